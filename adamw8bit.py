@@ -0,0 +1,175 @@
+import math
+import torch
+
+def _dynamic_codebook(signed: bool) -> torch.Tensor:
+    """
+    256 distinct sorted levels in [-1, 1] (signed) or [0, 1], spaced logarithmically.
+    
+    Blockwise-normalized Adam moments span several orders of magnitude, so
+    log spacing keeps the relative error roughly constant (about 3% for the
+    unsigned map, 6% for the signed one) instead of flushing small values to 0.
+    """
+    if signed:
+        # 127 negative levels, 0 and 128 positive levels
+        negative = -torch.logspace(-6, 0, 127, dtype=torch.float64).flip(0)
+        positive = torch.logspace(-6, 0, 128, dtype=torch.float64)
+        levels = torch.cat([negative, torch.zeros(1, dtype=torch.float64), positive])
+    else:
+        levels = torch.cat([torch.zeros(1, dtype=torch.float64), torch.logspace(-7, 0, 255, dtype=torch.float64)])
+    return levels.float()
+
+CODEBOOKS = {'signed': _dynamic_codebook(True), 'unsigned': _dynamic_codebook(False)}
+
+def quantize_blockwise(x: torch.Tensor, codebook: torch.Tensor, block_size: int = 256):
+    """
+    Quantize x to uint8 codebook indices with one absmax scale per block of block_size values.
+    
+    Values are rounded to the nearest level, except that a nonzero value
+    never becomes 0: it takes the smallest level of its sign instead. A
+    second moment flushed to 0 next to a nonzero first moment would turn the
+    Adam step into exp_avg / eps; rounding up only makes that step smaller.
+    
+    Returns:
+        codes: uint8 tensor, flattened and padded to a whole number of blocks
+        absmax: float32 scale per block
+    """
+    flat = x.detach().flatten().float()
+    padding = -flat.numel() % block_size
+    if padding:
+        flat = torch.cat([flat, flat.new_zeros(padding)])
+    blocks = flat.view(-1, block_size)
+    absmax = blocks.abs().amax(dim=1).clamp_min(torch.finfo(torch.float32).tiny)
+    codebook = codebook.to(flat.device)
+    midpoints = (codebook[1:] + codebook[:-1]) / 2
+    normalized = blocks / absmax[:, None]
+    codes = torch.bucketize(normalized, midpoints)
+    zero = int(codebook.abs().argmin())
+    codes = torch.where((codes == zero) & (normalized > 0), zero + 1, codes)
+    if zero > 0:
+        codes = torch.where((codes == zero) & (normalized < 0), zero - 1, codes)
+    return codes.to(torch.uint8).flatten(), absmax
+
+def dequantize_blockwise(codes: torch.Tensor, absmax: torch.Tensor, codebook: torch.Tensor, shape, block_size: int = 256) -> torch.Tensor:
+    """float32 tensor of the given shape from quantize_blockwise output"""
+    values = codebook.to(codes.device)[codes.long()].view(-1, block_size) * absmax[:, None]
+    return values.flatten()[:math.prod(shape)].view(shape)
+
+class AdamW8bit(torch.optim.Optimizer):
+    """
+    AdamW with both moments stored as blockwise-quantized 8-bit tensors.
+    
+    Each moment takes one byte per element plus one float32 scale per block,
+    about 2 bytes per parameter for both instead of 8. The update itself runs
+    in float32: a parameter's moments are dequantized, updated and quantized
+    again, one parameter at a time. Parameters smaller than min_8bit_size
+    (norm weights) keep float32 moments.
+    
+    Works with GradScaler (scaler.step() unscales the gradients before
+    step()) and round-trips through state_dict()/load_state_dict(). Loading
+    a torch.optim.AdamW state quantizes its float32 moments, so training
+    resumed from an existing checkpoint can switch to this optimizer.
+    """
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=1e-2, block_size=256, min_8bit_size=4096):
+        defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay)
+        super().__init__(params, defaults)
+        self.block_size = block_size
+        self.min_8bit_size = min_8bit_size
+    
+    def _quantized(self, p) -> bool:
+        return p.numel() >= self.min_8bit_size
+    
+    def _store(self, state, name, value, signed):
+        state[f"{name}_codes"], state[f"{name}_absmax"] = quantize_blockwise(
+            value, CODEBOOKS['signed' if signed else 'unsigned'], self.block_size
+        )
+    
+    def _load(self, state, name, p, signed):
+        return dequantize_blockwise(
+            state[f"{name}_codes"], state[f"{name}_absmax"], CODEBOOKS['signed' if signed else 'unsigned'], p.shape, self.block_size
+        )
+    
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+        
+        for group in self.param_groups:
+            beta1, beta2 = group['betas']
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                grad = p.grad.float()
+                state = self.state[p]
+                quantized = self._quantized(p)
+                
+                if len(state) == 0:
+                    state['step'] = torch.tensor(0.0)
+                    if quantized:
+                        self._store(state, 'exp_avg', torch.zeros_like(grad), signed=True)
+                        self._store(state, 'exp_avg_sq', torch.zeros_like(grad), signed=False)
+                    else:
+                        state['exp_avg'] = torch.zeros_like(p, dtype=torch.float32)
+                        state['exp_avg_sq'] = torch.zeros_like(p, dtype=torch.float32)
+                
+                if quantized:
+                    exp_avg = self._load(state, 'exp_avg', p, signed=True)
+                    exp_avg_sq = self._load(state, 'exp_avg_sq', p, signed=False)
+                else:
+                    exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
+                
+                state['step'] += 1
+                step = state['step'].item()
+                
+                # Decoupled weight decay, then the usual Adam update in float32
+                p.mul_(1 - group['lr'] * group['weight_decay'])
+                exp_avg.lerp_(grad, 1 - beta1)
+                exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+                bias_correction1 = 1 - beta1 ** step
+                bias_correction2 = 1 - beta2 ** step
+                denom = (exp_avg_sq.sqrt() / math.sqrt(bias_correction2)).add_(group['eps'])
+                p.addcdiv_(exp_avg.to(p.dtype), denom.to(p.dtype), value=-group['lr'] / bias_correction1)
+                
+                if quantized:
+                    self._store(state, 'exp_avg', exp_avg, signed=True)
+                    self._store(state, 'exp_avg_sq', exp_avg_sq, signed=False)
+        return loss
+    
+    def load_state_dict(self, state_dict):
+        """Load a state from this optimizer or from torch.optim.AdamW (float32 moments are quantized)"""
+        super().load_state_dict(state_dict)
+        for group in self.param_groups:
+            for p in group['params']:
+                state = self.state.get(p)
+                if not state:
+                    continue
+                # The base class casts floating point state to the parameter dtype,
+                # so codes come back as float; restore them to uint8
+                for key in [k for k in state if k.endswith('_codes')]:
+                    state[key] = state[key].to(torch.uint8)
+                for key in [k for k in state if k.endswith('_absmax')]:
+                    state[key] = state[key].float()
+                if torch.is_tensor(state.get('step')):
+                    state['step'] = state['step'].float().cpu()
+                else:
+                    state['step'] = torch.tensor(float(state['step']))
+                
+                if self._quantized(p) and 'exp_avg' in state:
+                    self._store(state, 'exp_avg', state.pop('exp_avg'), signed=True)
+                    self._store(state, 'exp_avg_sq', state.pop('exp_avg_sq'), signed=False)
+                    state.pop('max_exp_avg_sq', None)
+                elif not self._quantized(p) and 'exp_avg_codes' in state:
+                    state['exp_avg'] = self._load(state, 'exp_avg', p, signed=True)
+                    state['exp_avg_sq'] = self._load(state, 'exp_avg_sq', p, signed=False)
+                    for key in ('exp_avg_codes', 'exp_avg_absmax', 'exp_avg_sq_codes', 'exp_avg_sq_absmax'):
+                        del state[key]
+
+def optimizer_state_bytes(optimizer) -> int:
+    """Bytes held in an optimizer's per-parameter state tensors"""
+    return sum(
+        value.numel() * value.element_size()
+        for state in optimizer.state.values()
+        for value in state.values()
+        if torch.is_tensor(value)
+    )
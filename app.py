@@ -1,10 +1,23 @@
+import os
 import streamlit as st
 import torch
 import torch.nn.functional as F
-from smollm2_135M import create_model
-from checkpoint_utils import load_lightweight_checkpoint
+from checkpoint_utils import load_lightweight_model
+from generation import GenerationEngine, GenerationRequest, SpeculativeStats, detokenize_stream, speculative_stream
+from quantization import load_quantized_checkpoint
+from vocab_shortlist import load_shortlist
 from transformers import AutoTokenizer
 
+QUANTIZED_CHECKPOINT = "checkpoints/model_lightweight_10000_int8.pt"
+VOCAB_SHORTLIST = "checkpoints/vocab_shortlist.pt"
+# Seconds a session waits for each streamed token before giving up on the engine
+STREAM_TIMEOUT = 60.0
+# Off by default: with the measured weights the shortlist's exactness guard almost
+# always falls back to the full vocabulary, which is slower than the plain lm_head.
+# Turn it on only when python -m benchmarks.vocab_shortlist shows a net decode
+# speedup (few fallbacks) for the served checkpoint.
+USE_VOCAB_SHORTLIST = False
+
 @st.cache_resource
 def load_model_and_tokenizer():
     """Load model and tokenizer (cached by Streamlit)"""
@@ -12,9 +25,12 @@ def load_model_and_tokenizer():
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
     print(f"Using device: {device}")
     
-    # Create and load model
-    model = create_model()
-    model = load_lightweight_checkpoint(model, "checkpoints/model_lightweight_10000.pt")
+    # Prefer the int8 checkpoint (python quantization.py) on CPU-only hosts
+    if device == 'cpu' and os.path.exists(QUANTIZED_CHECKPOINT):
+        model = load_quantized_checkpoint(QUANTIZED_CHECKPOINT)
+    else:
+        # Build the model on the meta device and adopt the memory-mapped checkpoint weights
+        model = load_lightweight_model("checkpoints/model_lightweight_10000.pt", device)
     model.eval()
     
     # Load tokenizer from local directory
@@ -22,36 +38,40 @@ def load_model_and_tokenizer():
     
     return model, tokenizer
 
-def continue_text(model, tokenizer, prompt, max_new_tokens=50):
-    """Continue the prompt text using the trained model"""
-    # Determine device
-    device = next(model.parameters()).device
-    
-    # Encode prompt
-    inputs = tokenizer(prompt, return_tensors="pt", truncation=True, max_length=512)
-    input_ids = inputs["input_ids"].to(device)
-    
-    # Generate one token at a time
-    with torch.no_grad():
-        for _ in range(max_new_tokens):
-            # Get model predictions
-            logits, _ = model(input_ids)
-            
-            # Get the next token (most likely)
-            next_token = torch.argmax(logits[:, -1, :], dim=-1, keepdim=True)
-            
-            # Add the new token to our sequence
-            input_ids = torch.cat([input_ids, next_token], dim=1)
-    
-    # Decode the entire sequence
-    generated_text = tokenizer.decode(input_ids[0], skip_special_tokens=True)
-    return generated_text
+@st.cache_resource
+def load_engine(_model, _tokenizer):
+    """One generation engine shared by all sessions, so concurrent prompts are batched together"""
+    pad_token_id = _tokenizer.pad_token_id if _tokenizer.pad_token_id is not None else _tokenizer.eos_token_id
+    # Greedy steps project onto the vocabulary shortlist (python vocab_shortlist.py) if it is
+    # enabled and was built; it needs the dense lm_head, not the int8 one
+    vocab_shortlist = None
+    if USE_VOCAB_SHORTLIST and os.path.exists(VOCAB_SHORTLIST) and isinstance(_model.lm_head, torch.nn.Linear):
+        vocab_shortlist = load_shortlist(VOCAB_SHORTLIST, _model)
+    return GenerationEngine(_model, max_batch_size=8, pad_token_id=pad_token_id, vocab_shortlist=vocab_shortlist).start()
+
+def submit_prompt(engine, tokenizer, prompt, max_new_tokens=50, temperature=0.0, top_k=0, top_p=1.0):
+    """Encode the prompt and queue it on the engine"""
+    inputs = tokenizer(prompt, truncation=True, max_length=512)
+    return engine.submit(GenerationRequest(
+        prompt_ids=inputs["input_ids"],
+        max_new_tokens=max_new_tokens,
+        temperature=temperature,
+        top_k=top_k,
+        top_p=top_p,
+        eos_token_id=tokenizer.eos_token_id
+    ))
+
+def stream_continuation(prompt_ids, tokens, tokenizer):
+    """Yield the prompt text, then the continuation piece by piece as tokens are generated"""
+    yield tokenizer.decode(prompt_ids, skip_special_tokens=True)
+    yield from detokenize_stream(tokens, tokenizer, prompt_ids)
 
 # Streamlit UI
 st.title("Text Continuation with SmolLM2")
 
 # Load model and tokenizer
 model, tokenizer = load_model_and_tokenizer()
+engine = load_engine(model, tokenizer)
 
 # Input prompt
 prompt = st.text_area("Enter your prompt:", height=100)
@@ -59,12 +79,46 @@ prompt = st.text_area("Enter your prompt:", height=100)
 # Number of new tokens to generate
 max_new_tokens = st.slider("Number of new tokens", min_value=10, max_value=200, value=50)
 
+# Sampling settings (temperature 0 = greedy)
+temperature = st.slider("Temperature", min_value=0.0, max_value=2.0, value=0.0, step=0.1)
+top_k = st.slider("Top-k (0 = off)", min_value=0, max_value=200, value=0)
+top_p = st.slider("Top-p", min_value=0.05, max_value=1.0, value=1.0, step=0.05)
+
+# Self-speculative decoding: the first layers draft tokens, one full pass verifies them
+speculative = st.checkbox("Speculative decoding (greedy only, same output)", value=False)
+exit_layer = st.slider("Draft exit layer", min_value=1, max_value=model.config.num_hidden_layers - 1, value=8)
+draft_length = st.slider("Draft length", min_value=1, max_value=8, value=4)
+
 # Generate button
 if st.button("Continue Text"):
     if prompt:
-        with st.spinner("Generating..."):
-            continued_text = continue_text(model, tokenizer, prompt, max_new_tokens)
-            st.write("### Generated Continuation:")
-            st.write(continued_text)
+        st.write("### Generated Continuation:")
+        try:
+            if speculative and temperature == 0:
+                prompt_ids = tokenizer(prompt, truncation=True, max_length=512)["input_ids"]
+                timing = SpeculativeStats()
+                # Runs on this session's thread, interleaved with the engine's steps under its model lock
+                tokens = engine.exclusive_stream(speculative_stream(
+                    model, prompt_ids, max_new_tokens, exit_layer, draft_length, tokenizer.eos_token_id, stats=timing
+                ))
+                st.write_stream(stream_continuation(prompt_ids, tokens, tokenizer))
+                num_tokens = timing.generated
+            else:
+                timing = submit_prompt(engine, tokenizer, prompt, max_new_tokens, temperature, top_k, top_p)
+                # Rendered progressively as the engine produces tokens
+                st.write_stream(stream_continuation(timing.prompt_ids, timing.stream(timeout=STREAM_TIMEOUT), tokenizer))
+                num_tokens = len(timing.output_ids)
+        except Exception as e:
+            # A failed or stalled request ends this response only; the engine keeps serving
+            st.error(f"Generation failed: {e}")
+            st.stop()
+        
+        # Perceived latency: wait until the first token, then the decode rate
+        stats = f"Time to first token: {timing.time_to_first_token * 1000:.0f}ms | {num_tokens} tokens"
+        if timing.tokens_per_sec is not None:
+            stats += f" at {timing.tokens_per_sec:.1f} tokens/sec"
+        if isinstance(timing, SpeculativeStats) and timing.acceptance_rate is not None:
+            stats += f" | draft acceptance {timing.acceptance_rate:.0%}, {timing.tokens_per_full_pass:.2f} tokens per full pass"
+        st.caption(stats)
     else:
         st.warning("Please enter a prompt!") 
\ No newline at end of file
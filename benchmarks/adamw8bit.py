@@ -0,0 +1,133 @@
+"""
+AdamW vs AdamW8bit (blockwise 8-bit moments) on a small config on CPU.
+
+Reports optimizer state memory, training checkpoint size and the loss curve
+of both optimizers on the same batches, with a GradScaler in the loop. Also
+checks that a float32 AdamW state resumes into AdamW8bit through
+save/load_checkpoint and that an AdamW8bit checkpoint round-trips exactly.
+
+A stress check with one large gradient per 256-value block and the rest
+orders of magnitude smaller checks that no nonzero second moment is
+stored as 0 and that AdamW8bit moves parameters no further than AdamW.
+
+Run from the repository root:
+    python -m benchmarks.adamw8bit
+"""
+import os
+import tempfile
+import torch
+from torch.amp import GradScaler
+from transformers import AutoTokenizer
+from smollm2_135M import LlamaConfig, LlamaForCausalLM
+from checkpoint_utils import save_checkpoint, load_checkpoint
+from adamw8bit import AdamW8bit, optimizer_state_bytes
+from train import accumulate_gradients
+from benchmarks.common import synthetic_documents
+
+def make_optimizer(kind, model, lr=3e-3):
+    kwargs = dict(lr=lr, betas=(0.9, 0.95), eps=1e-8, weight_decay=0.01)
+    if kind == "8bit":
+        return AdamW8bit(model.parameters(), **kwargs)
+    return torch.optim.AdamW(model.parameters(), foreach=True, **kwargs)
+
+def train_steps(model, optimizer, scaler, batches):
+    losses = []
+    for x, y in batches:
+        loss = accumulate_gradients(model, scaler, [(x, y)], 'cpu', use_amp=False)
+        scaler.step(optimizer)
+        scaler.update()
+        optimizer.zero_grad(set_to_none=True)
+        losses.append(loss.item())
+    return losses
+
+def make_batches(num_batches, batch_size, sequence_length):
+    tokenizer = AutoTokenizer.from_pretrained("tokenizer", local_files_only=True)
+    ids = [token for text in synthetic_documents(40) for token in tokenizer(text, add_special_tokens=False)['input_ids']]
+    ids = torch.tensor(ids[:num_batches * batch_size * (sequence_length + 1)])
+    rows = ids.view(num_batches, batch_size, sequence_length + 1)
+    return [(row[:, :-1], row[:, 1:]) for row in rows]
+
+def mixed_magnitude_check(ratios=(1e-2, 1e-3, 1e-5), numel=8192, block_size=256, num_steps=20, lr=1e-3):
+    """One outlier gradient per block, the other values ratio times smaller"""
+    print(f"Mixed-magnitude blocks ({numel} values, one outlier per {block_size}, lr {lr}, {num_steps} steps):")
+    for ratio in ratios:
+        generator = torch.Generator().manual_seed(0)
+        grads = torch.randn(num_steps, numel, generator=generator) * ratio
+        grads[:, ::block_size] = 1.0
+        moved = {}
+        for kind in ("fp32", "8bit"):
+            p = torch.nn.Parameter(torch.zeros(numel))
+            if kind == "8bit":
+                optimizer = AdamW8bit([p], lr=lr, weight_decay=0.0, block_size=block_size)
+            else:
+                optimizer = torch.optim.AdamW([p], lr=lr, weight_decay=0.0)
+            for grad in grads:
+                p.grad = grad.clone()
+                optimizer.step()
+            moved[kind] = p.detach().abs().max().item()
+        state = optimizer.state[p]
+        exp_avg = optimizer._load(state, 'exp_avg', p, signed=True)
+        exp_avg_sq = optimizer._load(state, 'exp_avg_sq', p, signed=False)
+        flushed = int(((exp_avg_sq == 0) & (exp_avg != 0)).sum())
+        print(f"  ratio {ratio:.0e}: max |change| fp32 {moved['fp32']:.4f} | 8bit {moved['8bit']:.4f} | "
+              f"v == 0 with m != 0: {flushed}/{numel}")
+        assert flushed == 0, "a nonzero second moment was quantized to 0"
+        assert moved["8bit"] <= 1.1 * moved["fp32"], "AdamW8bit steps exceed AdamW's on mixed-magnitude blocks"
+
+def benchmark(num_hidden_layers=2, batch_size=4, sequence_length=64, num_steps=40):
+    batches = make_batches(num_steps, batch_size, sequence_length)
+    config = LlamaConfig(num_hidden_layers=num_hidden_layers)
+    torch.manual_seed(1337)
+    initial = LlamaForCausalLM(config).state_dict()
+    
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for kind in ("fp32", "8bit"):
+            model = LlamaForCausalLM(config)
+            model.load_state_dict(initial)
+            optimizer = make_optimizer(kind, model)
+            scaler = GradScaler('cpu', init_scale=2.0**10)
+            losses = train_steps(model, optimizer, scaler, batches)
+            save_dir = os.path.join(tmp, kind)
+            save_checkpoint(model, optimizer, scaler, num_steps, losses[-1], save_dir=save_dir)
+            size = os.path.getsize(os.path.join(save_dir, "model_latest.pt"))
+            results[kind] = (losses, optimizer_state_bytes(optimizer), size, model, optimizer)
+        
+        params = sum(p.numel() for p in results["fp32"][3].parameters())
+        print(f"{num_hidden_layers} layers, {params / 1e6:.1f}M parameters ({params * 4 / 2**20:.1f}MB fp32)")
+        for kind, (losses, state_bytes, size, _, _) in results.items():
+            print(f"AdamW {kind:<5} optimizer state {state_bytes / 2**20:7.1f}MB | checkpoint {size / 2**20:7.1f}MB | "
+                  f"final loss {losses[-1]:.4f}")
+        print("Loss curve (every 5 steps):")
+        for step in range(0, num_steps, 5):
+            print(f"  step {step:3d}  fp32 {results['fp32'][0][step]:.4f}  8bit {results['8bit'][0][step]:.4f}")
+        assert abs(results["8bit"][0][-1] - results["fp32"][0][-1]) < 0.1 * results["fp32"][0][-1], "8-bit loss curve diverged"
+        
+        # A float32 AdamW checkpoint resumes into AdamW8bit
+        model = LlamaForCausalLM(config)
+        optimizer = make_optimizer("8bit", model)
+        scaler = GradScaler('cpu', init_scale=2.0**10)
+        load_checkpoint(model, optimizer, scaler, checkpoint_path=os.path.join(tmp, "fp32", "model_latest.pt"))
+        # The tied embedding is the largest quantized parameter
+        embedding = model.model.embed_tokens.weight
+        restored = optimizer._load(optimizer.state[embedding], 'exp_avg_sq', embedding, signed=False)
+        fp32_model, fp32_optimizer = results["fp32"][3:]
+        expected = fp32_optimizer.state[fp32_model.model.embed_tokens.weight]['exp_avg_sq']
+        rel = ((restored - expected).abs().sum() / expected.abs().sum()).item()
+        print(f"fp32 AdamW checkpoint -> AdamW8bit: exp_avg_sq relative error {rel:.2%}")
+        assert rel < 0.05
+        train_steps(model, optimizer, scaler, batches[:2])
+        
+        # AdamW8bit checkpoints round-trip exactly
+        _, _, _, model_8bit, optimizer_8bit = results["8bit"]
+        model = LlamaForCausalLM(config)
+        optimizer = make_optimizer("8bit", model)
+        load_checkpoint(model, optimizer, GradScaler('cpu'), checkpoint_path=os.path.join(tmp, "8bit", "model_latest.pt"))
+        for saved, loaded in zip(optimizer_8bit.state.values(), optimizer.state.values()):
+            assert all(torch.equal(saved[k], loaded[k]) and saved[k].dtype == loaded[k].dtype for k in saved)
+        print("AdamW8bit checkpoint round-trips exactly (uint8 codes, scales and step)")
+    
+    mixed_magnitude_check()
+
+if __name__ == "__main__":
+    benchmark()
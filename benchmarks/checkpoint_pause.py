@@ -0,0 +1,79 @@
+"""
+Training-loop pause per checkpoint: synchronous torch.save vs the background CheckpointManager.
+
+Also checks that load_checkpoint skips a truncated newest checkpoint and
+resumes from the previous one.
+
+Run from the repository root:
+    python -m benchmarks.checkpoint_pause
+"""
+import os
+import tempfile
+import time
+import torch
+from torch.amp import GradScaler
+from smollm2_135M import LlamaConfig, LlamaForCausalLM
+from checkpoint_utils import CheckpointManager, load_checkpoint, _training_state
+
+def train_step(model, optimizer, x, y):
+    _, loss = model(x, labels=y)
+    loss.backward()
+    optimizer.step()
+    optimizer.zero_grad(set_to_none=True)
+    return loss.item()
+
+def run(model, optimizer, scaler, x, y, num_steps, checkpoint_frequency, save):
+    """Train for num_steps, checkpointing with save(step, loss); returns (loop time, pauses)"""
+    pauses = []
+    t0 = time.perf_counter()
+    for step in range(1, num_steps + 1):
+        loss = train_step(model, optimizer, x, y)
+        if step % checkpoint_frequency == 0:
+            t = time.perf_counter()
+            save(step, loss)
+            pauses.append(time.perf_counter() - t)
+    return time.perf_counter() - t0, pauses
+
+def benchmark(num_hidden_layers=8, batch_size=2, sequence_length=128, num_steps=6, checkpoint_frequency=2):
+    torch.manual_seed(1337)
+    model = LlamaForCausalLM(LlamaConfig(num_hidden_layers=num_hidden_layers))
+    optimizer = torch.optim.AdamW(model.parameters(), lr=3e-4)
+    scaler = GradScaler(enabled=False)
+    x = torch.randint(0, model.config.vocab_size, (batch_size, sequence_length))
+    y = torch.randint(0, model.config.vocab_size, (batch_size, sequence_length))
+    train_step(model, optimizer, x, y)  # Populate the optimizer state
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        def save_sync(step, loss):
+            # The previous save_checkpoint: torch.save on the training thread
+            torch.save(_training_state(model, optimizer, scaler, step, loss), os.path.join(tmp_dir, "model_latest.pt"))
+        
+        sync_time, sync_pauses = run(model, optimizer, scaler, x, y, num_steps, checkpoint_frequency, save_sync)
+        size = os.path.getsize(os.path.join(tmp_dir, "model_latest.pt")) / 2**20
+        
+        manager = CheckpointManager(save_dir=os.path.join(tmp_dir, "async"), keep_last=2)
+        async_time, async_pauses = run(
+            model, optimizer, scaler, x, y, num_steps, checkpoint_frequency,
+            lambda step, loss: manager.save(model, optimizer, scaler, step, loss)
+        )
+        t = time.perf_counter()
+        manager.wait()
+        flush_time = time.perf_counter() - t
+        
+        print(f"Layers: {num_hidden_layers} | checkpoint {size:.1f}MB | {num_steps} steps, checkpoint every {checkpoint_frequency}")
+        print(f"Synchronous torch.save: pause {sum(sync_pauses) / len(sync_pauses) * 1000:8.1f}ms/checkpoint | loop {sync_time:.2f}s")
+        print(f"CheckpointManager:      pause {sum(async_pauses) / len(async_pauses) * 1000:8.1f}ms/checkpoint | "
+              f"loop {async_time:.2f}s (+{flush_time * 1000:.1f}ms final flush)")
+        
+        # Corrupt the newest checkpoint; loading must fall back to the one before it
+        kept = sorted(os.listdir(manager.save_dir))
+        print(f"Kept checkpoints: {kept}")
+        newest = os.path.join(manager.save_dir, kept[-1])
+        with open(newest, "r+b") as f:
+            f.truncate(os.path.getsize(newest) // 2)
+        step, _ = load_checkpoint(model, optimizer, scaler, save_dir=manager.save_dir)
+        assert step == num_steps - checkpoint_frequency, "did not fall back to the previous checkpoint"
+        print(f"Truncated newest checkpoint skipped; resumed from step {step}")
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,42 @@
+"""
+Peak memory and training step time for each activation checkpointing policy.
+
+Run from the repository root:
+    python -m benchmarks.checkpointing
+"""
+import time
+import torch
+from smollm2_135M import LlamaConfig, LlamaForCausalLM, CHECKPOINT_POLICIES
+from benchmarks.common import peak_cpu_memory
+
+def train_step(model, x, y):
+    _, loss = model(x, labels=y)
+    loss.backward()
+    model.zero_grad(set_to_none=True)
+    return loss.item()
+
+def benchmark(batch_size=4, sequence_length=256, num_hidden_layers=8, every_k=2, repeats=3):
+    torch.manual_seed(1337)
+    model = LlamaForCausalLM(LlamaConfig(num_hidden_layers=num_hidden_layers))
+    model.train()
+    x = torch.randint(0, model.config.vocab_size, (batch_size, sequence_length))
+    y = torch.randint(0, model.config.vocab_size, (batch_size, sequence_length))
+    print(f"Layers: {num_hidden_layers} | batch {batch_size} x {sequence_length} | every_k={every_k}")
+    
+    losses = {}
+    for policy in CHECKPOINT_POLICIES:
+        model.gradient_checkpointing_enable(policy, every_k=every_k)
+        loss, peak = peak_cpu_memory(lambda: train_step(model, x, y))
+        
+        t0 = time.perf_counter()
+        for _ in range(repeats):
+            train_step(model, x, y)
+        step_ms = (time.perf_counter() - t0) / repeats * 1000
+        
+        losses[policy] = loss
+        print(f"{policy:<10} peak {peak / 2**20:8.1f}MB | step {step_ms:8.1f}ms | loss {loss:.6f}")
+    
+    assert len({round(l, 5) for l in losses.values()}) == 1, "checkpointing changed the loss"
+
+if __name__ == "__main__":
+    benchmark()
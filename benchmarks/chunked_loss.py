@@ -0,0 +1,54 @@
+"""
+Compare the full-logits loss with the chunked lm_head/cross-entropy loss:
+gradient parity, peak memory and training step time on CPU.
+
+Run from the repository root:
+    python -m benchmarks.chunked_loss
+"""
+import time
+import torch
+from smollm2_135M import LlamaConfig, LlamaForCausalLM
+from benchmarks.common import peak_cpu_memory
+
+def train_step(model, x, y, return_logits):
+    _, loss = model(x, labels=y, return_logits=return_logits)
+    loss.backward()
+    return loss.item()
+
+def check_gradients(model, x, y, atol=1e-5):
+    grads = {}
+    for return_logits in (True, False):
+        model.zero_grad(set_to_none=True)
+        train_step(model, x, y, return_logits)
+        grads[return_logits] = [p.grad.clone() for p in model.parameters()]
+    diff = max((a - b).abs().max().item() for a, b in zip(grads[True], grads[False]))
+    print(f"Max gradient difference (chunked vs full): {diff:.2e}")
+    assert diff < atol, "chunked loss gradients diverge from the full-logits loss"
+
+def benchmark(batch_size=4, sequence_length=512, num_hidden_layers=2, chunk_sizes=(256, 1024), repeats=3):
+    torch.manual_seed(1337)
+    model = LlamaForCausalLM(LlamaConfig(num_hidden_layers=num_hidden_layers))
+    model.train()
+    x = torch.randint(0, model.config.vocab_size, (batch_size, sequence_length))
+    y = torch.randint(0, model.config.vocab_size, (batch_size, sequence_length))
+    print(f"Layers: {num_hidden_layers} | batch {batch_size} x {sequence_length} | vocab {model.config.vocab_size}")
+    
+    check_gradients(model, x, y)
+    
+    runs = [("full logits", None)] + [(f"chunked ({c})", c) for c in chunk_sizes]
+    for name, chunk_size in runs:
+        if chunk_size is not None:
+            model.config.loss_chunk_size = chunk_size
+        step = lambda: train_step(model, x, y, return_logits=chunk_size is None)
+        
+        model.zero_grad(set_to_none=True)
+        loss, peak = peak_cpu_memory(step)
+        t0 = time.perf_counter()
+        for _ in range(repeats):
+            model.zero_grad(set_to_none=True)
+            step()
+        step_ms = (time.perf_counter() - t0) / repeats * 1000
+        print(f"{name:<16} peak {peak / 2**20:8.1f}MB | step {step_ms:8.1f}ms | loss {loss:.6f}")
+
+if __name__ == "__main__":
+    benchmark()
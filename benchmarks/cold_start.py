@@ -0,0 +1,94 @@
+"""
+Cold-start model load time and peak RSS: eager init + torch.load vs meta-device + mmap.
+
+Each loader runs in a fresh Python process, as the app does on startup, and
+peak RSS is reported above the process's footprint after imports. A
+random-weights lightweight checkpoint is written first when the real one is
+not available (e.g. only its git-lfs pointer is checked out). The file is in
+the page cache for every run, so the numbers exclude disk reads.
+
+Run from the repository root:
+    python -m benchmarks.cold_start
+"""
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import torch
+from smollm2_135M import create_model
+from checkpoint_utils import load_lightweight_model
+
+def load_eager(checkpoint_path):
+    """The previous app path: random init, full read, copy into the parameters"""
+    model = create_model()
+    model.load_state_dict(torch.load(checkpoint_path, map_location='cpu'))
+    return model.eval()
+
+def load_meta_mmap(checkpoint_path):
+    return load_lightweight_model(checkpoint_path, device='cpu')
+
+LOADERS = {'eager': load_eager, 'meta+mmap': load_meta_mmap}
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB"""
+    # VmHWM starts fresh at exec; ru_maxrss can carry over the parent's peak
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def child(loader, checkpoint_path):
+    """Measure one load in this process and print the results as JSON"""
+    baseline = peak_rss_mb()
+    t0 = time.perf_counter()
+    model = LOADERS[loader](checkpoint_path)
+    load_time = time.perf_counter() - t0
+    load_peak = peak_rss_mb()
+    
+    # First forward pass, which is when the memory-mapped weights get paged in
+    with torch.no_grad():
+        model(torch.zeros(1, 8, dtype=torch.long))
+    first_token_time = time.perf_counter() - t0
+    peak = peak_rss_mb()
+    print(json.dumps({
+        'load_time': load_time,
+        'first_token_time': first_token_time,
+        'load_peak_mb': load_peak - baseline,
+        'peak_mb': peak - baseline,
+    }))
+
+def run_child(loader, checkpoint_path):
+    out = subprocess.run(
+        [sys.executable, "-m", "benchmarks.cold_start", "--child", loader, checkpoint_path],
+        capture_output=True, text=True, check=True
+    )
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+def benchmark(checkpoint_path="checkpoints/model_lightweight_10000.pt", repeats=3):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        try:
+            torch.load(checkpoint_path, map_location='cpu', mmap=True, weights_only=True)
+        except Exception as e:
+            print(f"Could not load {checkpoint_path} ({type(e).__name__}); writing a random-weights checkpoint")
+            checkpoint_path = os.path.join(tmp_dir, "model_lightweight.pt")
+            torch.save(create_model().state_dict(), checkpoint_path)
+        print(f"Checkpoint: {os.path.getsize(checkpoint_path) / 2**20:.1f}MB")
+        
+        for loader in LOADERS:
+            runs = [run_child(loader, checkpoint_path) for _ in range(repeats)]
+            best = min(runs, key=lambda r: r['load_time'])
+            print(f"{loader:<10} load {best['load_time'] * 1000:8.1f}ms | first token {best['first_token_time'] * 1000:8.1f}ms | "
+                  f"peak RSS after load {best['load_peak_mb']:7.1f}MB | after first token {best['peak_mb']:7.1f}MB")
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "--child":
+        child(sys.argv[2], sys.argv[3])
+    else:
+        benchmark()
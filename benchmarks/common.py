@@ -0,0 +1,49 @@
+"""
+Shared helpers for the CPU benchmarks: synthetic text and a local corpus.
+"""
+import json
+import os
+import random
+
+WORDS = (
+    "the a of and to in is was for on with as by at from that this it are be "
+    "students learn algebra geometry history science energy planet water light "
+    "cells growth market price story children teacher example simple important "
+    "because however therefore first second finally together different often"
+).split()
+
+def synthetic_documents(num_docs, seed=0, min_sentences=5, max_sentences=60):
+    """Random English-like documents made of period-terminated sentences."""
+    rng = random.Random(seed)
+    docs = []
+    for _ in range(num_docs):
+        sentences = []
+        for _ in range(rng.randint(min_sentences, max_sentences)):
+            words = [rng.choice(WORDS) for _ in range(rng.randint(4, 24))]
+            sentences.append(" ".join(words).capitalize() + ".")
+        docs.append(" ".join(sentences))
+    return docs
+
+def write_synthetic_corpus(path, num_docs, seed=0):
+    """Write synthetic documents as JSON lines with a "text" field and return the path."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        for text in synthetic_documents(num_docs, seed):
+            f.write(json.dumps({"text": text}) + "\n")
+    return path
+
+def peak_cpu_memory(fn):
+    """
+    Run fn() under the PyTorch profiler and return (result, peak bytes).
+    
+    The peak is the high-water mark of tensor memory allocated during the
+    call, replayed from the profiler's allocation and free events.
+    """
+    from torch.profiler import profile, ProfilerActivity
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        result = fn()
+    current = peak = 0
+    for event in sorted(prof.events(), key=lambda e: e.time_range.start):
+        current += event.self_cpu_memory_usage
+        peak = max(peak, current)
+    return result, peak
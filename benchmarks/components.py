@@ -0,0 +1,87 @@
+"""
+Time each smollm2_135M component on CPU, reference vs fused paths, and check
+numerical parity between them.
+
+Run from the repository root:
+    python -m benchmarks.components
+"""
+import copy
+import time
+import torch
+from smollm2_135M import (
+    LlamaConfig,
+    RMSNorm,
+    RotaryEmbedding,
+    LlamaAttention,
+    LlamaMLP,
+    LlamaDecoderLayer,
+    apply_rotary_pos_emb,
+    apply_rotary_pos_emb_fused,
+)
+
+def time_fn(fn, repeats=20, warmup=3, backward=False):
+    """Median wall time of fn() in milliseconds (optionally including backward)"""
+    times = []
+    for i in range(warmup + repeats):
+        t0 = time.perf_counter()
+        out = fn()
+        if backward:
+            out.float().sum().backward()
+        if i >= warmup:
+            times.append(time.perf_counter() - t0)
+    times.sort()
+    return times[len(times) // 2] * 1000
+
+def report(name, ref_fn, new_fn, backward=False, atol=1e-5):
+    with torch.no_grad():
+        diff = (ref_fn() - new_fn()).abs().max().item()
+    ref_ms = time_fn(ref_fn, backward=backward)
+    new_ms = time_fn(new_fn, backward=backward)
+    status = "ok" if diff <= atol else "MISMATCH"
+    print(f"{name:<28} ref {ref_ms:8.3f}ms | fused {new_ms:8.3f}ms | {ref_ms / new_ms:5.2f}x | max diff {diff:.1e} {status}")
+    return diff <= atol
+
+def benchmark(batch_size=2, seq_len=512, backward=False, compile=False):
+    torch.manual_seed(1337)
+    ref_config = LlamaConfig(fused_rms_norm=False, fused_rotary=False)
+    fused_config = LlamaConfig(fused_rms_norm=True, fused_rotary=True)
+    head_dim = ref_config.hidden_size // ref_config.num_attention_heads
+    maybe_compile = torch.compile if compile else (lambda m: m)
+    
+    x = torch.randn(batch_size, seq_len, ref_config.hidden_size, requires_grad=backward)
+    print(f"Batch {batch_size} x {seq_len} | {'forward + backward' if backward else 'forward'}"
+          f"{' | torch.compile' if compile else ''}")
+    ok = True
+    
+    # RMSNorm
+    ref_norm = RMSNorm(ref_config.hidden_size, eps=ref_config.rms_norm_eps)
+    fused_norm = RMSNorm(ref_config.hidden_size, eps=ref_config.rms_norm_eps, fused=True)
+    ref_norm, fused_norm = maybe_compile(ref_norm), maybe_compile(fused_norm)
+    ok &= report("RMSNorm", lambda: ref_norm(x), lambda: fused_norm(x), backward, atol=1e-4)
+    
+    # Rotary table lookup and application
+    rotary = RotaryEmbedding(head_dim, ref_config.max_position_embeddings, ref_config.rope_theta)
+    cos, sin = rotary(x, seq_len=seq_len)
+    cos, sin = cos.view(1, seq_len, 1, head_dim), sin.view(1, seq_len, 1, head_dim)
+    q = torch.randn(batch_size, seq_len, ref_config.num_attention_heads, head_dim, requires_grad=backward)
+    k = torch.randn(batch_size, seq_len, ref_config.num_key_value_heads, head_dim, requires_grad=backward)
+    ref_rope, fused_rope = maybe_compile(apply_rotary_pos_emb), maybe_compile(apply_rotary_pos_emb_fused)
+    ok &= report("RotaryEmbedding (apply)",
+                 lambda: torch.cat([t.flatten() for t in ref_rope(q, k, cos, sin)]),
+                 lambda: torch.cat([t.flatten() for t in fused_rope(q, k, cos, sin)]), backward)
+    
+    # Attention, MLP and a full decoder layer with identical weights
+    for name, cls in [("LlamaAttention", LlamaAttention), ("LlamaMLP", LlamaMLP), ("LlamaDecoderLayer", LlamaDecoderLayer)]:
+        ref_module = cls(ref_config)
+        fused_module = cls(fused_config)
+        fused_module.load_state_dict(copy.deepcopy(ref_module.state_dict()))
+        ref_module, fused_module = maybe_compile(ref_module), maybe_compile(fused_module)
+        args = (x,) if cls is LlamaMLP else (x, (cos, sin))
+        ok &= report(name, lambda: ref_module(*args), lambda: fused_module(*args), backward, atol=1e-4)
+    
+    assert ok, "fused path diverges from the reference"
+
+if __name__ == "__main__":
+    benchmark(backward=False)
+    benchmark(backward=True)
+    benchmark(backward=False, compile=True)
@@ -0,0 +1,141 @@
+"""
+Data-parallel training checks with several CPU processes (gloo backend).
+
+- The rank-sharded loaders read disjoint documents that together cover the corpus
+- DDP gradients (with gradient accumulation) match one process on the global batch
+- save_checkpoint writes once, from rank 0, with every rank's loader position,
+  and load_checkpoint gives each rank its own position back
+- Loss and throughput reductions across ranks, and the MIN reduction that
+  gives every rank the same probed micro-batch size
+
+Run from the repository root:
+    python -m benchmarks.ddp_check
+"""
+import os
+import tempfile
+import time
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.amp import GradScaler
+from torch.nn.parallel import DistributedDataParallel as DDP
+from smollm2_135M import LlamaConfig, LlamaForCausalLM
+from cosmopedia_dataloader import CosmopediaDataLoader
+from checkpoint_utils import save_checkpoint, load_checkpoint
+from dist_utils import setup_distributed, cleanup_distributed, all_reduce_mean, all_reduce_min, all_reduce_sum, gather_objects
+from train import accumulate_gradients
+from benchmarks.common import write_synthetic_corpus
+
+def make_loader(corpus, rank, world_size):
+    return CosmopediaDataLoader(
+        batch_size=2,
+        sequence_length=64,
+        tokenizer_path="tokenizer",
+        dataset_name="json",
+        subset=None,
+        data_files=corpus,
+        seed=1337,
+        rank=rank,
+        world_size=world_size
+    )
+
+def gradients(model):
+    return {name: p.grad.clone() for name, p in model.named_parameters() if p.grad is not None}
+
+def check_sharding(corpus, rank, world_size):
+    loader = make_loader(corpus, rank, world_size)
+    texts = [example['text'] for example in loader.dataset]
+    all_texts = gather_objects(texts)
+    full = [example['text'] for example in make_loader(corpus, 0, 1).dataset]
+    if rank == 0:
+        seen = [set(t) for t in all_texts]
+        assert all(not (a & b) for i, a in enumerate(seen) for b in seen[i + 1:]), "ranks share documents"
+        assert set().union(*seen) == set(full), "ranks do not cover the corpus"
+        print(f"Sharding: {[len(t) for t in all_texts]} documents per rank, disjoint, covering all {len(full)}")
+    return loader
+
+def check_gradients(rank, world_size, batch_size=4, sequence_length=32, accumulation_steps=2):
+    torch.manual_seed(1337)
+    model = LlamaForCausalLM(LlamaConfig(num_hidden_layers=2))
+    x = torch.randint(0, model.config.vocab_size, (batch_size * world_size, sequence_length))
+    y = torch.randint(0, model.config.vocab_size, (batch_size * world_size, sequence_length))
+    # Uneven masking: rank r's rows have fewer labelled tokens the higher r is, so
+    # only weights from the global token count match the single-process batch
+    for r in range(world_size):
+        y[r * batch_size:(r + 1) * batch_size, :r * sequence_length // (2 * world_size)] = -100
+    scaler = GradScaler('cpu', enabled=False)
+    
+    # Reference: one process, the whole global batch
+    accumulate_gradients(model, scaler, [(x, y)], 'cpu', use_amp=False)
+    expected = gradients(model)
+    model.zero_grad(set_to_none=True)
+    
+    # DDP: this rank's slice, split into micro-batches
+    ddp_model = DDP(model)
+    local_x = x[rank * batch_size:(rank + 1) * batch_size]
+    local_y = y[rank * batch_size:(rank + 1) * batch_size]
+    micro = batch_size // accumulation_steps
+    micro_batches = [(local_x[i:i + micro], local_y[i:i + micro]) for i in range(0, batch_size, micro)]
+    accumulate_gradients(ddp_model, scaler, micro_batches, 'cpu', use_amp=False)
+    actual = gradients(model)
+    
+    max_diff = max((expected[name] - actual[name]).abs().max().item() for name in expected)
+    max_diff = all_reduce_sum(max_diff)
+    if rank == 0:
+        print(f"DDP vs single-process gradients (uneven labelled tokens per rank): max difference {max_diff:.2e}")
+    assert max_diff < 1e-6, "DDP gradients differ from the single-process global batch"
+    return model
+
+def check_checkpoint(model, loader, rank, world_size, save_dir):
+    optimizer = torch.optim.AdamW(model.parameters(), lr=3e-4)
+    scaler = GradScaler('cpu', enabled=False)
+    for _ in range(3):
+        loader.next_batch()
+    save_checkpoint(model, optimizer, scaler, step=3, loss=1.0, save_dir=save_dir, train_loader=loader)
+    expected = loader.next_batch()[0]
+    dist.barrier()
+    
+    if rank == 0:
+        files = os.listdir(save_dir)
+        assert files == ["model_latest.pt"], f"unexpected checkpoint files {files}"
+        checkpoint = torch.load(os.path.join(save_dir, "model_latest.pt"), weights_only=False)
+        assert len(checkpoint['loader_state_dicts']) == world_size
+        print(f"Checkpoint: written once by rank 0 with {world_size} loader positions")
+    
+    load_checkpoint(model, optimizer, scaler, checkpoint_path=os.path.join(save_dir, "model_latest.pt"), train_loader=loader)
+    assert torch.equal(loader.next_batch()[0], expected), f"rank {rank} did not resume its own data position"
+    dist.barrier()
+    if rank == 0:
+        print("Resume: every rank continues from its own data position")
+
+def worker(rank, world_size, corpus, save_dir):
+    os.environ.update(RANK=str(rank), WORLD_SIZE=str(world_size), MASTER_ADDR="127.0.0.1", MASTER_PORT="29517")
+    torch.set_num_threads(1)
+    setup_distributed("gloo")
+    try:
+        loader = check_sharding(corpus, rank, world_size)
+        model = check_gradients(rank, world_size)
+        check_checkpoint(model, loader, rank, world_size, save_dir)
+        
+        t0 = time.perf_counter()
+        mean_loss = all_reduce_mean(float(rank))
+        total = all_reduce_sum(1000.0)
+        # Micro-batch agreement: each rank probes its own size, all use the smallest
+        micro_batch = int(all_reduce_min(16 >> rank))
+        assert micro_batch == 16 >> (world_size - 1), f"rank {rank} got micro-batch {micro_batch}"
+        if rank == 0:
+            assert mean_loss == (world_size - 1) / 2 and total == 1000.0 * world_size
+            print(f"Reductions: mean/sum/min over {world_size} ranks in {(time.perf_counter() - t0) * 1000:.2f}ms; "
+                  f"shared micro-batch {micro_batch}")
+    finally:
+        cleanup_distributed()
+
+def benchmark(world_size=2, num_docs=40):
+    with tempfile.TemporaryDirectory() as tmp:
+        corpus = write_synthetic_corpus(os.path.join(tmp, "corpus.jsonl"), num_docs)
+        save_dir = os.path.join(tmp, "checkpoints")
+        mp.spawn(worker, args=(world_size, corpus, save_dir), nprocs=world_size, join=True)
+    print(f"All data-parallel checks passed with {world_size} processes")
+
+if __name__ == "__main__":
+    benchmark()
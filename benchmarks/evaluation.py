@@ -0,0 +1,162 @@
+"""
+Held-out perplexity evaluation on CPU.
+
+- build_held_out_set tokenizes a local corpus once with the bundled tokenizer
+- Sliding windows score every token after the first of each document exactly once
+- Batched, padded evaluation equals an unbatched per-document reference when
+  the window covers whole documents
+- Cost in the training loop: the old sample preview (a forward pass over the
+  whole batch) vs one row vs inline evaluation of a fixed window subset
+- The checkpoint watcher, in its own process, evaluates each checkpoint
+  CheckpointManager writes and skips those already in its metrics file
+
+Run from the repository root:
+    python -m benchmarks.evaluation
+"""
+import contextlib
+import io
+import json
+import math
+import os
+import tempfile
+import time
+import torch
+import torch.multiprocessing as mp
+import torch.nn.functional as F
+from torch.amp import GradScaler
+from transformers import AutoTokenizer
+from smollm2_135M import LlamaConfig, LlamaForCausalLM
+from checkpoint_utils import CheckpointManager
+from evaluation import HeldOutSet, build_held_out_set, evaluate_perplexity, watch_checkpoints
+from model_sampling import sample_model_output
+from train import accumulate_gradients
+from benchmarks.common import write_synthetic_corpus
+
+CONFIG = LlamaConfig(num_hidden_layers=2)
+
+def documents(path):
+    data = torch.load(path, weights_only=True)
+    offsets = data['offsets'].tolist()
+    return [data['tokens'][start:end].long() for start, end in zip(offsets[:-1], offsets[1:])]
+
+def reference_loss(model, docs):
+    """Mean next-token loss with one unpadded forward pass per document"""
+    total, count = 0.0, 0
+    with torch.no_grad():
+        for doc in docs:
+            logits, _ = model(doc[None, :-1])
+            total += F.cross_entropy(logits[0].double(), doc[1:], reduction='sum').item()
+            count += len(doc) - 1
+    return total / count
+
+def check_windows(held_out_path, docs):
+    expected = sum(len(doc) - 1 for doc in docs)
+    for window, stride in [(64, 64), (64, 16), (128, 64)]:
+        held_out = HeldOutSet(held_out_path, window=window, stride=stride)
+        assert held_out.num_tokens == expected, f"window {window}/{stride} scores {held_out.num_tokens} of {expected} tokens"
+    print(f"Sliding windows: every one of {expected} targets scored exactly once (window/stride 64/64, 64/16, 128/64)")
+
+def check_exactness(model, held_out_path, docs):
+    longest = max(len(doc) for doc in docs)
+    held_out = HeldOutSet(held_out_path, window=longest)
+    result = evaluate_perplexity(model, held_out, batch_size=4)
+    expected = reference_loss(model, docs)
+    print(f"Whole-document windows: loss {result['loss']:.6f} vs unbatched reference {expected:.6f}")
+    assert abs(result['loss'] - expected) < 1e-4, "batched evaluation differs from the per-document reference"
+    
+    sliding = evaluate_perplexity(model, HeldOutSet(held_out_path, window=128), batch_size=8)
+    print(f"Window 128, stride 64: perplexity {sliding['perplexity']:.2f} vs {math.exp(expected):.2f} with whole-document context")
+
+def loop_costs(model, held_out_path, tokenizer, batch_size=16, sequence_length=256, eval_max_windows=16, repeats=3):
+    x = torch.randint(0, CONFIG.vocab_size, (batch_size, sequence_length))
+    scaler = GradScaler('cpu', enabled=False)
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.0)
+    held_out = HeldOutSet(held_out_path, window=sequence_length, max_windows=eval_max_windows)
+    
+    def train_step():
+        accumulate_gradients(model, scaler, [(x, x)], 'cpu', use_amp=False)
+        optimizer.step()
+        optimizer.zero_grad()
+    
+    def sample(rows):
+        model.eval()
+        with torch.no_grad():
+            sample_model_output(model, rows, tokenizer)
+        model.train()
+    
+    def best_ms(fn):
+        times = []
+        for _ in range(repeats):
+            t0 = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - t0)
+        return min(times) * 1000
+    
+    model.train()
+    step_ms = best_ms(train_step)
+    with contextlib.redirect_stdout(io.StringIO()):
+        full_sample_ms = best_ms(lambda: sample(x))
+        row_sample_ms = best_ms(lambda: sample(x[:1]))
+    eval_ms = best_ms(lambda: evaluate_perplexity(model, held_out, batch_size=8))
+    print(f"Training loop, batch {batch_size} x {sequence_length}: step {step_ms:.0f}ms")
+    print(f"  sample preview over the whole batch (old): +{full_sample_ms:.0f}ms | one row (default): +{row_sample_ms:.0f}ms")
+    print(f"  inline evaluation of {len(held_out)} windows ({held_out.num_tokens} tokens): +{eval_ms:.0f}ms of stalled training; "
+          "the watcher takes it off the training process")
+
+def check_watcher(held_out_path, tmp):
+    checkpoint_dir = os.path.join(tmp, "checkpoints")
+    metrics_path = os.path.join(tmp, "eval_metrics.jsonl")
+    torch.manual_seed(0)
+    model = LlamaForCausalLM(CONFIG)
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.0)
+    manager = CheckpointManager(save_dir=checkpoint_dir, keep_last=3)
+    
+    watcher = mp.get_context("spawn").Process(
+        target=watch_checkpoints,
+        args=(held_out_path, checkpoint_dir, metrics_path),
+        kwargs=dict(window=128, max_windows=16, poll_interval=0.5, config=CONFIG, num_threads=1),
+        daemon=True
+    )
+    watcher.start()
+    try:
+        for step in (100, 200):
+            manager.save(model, optimizer, GradScaler('cpu', enabled=False), step, loss=1.0)
+            manager.wait()
+        deadline = time.time() + 300
+        records = []
+        while len(records) < 2 and time.time() < deadline:
+            time.sleep(0.5)
+            if os.path.exists(metrics_path):
+                with open(metrics_path) as f:
+                    records = [json.loads(line) for line in f]
+    finally:
+        watcher.terminate()
+        watcher.join()
+    assert sorted(r['step'] for r in records) == [100, 200], f"watcher recorded {records}"
+    print(f"Watcher (separate process): evaluated steps {[r['step'] for r in records]} | "
+          f"{records[0]['seconds']:.2f}s per checkpoint for {records[0]['tokens']} tokens")
+    
+    # A restarted watcher skips what its metrics file already has
+    watch_checkpoints(held_out_path, checkpoint_dir, metrics_path, window=128, max_windows=16, once=True, config=CONFIG)
+    with open(metrics_path) as f:
+        assert len(f.readlines()) == 2, "restarted watcher re-evaluated checkpoints"
+    print("Watcher restart: already-evaluated checkpoints skipped")
+
+def benchmark(num_docs=24):
+    tokenizer = AutoTokenizer.from_pretrained("tokenizer", local_files_only=True)
+    with tempfile.TemporaryDirectory() as tmp:
+        corpus = write_synthetic_corpus(os.path.join(tmp, "corpus.jsonl"), num_docs, seed=3)
+        held_out_path = build_held_out_set(os.path.join(tmp, "held_out.pt"), data_files=corpus, num_documents=num_docs)
+        docs = documents(held_out_path)
+        assert len(docs) == num_docs and all(doc[-1] == tokenizer.eos_token_id for doc in docs)
+        
+        torch.manual_seed(1337)
+        model = LlamaForCausalLM(CONFIG).eval()
+        check_windows(held_out_path, docs)
+        check_exactness(model, held_out_path, docs)
+        loop_costs(model, held_out_path, tokenizer)
+        check_watcher(held_out_path, tmp)
+    print("All evaluation checks passed")
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,207 @@
+"""
+Fused qkv_proj/gate_up_proj vs separate projections.
+
+Parity:
+- Logits and loss of a fused model loaded from separate-projection weights,
+  and gradients once the separate gradients are concatenated
+- Loading in the other direction (fused weights into a separate-projection model)
+- Compiled-model ("_orig_mod."-prefixed) training checkpoints, including the
+  AdamW state, and lightweight checkpoints through load_lightweight_model
+- An optimizer_8bit (AdamW8bit) checkpoint round-trips separate -> fused ->
+  separate, with its moments requantized in each layout
+- Quantized checkpoints written before fusion still load
+
+Latency: per-layer attention and MLP on CPU for a training shape (forward +
+backward) and a single-token decode shape (forward with a key/value cache).
+
+Run from the repository root:
+    python -m benchmarks.fused_projections
+"""
+import os
+import tempfile
+import time
+import torch
+from torch.amp import GradScaler
+from smollm2_135M import LlamaConfig, LlamaForCausalLM, LlamaAttention, LlamaMLP, RotaryEmbedding, FUSED_PROJECTIONS, create_model
+from adamw8bit import AdamW8bit
+from checkpoint_utils import load_checkpoint, load_lightweight_model, _training_state
+from quantization import quantize_model, save_quantized_checkpoint, load_quantized_checkpoint
+
+def fuse_names(tensors):
+    """A name -> tensor dict keyed by fused parameter names (separate projections concatenated)"""
+    tensors = dict(tensors)
+    for fused, parts in FUSED_PROJECTIONS.items():
+        for name in [n for n in tensors if f".{parts[0]}." in n]:
+            part_names = [name.replace(f".{parts[0]}.", f".{part}.") for part in parts]
+            tensors[name.replace(f".{parts[0]}.", f".{fused}.")] = torch.cat([tensors.pop(n) for n in part_names])
+    return tensors
+
+def fused_gradients(model):
+    """Gradients keyed by fused parameter names"""
+    return fuse_names({name: p.grad for name, p in model.named_parameters()})
+
+def check_parity(num_hidden_layers=2, batch_size=2, sequence_length=64):
+    torch.manual_seed(1337)
+    separate = LlamaForCausalLM(LlamaConfig(num_hidden_layers=num_hidden_layers, fused_projections=False))
+    fused = LlamaForCausalLM(LlamaConfig(num_hidden_layers=num_hidden_layers))
+    fused.load_state_dict(separate.state_dict())
+    x = torch.randint(0, separate.config.vocab_size, (batch_size, sequence_length))
+    
+    logits_separate, loss_separate = separate(x, labels=x)
+    logits_fused, loss_fused = fused(x, labels=x)
+    loss_separate.backward()
+    loss_fused.backward()
+    logit_diff = (logits_separate - logits_fused).abs().max().item()
+    expected = fused_gradients(separate)
+    grad_diff = max((p.grad - expected[name]).abs().max().item() for name, p in fused.named_parameters())
+    print(f"Separate -> fused: max logit difference {logit_diff:.2e} | max gradient difference {grad_diff:.2e}")
+    assert logit_diff < 1e-5 and grad_diff < 1e-6, "fused model differs from the separate projections"
+    
+    back = LlamaForCausalLM(LlamaConfig(num_hidden_layers=num_hidden_layers, fused_projections=False))
+    back.load_state_dict(fused.state_dict())
+    assert all(torch.equal(a, b) for a, b in zip(back.state_dict().values(), separate.state_dict().values()))
+    print("Fused -> separate: weights split back exactly")
+    return separate, fused, x
+
+def check_training_checkpoint(separate, fused, x, tmp):
+    """A compiled separate-projection training checkpoint resumes into a compiled fused model"""
+    optimizer = torch.optim.AdamW(separate.parameters(), lr=1e-3)
+    separate.zero_grad()
+    separate(x, labels=x)[1].backward()
+    optimizer.step()
+    scaler = GradScaler('cpu', enabled=False)
+    state = _training_state(separate, optimizer, scaler, step=1, loss=0.0)
+    state['model_state_dict'] = {f"_orig_mod.{k}": v for k, v in state['model_state_dict'].items()}
+    path = os.path.join(tmp, "model_latest.pt")
+    torch.save(state, path)
+    
+    compiled = torch.compile(fused)  # Loading does not trigger compilation
+    fused_optimizer = torch.optim.AdamW(compiled.parameters(), lr=1e-3)
+    load_checkpoint(compiled, fused_optimizer, scaler, checkpoint_path=path)
+    
+    # One more identical step in both layouts must give the same weights
+    for model, opt in ((separate, optimizer), (fused, fused_optimizer)):
+        model.zero_grad()
+        model(x, labels=x)[1].backward()
+        opt.step()
+    fused_from_separate = LlamaForCausalLM(fused.config)
+    fused_from_separate.load_state_dict(separate.state_dict())
+    diff = max((a - b).abs().max().item() for a, b in zip(fused_from_separate.state_dict().values(), fused.state_dict().values()))
+    print(f"Compiled training checkpoint (weights + AdamW state) resumed fused: max weight difference after a step {diff:.2e}")
+    assert diff < 1e-6, "optimizer state was not converted to the fused layout"
+
+def moments(optimizer, model):
+    """float32 AdamW8bit moments keyed by parameter name and moment"""
+    result = {}
+    for name, p in model.named_parameters():
+        state = optimizer.state[p]
+        for key, signed in (('exp_avg', True), ('exp_avg_sq', False)):
+            result[f"{name}.{key}"] = optimizer._load(state, key, p, signed) if f"{key}_codes" in state else state[key]
+    return result
+
+def check_8bit_training_checkpoint(separate, x, tmp):
+    """An optimizer_8bit checkpoint resumes across layouts, in both directions"""
+    scaler = GradScaler('cpu', enabled=False)
+    optimizer = AdamW8bit(separate.parameters(), lr=1e-3)
+    separate.zero_grad()
+    separate(x, labels=x)[1].backward()
+    optimizer.step()
+    path = os.path.join(tmp, "model_8bit.pt")
+    torch.save(_training_state(separate, optimizer, scaler, step=1, loss=0.0), path)
+    expected = moments(optimizer, separate)
+    
+    fused = LlamaForCausalLM(LlamaConfig(num_hidden_layers=separate.config.num_hidden_layers))
+    fused_optimizer = AdamW8bit(fused.parameters(), lr=1e-3)
+    load_checkpoint(fused, fused_optimizer, scaler, checkpoint_path=path)
+    qkv = fused_optimizer.state[fused.model.layers[0].self_attn.qkv_proj.weight]
+    assert 'exp_avg_codes' in qkv and qkv['exp_avg_codes'].dtype == torch.uint8, "fused moments were not requantized"
+    torch.save(_training_state(fused, fused_optimizer, scaler, step=1, loss=0.0), path)
+    
+    back = LlamaForCausalLM(separate.config)
+    back_optimizer = AdamW8bit(back.parameters(), lr=1e-3)
+    load_checkpoint(back, back_optimizer, scaler, checkpoint_path=path)
+    actual = moments(back_optimizer, back)
+    # Each requantization moves a value by up to half a codebook step of its block scale
+    error = max(((actual[k] - expected[k]).abs().max() / expected[k].abs().max()).item() for k in expected)
+    print(f"optimizer_8bit checkpoint separate -> fused -> separate: max moment error {error:.2%} of the tensor's absmax")
+    assert error < 0.1, "AdamW8bit moments were not converted between layouts"
+
+def check_lightweight_and_quantized(separate, x, tmp):
+    # load_lightweight_model builds the full-size model, so save a full-size separate one
+    full = create_model(config=LlamaConfig(fused_projections=False)).eval()
+    path = os.path.join(tmp, "model_lightweight.pt")
+    torch.save(full.state_dict(), path)
+    model = load_lightweight_model(path, device='cpu')
+    with torch.no_grad():
+        diff = (model(x[:, :16])[0] - full(x[:, :16])[0]).abs().max().item()
+    assert hasattr(model.model.layers[0].self_attn, "qkv_proj") and diff < 1e-4
+    print(f"Lightweight checkpoint with separate projections loads fused: max logit difference {diff:.2e}")
+    
+    quantized = quantize_model(separate, bits=8, use_kernels=False).eval()
+    q_path = os.path.join(tmp, "quantized.pt")
+    save_quantized_checkpoint(quantized, q_path)
+    checkpoint = torch.load(q_path, weights_only=True)
+    del checkpoint['config']['fused_projections']  # As written before fusion
+    torch.save(checkpoint, q_path)
+    loaded = load_quantized_checkpoint(q_path, use_kernels=False)
+    with torch.no_grad():
+        assert torch.equal(loaded(x)[0], quantized(x)[0])
+    print("Quantized checkpoint written before fusion loads with separate projections")
+
+def time_fn(fn, repeats, blocks=5):
+    """Best mean over several blocks of calls, in ms (less sensitive to noise on a shared CPU)"""
+    fn()
+    best = float("inf")
+    for _ in range(blocks):
+        t0 = time.perf_counter()
+        for _ in range(repeats):
+            fn()
+        best = min(best, (time.perf_counter() - t0) / repeats)
+    return best * 1000
+
+def layer_latency(config, train_shape=(4, 256), past_len=256, repeats=20):
+    torch.manual_seed(1337)
+    rotary = RotaryEmbedding(config.hidden_size // config.num_attention_heads, base=config.rope_theta)
+    B, T = train_shape
+    x_train = torch.randn(B, T, config.hidden_size, requires_grad=True)
+    x_decode = torch.randn(1, 1, config.hidden_size)
+    head_dim = config.hidden_size // config.num_attention_heads
+    cos, sin = rotary(x_train, seq_len=T)
+    train_pos = (cos.view(1, T, 1, head_dim), sin.view(1, T, 1, head_dim))
+    cos, sin = rotary(x_decode, seq_len=1, offset=past_len)
+    decode_pos = (cos.view(1, 1, 1, head_dim), sin.view(1, 1, 1, head_dim))
+    past = tuple(torch.randn(1, config.num_key_value_heads, past_len, head_dim) for _ in range(2))
+    
+    attn, mlp = LlamaAttention(config), LlamaMLP(config)
+    def train_attn():
+        attn(x_train, train_pos).sum().backward()
+    def train_mlp():
+        mlp(x_train).sum().backward()
+    @torch.no_grad()
+    def decode_attn():
+        attn(x_decode, decode_pos, past_key_value=past, use_cache=True)
+    @torch.no_grad()
+    def decode_mlp():
+        mlp(x_decode)
+    return {
+        'attention train': time_fn(train_attn, max(repeats // 10, 3)),
+        'attention decode': time_fn(decode_attn, repeats * 10),
+        'mlp train': time_fn(train_mlp, max(repeats // 10, 3)),
+        'mlp decode': time_fn(decode_mlp, repeats * 10),
+    }
+
+def benchmark():
+    with tempfile.TemporaryDirectory() as tmp:
+        separate, fused, x = check_parity()
+        check_training_checkpoint(separate, fused, x, tmp)
+        check_8bit_training_checkpoint(separate, x, tmp)
+        check_lightweight_and_quantized(separate, x, tmp)
+    
+    separate = layer_latency(LlamaConfig(fused_projections=False))
+    fused = layer_latency(LlamaConfig())
+    print("Per-layer CPU latency (train: batch 4 x 256, forward + backward; decode: 1 token, 256 cached):")
+    for name in separate:
+        print(f"{name:<17} separate {separate[name]:8.3f}ms | fused {fused[name]:8.3f}ms | {separate[name] / fused[name]:.2f}x")
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,72 @@
+"""
+Compare LlamaAttention's native grouped-query path with the previous
+repeat_interleave implementation: output parity, latency and peak memory on
+CPU across sequence lengths.
+
+Run from the repository root:
+    python -m benchmarks.gqa_attention
+"""
+import time
+import torch
+import torch.nn.functional as F
+from smollm2_135M import LlamaConfig, LlamaAttention, RotaryEmbedding, apply_rotary_pos_emb, SDPA_SUPPORTS_GQA
+from benchmarks.common import peak_cpu_memory
+
+def reference_attention(attn, x, position_embeddings):
+    """The previous implementation: k/v repeated to num_heads and the query pre-scaled"""
+    B, T, C = x.size()
+    q = attn.q_proj(x).view(B, T, attn.num_heads, attn.head_dim)
+    k = attn.k_proj(x).view(B, T, attn.num_kv_heads, attn.head_dim)
+    v = attn.v_proj(x).view(B, T, attn.num_kv_heads, attn.head_dim)
+    cos, sin = position_embeddings
+    q, k = apply_rotary_pos_emb(q, k, cos, sin)
+    k = k.repeat_interleave(attn.num_kv_groups, dim=2)
+    v = v.repeat_interleave(attn.num_kv_groups, dim=2)
+    q, k, v = q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2)
+    q = q * (attn.head_dim ** -0.5)
+    output = F.scaled_dot_product_attention(q, k, v, is_causal=True)
+    return attn.o_proj(output.transpose(1, 2).contiguous().view(B, T, C))
+
+def time_fn(fn, repeats=5):
+    fn()
+    t0 = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - t0) / repeats * 1000
+
+def benchmark(seq_lens=(128, 512, 1024, 2048), batch_size=1, backward=False):
+    torch.manual_seed(1337)
+    config = LlamaConfig(fused_rotary=False, fused_projections=False)
+    attn = LlamaAttention(config)
+    head_dim = attn.head_dim
+    rotary = RotaryEmbedding(head_dim, config.max_position_embeddings, config.rope_theta)
+    print(f"SDPA enable_gqa available: {SDPA_SUPPORTS_GQA} | {'forward + backward' if backward else 'forward (no grad)'}")
+    
+    for T in seq_lens:
+        x = torch.randn(batch_size, T, config.hidden_size, requires_grad=backward)
+        cos, sin = rotary(x, seq_len=T)
+        pos = (cos.view(1, T, 1, head_dim), sin.view(1, T, 1, head_dim))
+        
+        def run(fn):
+            if backward:
+                out = fn(attn, x, pos)
+                out.sum().backward()
+                return out.detach()
+            with torch.no_grad():
+                return fn(attn, x, pos)
+        
+        ref_fn = lambda: run(reference_attention)
+        new_fn = lambda: run(lambda a, *args: a(*args))
+        
+        ref_out, ref_peak = peak_cpu_memory(ref_fn)
+        new_out, new_peak = peak_cpu_memory(new_fn)
+        diff = (ref_out - new_out).abs().max().item()
+        assert diff < 1e-5, f"GQA output differs from the reference by {diff}"
+        
+        ref_ms, new_ms = time_fn(ref_fn), time_fn(new_fn)
+        print(f"T={T:5d} | repeat_interleave {ref_ms:8.2f}ms {ref_peak / 2**20:7.1f}MB | "
+              f"native GQA {new_ms:8.2f}ms {new_peak / 2**20:7.1f}MB | max diff {diff:.1e}")
+
+if __name__ == "__main__":
+    benchmark(backward=False)
+    benchmark(backward=True)
@@ -0,0 +1,49 @@
+"""
+Check that gradients accumulated over micro-batches match one large batch on CPU.
+
+Covers a GradScaler with a non-trivial scale and micro-batches with different
+numbers of labelled tokens (labels of -100 are ignored by the loss).
+
+Run from the repository root:
+    python -m benchmarks.grad_accumulation
+"""
+import torch
+from torch.amp import GradScaler
+from smollm2_135M import LlamaConfig, LlamaForCausalLM
+from train import accumulate_gradients
+
+def unscaled_gradients(model, scaler, micro_batches):
+    model.zero_grad(set_to_none=True)
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.0)
+    loss = accumulate_gradients(model, scaler, micro_batches, 'cpu', use_amp=False)
+    scaler.unscale_(optimizer)
+    grads = {name: p.grad.clone() for name, p in model.named_parameters() if p.grad is not None}
+    return loss.item(), grads
+
+def benchmark(batch_size=8, sequence_length=64, num_hidden_layers=2, accumulation_steps=4):
+    torch.manual_seed(1337)
+    model = LlamaForCausalLM(LlamaConfig(num_hidden_layers=num_hidden_layers))
+    model.train()
+    
+    x = torch.randint(0, model.config.vocab_size, (batch_size, sequence_length))
+    y = torch.randint(0, model.config.vocab_size, (batch_size, sequence_length))
+    # Unequal labelled-token counts per micro-batch
+    y[0, sequence_length // 2:] = -100
+    y[-1, :sequence_length // 4] = -100
+    
+    micro_size = batch_size // accumulation_steps
+    micro_batches = [(x[i:i + micro_size], y[i:i + micro_size]) for i in range(0, batch_size, micro_size)]
+    
+    full_loss, full_grads = unscaled_gradients(model, GradScaler('cpu', init_scale=2.0**10), [(x, y)])
+    accum_loss, accum_grads = unscaled_gradients(model, GradScaler('cpu', init_scale=2.0**10), micro_batches)
+    
+    max_diff = max((full_grads[name] - accum_grads[name]).abs().max().item() for name in full_grads)
+    max_grad = max(g.abs().max().item() for g in full_grads.values())
+    print(f"Batch {batch_size} vs {accumulation_steps} x {micro_size} | loss {full_loss:.6f} vs {accum_loss:.6f}")
+    print(f"Max gradient difference: {max_diff:.2e} (largest gradient {max_grad:.2e})")
+    assert abs(full_loss - accum_loss) < 1e-5, "accumulated loss differs from the full batch"
+    assert max_diff < 1e-6 * max(max_grad, 1.0), "accumulated gradients differ from the full batch"
+    print("Accumulated gradients match the single large batch")
+
+if __name__ == "__main__":
+    benchmark()
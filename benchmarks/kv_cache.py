@@ -0,0 +1,60 @@
+"""
+Compare greedy decoding with and without the key/value cache on CPU.
+
+Run from the repository root:
+    python -m benchmarks.kv_cache
+"""
+import time
+import torch
+from smollm2_135M import create_model
+from model_sampling import greedy_generate
+
+def check_logits(model, input_ids, max_new_tokens, atol=1e-4):
+    """Check that cached step-by-step logits match a full forward pass over the same tokens."""
+    with torch.no_grad():
+        ids = greedy_generate(model, input_ids, max_new_tokens, use_cache=True)
+        full_logits, _ = model(ids)
+        
+        prompt_len = input_ids.size(1)
+        cached_logits, _, past_key_values = model(ids[:, :prompt_len], use_cache=True)
+        steps = [cached_logits]
+        for t in range(prompt_len, ids.size(1)):
+            logits, _, past_key_values = model(ids[:, t:t + 1], past_key_values=past_key_values, use_cache=True)
+            steps.append(logits)
+        cached_logits = torch.cat(steps, dim=1)
+    
+    max_diff = (full_logits - cached_logits).abs().max().item()
+    print(f"Max logit difference (cached vs full): {max_diff:.2e}")
+    assert max_diff < atol, "cached logits diverge from the full forward pass"
+
+def time_generate(model, input_ids, max_new_tokens, use_cache, repeats=3):
+    best = float("inf")
+    for _ in range(repeats):
+        t0 = time.time()
+        ids = greedy_generate(model, input_ids, max_new_tokens, use_cache=use_cache)
+        best = min(best, time.time() - t0)
+    return ids, best
+
+def benchmark(batch_size=1, prompt_length=64, max_new_tokens=128, num_threads=None):
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    torch.manual_seed(1337)
+    
+    model = create_model()
+    model.eval()
+    input_ids = torch.randint(0, model.config.vocab_size, (batch_size, prompt_length))
+    
+    check_logits(model, input_ids, max_new_tokens=16)
+    
+    full_ids, full_time = time_generate(model, input_ids, max_new_tokens, use_cache=False)
+    cached_ids, cached_time = time_generate(model, input_ids, max_new_tokens, use_cache=True)
+    assert torch.equal(full_ids, cached_ids), "cached greedy output differs from the full path"
+    
+    new_tokens = batch_size * max_new_tokens
+    print(f"Prompt length: {prompt_length} | new tokens: {max_new_tokens} | batch: {batch_size}")
+    print(f"Full recompute: {full_time * 1000:.1f}ms | tok/sec: {new_tokens / full_time:.2f}")
+    print(f"KV cache:       {cached_time * 1000:.1f}ms | tok/sec: {new_tokens / cached_time:.2f}")
+    print(f"Speedup: {full_time / cached_time:.2f}x")
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,56 @@
+"""
+Compare batch throughput of the streaming CosmopediaDataLoader with the
+pre-tokenized MemmapDataLoader on a locally generated corpus.
+
+Run from the repository root:
+    python -m benchmarks.memmap_loader
+"""
+import os
+import tempfile
+import time
+from cosmopedia_dataloader import CosmopediaDataLoader
+from memmap_dataloader import MemmapDataLoader, pretokenize
+from benchmarks.common import write_synthetic_corpus
+
+def time_batches(loader, num_batches):
+    t0 = time.time()
+    for _ in range(num_batches):
+        x, y = loader.next_batch()
+    return time.time() - t0
+
+def benchmark(batch_size=16, sequence_length=800, num_batches=50, num_docs=4000):
+    with tempfile.TemporaryDirectory() as tmp:
+        corpus = write_synthetic_corpus(os.path.join(tmp, "corpus.jsonl"), num_docs)
+        
+        t0 = time.time()
+        pretokenize(
+            os.path.join(tmp, "shards"),
+            tokenizer_path="tokenizer",
+            dataset_name="json",
+            subset=None,
+            data_files=corpus,
+            shard_size=1_000_000
+        )
+        print(f"One-time pre-tokenization: {time.time() - t0:.2f}s")
+        
+        streaming = CosmopediaDataLoader(
+            batch_size,
+            sequence_length,
+            tokenizer_path="tokenizer",
+            dataset_name="json",
+            subset=None,
+            data_files=corpus
+        )
+        memmap = MemmapDataLoader(batch_size, sequence_length, os.path.join(tmp, "shards"), seed=0)
+        
+        streaming_time = time_batches(streaming, num_batches)
+        memmap_time = time_batches(memmap, num_batches)
+    
+    tokens = num_batches * batch_size * sequence_length
+    print(f"Batches: {num_batches} x {batch_size} x {sequence_length}")
+    print(f"Streaming: {streaming_time / num_batches * 1000:.2f}ms/batch | tok/sec: {tokens / streaming_time:.0f}")
+    print(f"Memmap:    {memmap_time / num_batches * 1000:.2f}ms/batch | tok/sec: {tokens / memmap_time:.0f}")
+    print(f"Speedup: {streaming_time / memmap_time:.1f}x")
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,62 @@
+"""
+A few train() steps on CPU reading pre-tokenized shards (data_path) instead
+of streaming and tokenizing the dataset.
+
+Checks that MemmapDataLoader provides what the training loop uses (stall
+time, stats, close, loader state in checkpoints) and reports the per-step
+metrics train() logs.
+
+Run from the repository root:
+    python -m benchmarks.memmap_training
+"""
+import json
+import math
+import os
+import tempfile
+import torch
+from memmap_dataloader import pretokenize
+from train import train
+from benchmarks.common import write_synthetic_corpus
+
+def benchmark(num_steps=4, batch_size=2, sequence_length=64, num_docs=200):
+    tokenizer_path = os.path.abspath("tokenizer")
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        corpus = write_synthetic_corpus(os.path.join(tmp, "corpus.jsonl"), num_docs)
+        shards = pretokenize(
+            os.path.join(tmp, "shards"),
+            tokenizer_path=tokenizer_path,
+            dataset_name="json",
+            subset=None,
+            data_files=corpus,
+            shard_size=50_000
+        )
+        # train() writes checkpoints/ and logs/ relative to the working directory
+        os.chdir(tmp)
+        try:
+            train(
+                batch_size=batch_size,
+                sequence_length=sequence_length,
+                num_steps=num_steps,
+                model_path=tokenizer_path,
+                data_path=os.path.join(tmp, "shards"),
+                checkpoint_frequency=num_steps - 1,
+                log_interval=1,
+                metrics_path=os.path.join(tmp, "metrics.jsonl"),
+            )
+            checkpoints = os.listdir("checkpoints")
+            checkpoint = torch.load(os.path.join("checkpoints", checkpoints[0]), weights_only=False)
+        finally:
+            os.chdir(cwd)
+        with open(os.path.join(tmp, "metrics.jsonl")) as f:
+            records = [json.loads(line) for line in f]
+    
+    assert len(records) == num_steps and all(math.isfinite(r['loss']) for r in records)
+    assert 'rng_state' in checkpoint['loader_state_dict'], "checkpoint lacks the memmap loader position"
+    print(f"Trained {num_steps} steps of {batch_size} x {sequence_length} from {len(shards)} shards")
+    for r in records:
+        print(f"  step {r['step']}: loss {r['loss']:.4f} | {r['step_time_ms']:.0f}ms | data wait {r['data_wait_ms']:.2f}ms")
+    print(f"Checkpoint {checkpoints[0]} holds the memmap loader position")
+
+if __name__ == "__main__":
+    benchmark()
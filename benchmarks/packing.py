@@ -0,0 +1,123 @@
+"""
+Useful tokens per batch and per second: padded sentence chunks vs packed documents.
+
+A position is useful when its target counts towards the loss (label != -100).
+Also checks that, with document masks, logits for a packed row match running
+each of its documents on its own, and that a packed loader resumes exactly.
+
+Run from the repository root:
+    python -m benchmarks.packing
+"""
+import os
+import tempfile
+import time
+import torch
+from torch.amp import GradScaler
+from smollm2_135M import LlamaConfig, LlamaForCausalLM, document_attention_inputs
+from cosmopedia_dataloader import CosmopediaDataLoader
+from train import accumulate_gradients
+from benchmarks.common import synthetic_documents, write_synthetic_corpus
+
+def make_loader(corpus, batch_size, sequence_length, packing):
+    return CosmopediaDataLoader(
+        batch_size=batch_size,
+        sequence_length=sequence_length,
+        tokenizer_path="tokenizer",
+        dataset_name="json",
+        subset=None,
+        data_files=corpus,
+        seed=1337,
+        packing=packing
+    )
+
+def train_throughput(model, loader, num_steps, eos_token_id=None):
+    """Useful tokens per second over num_steps training steps"""
+    optimizer = torch.optim.AdamW(model.parameters(), lr=3e-4)
+    scaler = GradScaler('cpu', enabled=False)
+    batches = [loader.next_batch() for _ in range(num_steps + 1)]
+    useful = 0
+    for i, (x, y) in enumerate(batches):
+        if i == 1:
+            t0 = time.perf_counter()  # The first step is warm-up
+        accumulate_gradients(model, scaler, [(x, y)], 'cpu', use_amp=False, eos_token_id=eos_token_id)
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+        if i >= 1:
+            useful += (y != -100).sum().item()
+    return useful / (time.perf_counter() - t0)
+
+def short_packed_rows(tokenizer, batch_size, sequence_length):
+    """Rows packed from short documents, so that every row holds several of them"""
+    eos = [tokenizer.eos_token_id]
+    stream = []
+    for text in synthetic_documents(batch_size * sequence_length // 16, seed=1, min_sentences=1, max_sentences=2):
+        stream += tokenizer(text, add_special_tokens=False)['input_ids'] + eos
+    return torch.tensor(stream[:batch_size * sequence_length]).view(batch_size, sequence_length)
+
+def check_document_masks(model, x, eos_token_id):
+    """Packed-row logits with document masks vs each document run separately"""
+    attention_mask, position_ids = document_attention_inputs(x, eos_token_id)
+    with torch.no_grad():
+        packed = model(x, attention_mask=attention_mask, position_ids=position_ids)[0]
+        max_diff = 0.0
+        for row in range(x.size(0)):
+            ends = (x[row] == eos_token_id).nonzero().flatten().tolist()
+            start = 0
+            for end in ends + [x.size(1) - 1]:
+                if end < start:
+                    continue
+                alone = model(x[row:row + 1, start:end + 1])[0]
+                max_diff = max(max_diff, (packed[row, start:end + 1] - alone[0]).abs().max().item())
+                start = end + 1
+    return max_diff
+
+def check_resume(corpus, batch_size, sequence_length):
+    loader = make_loader(corpus, batch_size, sequence_length, packing=True)
+    for _ in range(5):
+        loader.next_batch()
+    state = loader.state_dict()
+    expected = [loader.next_batch() for _ in range(20)]  # Spans at least one refill
+    
+    resumed = make_loader(corpus, batch_size, sequence_length, packing=True)
+    resumed.load_state_dict(state)
+    for (x, y), (rx, ry) in zip(expected, (resumed.next_batch() for _ in expected)):
+        assert torch.equal(x, rx) and torch.equal(y, ry), "packed loader did not resume exactly"
+
+def benchmark(batch_size=4, sequence_length=128, num_hidden_layers=2, num_steps=10, num_docs=200):
+    torch.manual_seed(1337)
+    with tempfile.TemporaryDirectory() as tmp:
+        corpus = write_synthetic_corpus(os.path.join(tmp, "corpus.jsonl"), num_docs)
+        padded = make_loader(corpus, batch_size, sequence_length, packing=False)
+        packed = make_loader(corpus, batch_size, sequence_length, packing=True)
+        eos_token_id = packed.tokenizer.eos_token_id
+        
+        model = LlamaForCausalLM(LlamaConfig(num_hidden_layers=num_hidden_layers))
+        model.train()
+        results = [
+            ("padded chunks", padded, train_throughput(model, padded, num_steps)),
+            ("packed", packed, train_throughput(model, packed, num_steps)),
+            ("packed + doc masks", packed, train_throughput(model, packed, num_steps, eos_token_id)),
+        ]
+        print(f"Batch {batch_size} x {sequence_length} | {num_hidden_layers} layers | {num_steps} steps")
+        for name, loader, tokens_per_sec in results:
+            stats = loader.get_stats()
+            print(f"{name:<20} useful tokens {stats['total_useful_token_fraction']:6.1%} | "
+                  f"useful tok/sec {tokens_per_sec:9.1f}")
+        
+        # Every labelled target is the next token of the stream
+        x, y = packed.next_batch()
+        labelled = y != -100
+        assert torch.equal(y[:, :-1][labelled[:, :-1]], x[:, 1:][labelled[:, :-1]])
+        assert not labelled[x == eos_token_id].any(), "targets after EOS are not masked"
+        
+        model.eval()
+        x = short_packed_rows(packed.tokenizer, batch_size, sequence_length)
+        max_diff = check_document_masks(model, x, eos_token_id)
+        print(f"Document-masked packed logits vs separate documents: max difference {max_diff:.2e}")
+        assert max_diff < 1e-4, "documents attend across packing boundaries"
+        
+        check_resume(corpus, batch_size, sequence_length)
+        print("Packed loader resumes exactly, including the partially packed tail")
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,90 @@
+"""
+Weight-only int8/int4 inference vs fp32: checkpoint size, agreement, perplexity and decode speed.
+
+Uses checkpoints/model_lightweight_10000.pt when it holds real weights, and a
+randomly initialized model otherwise (agreement is then much less meaningful).
+
+Run from the repository root:
+    python -m benchmarks.quantization
+"""
+import copy
+import os
+import tempfile
+import time
+import torch
+import torch.nn.functional as F
+from transformers import AutoTokenizer
+from smollm2_135M import create_model
+from model_sampling import greedy_generate
+from quantization import quantize_model, save_quantized_checkpoint
+from benchmarks.common import synthetic_documents
+
+def load_reference(checkpoint_path):
+    model = create_model()
+    try:
+        model.load_state_dict(torch.load(checkpoint_path, map_location='cpu'))
+        print(f"Reference: {checkpoint_path}")
+    except Exception as e:
+        print(f"Could not load {checkpoint_path} ({type(e).__name__}); using random weights")
+    return model.eval()
+
+def evaluate(model, reference_logits, windows):
+    """Perplexity on the windows and top-1 agreement with the fp32 logits"""
+    with torch.no_grad():
+        logits, _ = model(windows[:, :-1])
+    loss = F.cross_entropy(logits.reshape(-1, logits.size(-1)).float(), windows[:, 1:].reshape(-1))
+    agreement = (logits.argmax(-1) == reference_logits.argmax(-1)).float().mean().item()
+    return torch.exp(loss).item(), agreement
+
+def decode_speed(model, prompt, max_new_tokens, repeats=2):
+    greedy_generate(model, prompt, 4)
+    best = float("inf")
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        ids = greedy_generate(model, prompt, max_new_tokens)
+        best = min(best, time.perf_counter() - t0)
+    return ids, max_new_tokens * prompt.size(0) / best
+
+def checkpoint_size(model, tmp_dir, name):
+    path = os.path.join(tmp_dir, name)
+    if hasattr(model, 'quantization'):
+        save_quantized_checkpoint(model, path)
+    else:
+        torch.save(model.state_dict(), path)
+    return os.path.getsize(path) / (1024 * 1024)
+
+def benchmark(checkpoint_path="checkpoints/model_lightweight_10000.pt", num_windows=4, window_length=256,
+              prompt_length=64, max_new_tokens=64, num_threads=None):
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    torch.manual_seed(1337)
+    reference = load_reference(checkpoint_path)
+    
+    tokenizer = AutoTokenizer.from_pretrained("tokenizer", local_files_only=True)
+    tokens = tokenizer(" ".join(synthetic_documents(40)))['input_ids']
+    windows = torch.tensor(tokens[:num_windows * (window_length + 1)]).view(num_windows, window_length + 1)
+    with torch.no_grad():
+        reference_logits, _ = reference(windows[:, :-1])
+    prompt = windows[:1, :prompt_length]
+    
+    variants = {
+        'fp32': reference,
+        'int8': quantize_model(copy.deepcopy(reference), bits=8),
+        'int8-dequant': quantize_model(copy.deepcopy(reference), bits=8, use_kernels=False),
+        'int4-g64': quantize_model(copy.deepcopy(reference), bits=4, group_size=64),
+    }
+    
+    reference_ids = None
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, model in variants.items():
+            size = checkpoint_size(model, tmp_dir, f"{name}.pt")
+            ppl, agreement = evaluate(model, reference_logits, windows)
+            ids, tok_per_sec = decode_speed(model, prompt, max_new_tokens)
+            if reference_ids is None:
+                reference_ids = ids
+            same = (ids == reference_ids)[0, prompt_length:].float().mean().item()
+            print(f"{name:<13} size {size:7.1f}MB | ppl {ppl:9.2f} | top-1 agreement {agreement:6.1%} | "
+                  f"greedy tokens matching fp32 {same:6.1%} | decode {tok_per_sec:6.1f} tok/sec")
+
+if __name__ == "__main__":
+    benchmark()
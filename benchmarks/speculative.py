@@ -0,0 +1,80 @@
+"""
+Self-speculative greedy decoding (early-exit draft + full-depth verification) on CPU.
+
+- Output equivalence: speculative output equals plain greedy decoding for
+  several prompts, exit layers and draft lengths
+- Tokens/sec, acceptance rate and tokens per full-depth pass vs plain greedy
+
+Acceptance depends on how well the first layers predict the full model, which
+only a trained model shows. The lightweight checkpoint is used when it is
+available (not just its git-lfs pointer). Otherwise, two random-weights
+models are run: one as initialized, where early exits almost never agree,
+and one whose layers above the exit are damped, standing in for a model
+whose later layers mostly refine its prediction.
+
+Run from the repository root:
+    python -m benchmarks.speculative
+"""
+import time
+import torch
+from smollm2_135M import create_model
+from checkpoint_utils import load_lightweight_model
+from generation import generate, speculative_generate
+
+def damp_upper_layers(model, exit_layer, factor=0.05):
+    """Scale the residual contributions (o_proj, down_proj) of layers above exit_layer"""
+    with torch.no_grad():
+        for layer in model.model.layers[exit_layer:]:
+            layer.self_attn.o_proj.weight.mul_(factor)
+            layer.mlp.down_proj.weight.mul_(factor)
+    return model
+
+def check_equivalence(model, prompts, max_new_tokens, settings):
+    expected = [out[len(p):] for p, out in zip(prompts, generate(model, prompts, max_new_tokens=max_new_tokens))]
+    for exit_layer, draft_length in settings:
+        for prompt, reference in zip(prompts, expected):
+            output, _ = speculative_generate(
+                model, prompt, max_new_tokens=max_new_tokens, exit_layer=exit_layer, draft_length=draft_length
+            )
+            assert output == reference, f"speculative output differs (exit layer {exit_layer}, draft {draft_length})"
+
+def greedy_tokens_per_sec(model, prompt, max_new_tokens):
+    t0 = time.perf_counter()
+    output = generate(model, [prompt], max_new_tokens=max_new_tokens)[0]
+    return (len(output) - len(prompt)) / (time.perf_counter() - t0)
+
+def report(name, model, prompt, max_new_tokens, settings):
+    print(f"{name}:")
+    print(f"  plain greedy          {greedy_tokens_per_sec(model, prompt, max_new_tokens):6.2f} tok/s")
+    for exit_layer, draft_length in settings:
+        t0 = time.perf_counter()
+        output, stats = speculative_generate(
+            model, prompt, max_new_tokens=max_new_tokens, exit_layer=exit_layer, draft_length=draft_length
+        )
+        tokens_per_sec = len(output) / (time.perf_counter() - t0)
+        print(f"  exit {exit_layer:2d}, draft {draft_length}  {tokens_per_sec:6.2f} tok/s | acceptance {stats.acceptance_rate:6.1%} | "
+              f"{stats.tokens_per_full_pass:.2f} tokens per full pass")
+
+def benchmark(checkpoint_path="checkpoints/model_lightweight_10000.pt", max_new_tokens=48):
+    torch.manual_seed(1337)
+    prompts = [torch.randint(0, 49152, (n,)).tolist() for n in (8, 17, 30)]
+    settings = [(4, 3), (8, 4), (12, 6)]
+    
+    try:
+        model = load_lightweight_model(checkpoint_path, device='cpu')
+        models = [("Lightweight checkpoint", model)]
+    except Exception as e:
+        print(f"Could not load {checkpoint_path} ({type(e).__name__}); using random weights")
+        models = [
+            ("Random weights", create_model(device='cpu').eval()),
+            ("Random weights, layers 8+ damped", damp_upper_layers(create_model(device='cpu').eval(), exit_layer=8)),
+        ]
+    
+    for name, model in models:
+        check_equivalence(model, prompts, max_new_tokens=24, settings=settings)
+        print(f"{name}: speculative output matches greedy for {len(prompts)} prompts x {len(settings)} settings")
+    for name, model in models:
+        report(name, model, prompts[0], max_new_tokens, settings)
+
+if __name__ == "__main__":
+    benchmark()
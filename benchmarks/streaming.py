@@ -0,0 +1,90 @@
+"""
+Streaming generation: incremental detokenization and time to first token.
+
+- IncrementalDetokenizer, fed one token at a time, reproduces a full decode
+  exactly, including multi-byte characters split across byte-level tokens
+- Per-token cost of incremental decoding vs re-decoding the whole sequence
+- Time to first streamed token vs waiting for the whole continuation, through
+  a GenerationEngine serving from its background thread
+
+Run from the repository root:
+    python -m benchmarks.streaming
+"""
+import time
+import torch
+from transformers import AutoTokenizer
+from smollm2_135M import LlamaConfig, LlamaForCausalLM
+from generation import GenerationEngine, GenerationRequest, IncrementalDetokenizer, stream_text
+from benchmarks.common import synthetic_documents
+
+MULTIBYTE_TEXTS = [
+    "Café crème, naïve façade and jalapeño — résumé.",
+    "日本語のテキストと中文字符，混在した文章。",
+    "Emoji: 🚀🔥👍🏽 and flags 🇮🇳🇫🇷 mixed with text.",
+    "Ünïcödé ẞ Ω ∑ ∫ ≈ ≠ → ← ½ ¾ and math 𝔸𝔹ℂ.",
+]
+
+def check_detokenizer(tokenizer, texts, prompt_len=4):
+    """Stream each text token by token after a prompt and compare with a full decode"""
+    for text in texts:
+        ids = tokenizer(text, add_special_tokens=False)['input_ids']
+        prompt, generated = ids[:prompt_len], ids[prompt_len:]
+        detokenizer = IncrementalDetokenizer(tokenizer, prompt)
+        streamed = "".join(detokenizer.add([token]) for token in generated) + detokenizer.flush()
+        expected = tokenizer.decode(ids, skip_special_tokens=True)[len(tokenizer.decode(prompt, skip_special_tokens=True)):]
+        assert streamed == expected, f"streamed {streamed!r} != decoded {expected!r}"
+        assert "�" not in streamed, "a partial character was emitted"
+
+def decode_cost(tokenizer, ids):
+    """Seconds per token to stream ids incrementally vs re-decoding the full sequence each time"""
+    t0 = time.perf_counter()
+    detokenizer = IncrementalDetokenizer(tokenizer)
+    for token in ids:
+        detokenizer.add([token])
+    incremental = (time.perf_counter() - t0) / len(ids)
+    
+    t0 = time.perf_counter()
+    for i in range(1, len(ids) + 1):
+        tokenizer.decode(ids[:i], skip_special_tokens=True)
+    full = (time.perf_counter() - t0) / len(ids)
+    return incremental, full
+
+def benchmark(max_new_tokens=64, num_hidden_layers=6):
+    tokenizer = AutoTokenizer.from_pretrained("tokenizer", local_files_only=True)
+    texts = MULTIBYTE_TEXTS + synthetic_documents(20, min_sentences=1, max_sentences=5)
+    check_detokenizer(tokenizer, texts)
+    print(f"Incremental detokenization matches a full decode on {len(texts)} texts (incl. multi-byte)")
+    
+    for length in (64, 512):
+        ids = tokenizer(" ".join(synthetic_documents(3)), add_special_tokens=False)['input_ids'][:length]
+        incremental, full = decode_cost(tokenizer, ids)
+        print(f"{length:4d} tokens: incremental {incremental * 1e6:7.1f}us/token | full re-decode {full * 1e6:7.1f}us/token")
+    
+    torch.manual_seed(1337)
+    model = LlamaForCausalLM(LlamaConfig(num_hidden_layers=num_hidden_layers)).eval()
+    engine = GenerationEngine(model, pad_token_id=tokenizer.pad_token_id, seed=0).start()
+    try:
+        prompt_ids = tokenizer("The students learn algebra because", add_special_tokens=False)['input_ids']
+        # Warm-up
+        engine.submit(GenerationRequest(prompt_ids=prompt_ids, max_new_tokens=4)).wait()
+        
+        request = engine.submit(GenerationRequest(prompt_ids=prompt_ids, max_new_tokens=max_new_tokens))
+        t0 = time.perf_counter()
+        first_text = None
+        chunks = []
+        for text in stream_text(request, tokenizer):
+            if first_text is None:
+                first_text = time.perf_counter() - t0
+            chunks.append(text)
+        total = time.perf_counter() - t0
+        
+        full = tokenizer.decode(request.prompt_ids + request.output_ids, skip_special_tokens=True)
+        assert tokenizer.decode(request.prompt_ids, skip_special_tokens=True) + "".join(chunks) == full
+        print(f"{num_hidden_layers} layers, {len(request.output_ids)} tokens | first streamed text {first_text * 1000:.1f}ms "
+              f"(request TTFT {request.time_to_first_token * 1000:.1f}ms) vs full response {total * 1000:.1f}ms | "
+              f"{request.tokens_per_sec:.1f} tokens/sec")
+    finally:
+        engine.close()
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,74 @@
+"""
+Compare per-sentence tokenization with the batched, offset-based path of
+CosmopediaDataLoader using the bundled tokenizer and synthetic text.
+
+Run from the repository root:
+    python -m benchmarks.tokenization
+"""
+import os
+import random
+import tempfile
+import time
+import numpy as np
+from cosmopedia_dataloader import CosmopediaDataLoader
+from benchmarks.common import synthetic_documents, write_synthetic_corpus
+
+def per_sentence_row(tokenizer, text, sequence_length, rng):
+    """The loader's old path: one tokenizer call per sentence, one random chunk of the document"""
+    chunks, current = [], []
+    for sentence in text.split('.'):
+        if not sentence.strip():
+            continue
+        tokens = tokenizer(sentence.strip() + ".", truncation=False, padding=False)['input_ids']
+        if len(current) + len(tokens) > sequence_length and current:
+            chunks.append(current)
+            current = []
+        current = current + tokens
+    if current:
+        chunks.append(current)
+    if not chunks:
+        return []
+    chunk = rng.choice(chunks)[:sequence_length]
+    return chunk + [tokenizer.pad_token_id] * (sequence_length - len(chunk))
+
+def benchmark(num_docs=2000, sequence_length=800, tokenize_batch_size=64):
+    with tempfile.TemporaryDirectory() as tmp:
+        corpus = write_synthetic_corpus(os.path.join(tmp, "corpus.jsonl"), num_docs=64)
+        loader = CosmopediaDataLoader(
+            batch_size=1,
+            sequence_length=sequence_length,
+            tokenizer_path="tokenizer",
+            dataset_name="json",
+            subset=None,
+            data_files=corpus,
+            tokenize_batch_size=tokenize_batch_size
+        )
+    pad = loader.tokenizer.pad_token_id
+    texts = synthetic_documents(num_docs, seed=1)
+    
+    # Old path: one tokenizer call per sentence, one random chunk per document
+    rng = random.Random(1)
+    t0 = time.time()
+    old_rows = [per_sentence_row(loader.tokenizer, text, sequence_length, rng) for text in texts]
+    old_time = time.time() - t0
+    old_tokens = sum(int((np.asarray(row) != pad).sum()) for row in old_rows)
+    
+    # New path: one tokenizer call per batch, every chunk kept
+    t0 = time.time()
+    new_rows = np.concatenate([
+        loader._tokenize_batch(texts[i:i + tokenize_batch_size])
+        for i in range(0, len(texts), tokenize_batch_size)
+    ])
+    new_time = time.time() - t0
+    new_tokens = int((new_rows != pad).sum())
+    
+    print(f"Documents: {num_docs} | sequence length: {sequence_length}")
+    print(f"Per-sentence: {num_docs / old_time:.1f} docs/sec | {old_tokens / old_time:.0f} tok/sec | "
+          f"{len(old_rows)} rows, {old_tokens} useful tokens")
+    print(f"Batched:      {num_docs / new_time:.1f} docs/sec | {new_tokens / new_time:.0f} tok/sec | "
+          f"{len(new_rows)} rows, {new_tokens} useful tokens")
+    print(f"Speedup: {old_time / new_time:.2f}x | useful tokens per document: "
+          f"{old_tokens / num_docs:.1f} -> {new_tokens / num_docs:.1f}")
+
+if __name__ == "__main__":
+    benchmark()
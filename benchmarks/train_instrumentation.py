@@ -0,0 +1,90 @@
+"""
+Training-loop instrumentation on CPU: phase timers, profiler window and JSONL metrics.
+
+- Overhead of the phase timers (enabled vs disabled) on step time
+- Per-phase breakdown (h2d, forward, backward, optimizer) against the step time
+- model_flops_per_token counts every matmul weight of the model
+- A StepProfiler window writes a trace containing the phase ranges
+- MetricsLogger records read back as JSON
+
+Run from the repository root:
+    python -m benchmarks.train_instrumentation
+"""
+import json
+import os
+import tempfile
+import time
+import torch
+import torch.nn as nn
+from torch.amp import GradScaler
+from smollm2_135M import LlamaConfig, LlamaForCausalLM
+from train import accumulate_gradients
+from training_metrics import PhaseTimer, StepProfiler, MetricsLogger, model_flops_per_token
+
+def run(model, optimizer, batches, timer, profiler=None):
+    """Train on batches; returns the mean step time in seconds (first step excluded)"""
+    scaler = GradScaler('cpu', enabled=False)
+    for step, (x, y) in enumerate(batches):
+        if step == 1:
+            t0 = time.perf_counter()
+        if profiler is not None:
+            profiler.step_begin(step)
+        accumulate_gradients(model, scaler, [(x, y)], 'cpu', use_amp=False, timer=timer)
+        with timer.phase("optimizer"):
+            optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
+        if profiler is not None:
+            profiler.step_end(step)
+    return (time.perf_counter() - t0) / (len(batches) - 1)
+
+def benchmark(batch_size=4, sequence_length=128, num_hidden_layers=2, num_steps=10):
+    torch.manual_seed(1337)
+    config = LlamaConfig(num_hidden_layers=num_hidden_layers)
+    model = LlamaForCausalLM(config)
+    model.train()
+    optimizer = torch.optim.AdamW(model.parameters(), lr=3e-4)
+    batches = [
+        (torch.randint(0, config.vocab_size, (batch_size, sequence_length)),
+         torch.randint(0, config.vocab_size, (batch_size, sequence_length)))
+        for _ in range(num_steps + 1)
+    ]
+    
+    # The FLOP count covers exactly the weights used in matmuls (lm_head shares the embedding)
+    linear_params = sum(m.weight.numel() for m in model.modules() if isinstance(m, nn.Linear))
+    flops = model_flops_per_token(config, sequence_length)
+    attention_flops = 12 * num_hidden_layers * config.hidden_size * sequence_length
+    assert flops - attention_flops == 6 * linear_params, "FLOP count does not match the model's matmul weights"
+    print(f"FLOPs/token: {flops / 1e6:.1f}M (6 x {linear_params / 1e6:.1f}M matmul weights + attention)")
+    
+    disabled = run(model, optimizer, batches, PhaseTimer('cpu', enabled=False))
+    timer = PhaseTimer('cpu')
+    enabled = run(model, optimizer, batches, timer)
+    phases = {name: ms / (num_steps + 1) for name, ms in timer.collect().items()}
+    print(f"Step time: timers off {disabled * 1000:.2f}ms | timers on {enabled * 1000:.2f}ms "
+          f"({(enabled / disabled - 1) * 100:+.1f}%)")
+    print("Per-step phases: " + " | ".join(f"{name} {ms:.2f}ms" for name, ms in phases.items()) +
+          f" | sum {sum(phases.values()):.2f}ms")
+    print(f"Tokens/sec: {batch_size * sequence_length / enabled:.1f}")
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        profiler = StepProfiler(start_step=2, num_steps=2, output_dir=tmp, timer=timer)
+        run(model, optimizer, batches[:5], timer, profiler)
+        traces = os.listdir(tmp)
+        assert len(traces) == 1, f"expected one trace, found {traces}"
+        with open(os.path.join(tmp, traces[0])) as f:
+            names = {event.get('name') for event in json.load(f)['traceEvents']}
+        assert {"forward", "backward", "optimizer"} <= names, "phase ranges missing from the trace"
+        print(f"Profiler trace {traces[0]} has the forward/backward/optimizer ranges")
+        
+        path = os.path.join(tmp, "logs", "metrics.jsonl")
+        metrics = MetricsLogger(path)
+        for step in range(3):
+            metrics.log({'step': step, 'step_time_ms': enabled * 1000, 'phase_ms': phases})
+        metrics.close()
+        with open(path) as f:
+            records = [json.loads(line) for line in f]
+        assert [r['step'] for r in records] == [0, 1, 2]
+        print(f"Metrics: {len(records)} JSONL records written and read back")
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,108 @@
+"""
+Vocabulary-shortlist lm_head for greedy decoding on CPU.
+
+- A 4096-token shortlist built from token frequencies of a local corpus with
+  the bundled tokenizer, and the share of corpus tokens it covers
+- Agreement: greedy generate() with the shortlist equals full-vocabulary greedy
+  output, token for token
+- How often the exactness guard passes, rescores excluded tokens or falls back
+  to the full vocabulary, and decode tokens/sec with and without the shortlist
+- The lm_head projection alone, full vs shortlist, for one decoding row
+
+The guard only passes when no excluded token can reach the best shortlisted
+logit, which needs a trained model: tokens a model never predicts end up
+with small output embeddings. The lightweight checkpoint is used when it is
+available (not just its git-lfs pointer). Otherwise, two random-weights
+models are run: one as initialized, where the guard always falls back, and
+one with the excluded rows of the tied embedding shrunk, standing in for the
+weight decay those rows see in training.
+
+Run from the repository root:
+    python -m benchmarks.vocab_shortlist
+"""
+import os
+import tempfile
+import time
+import torch
+from transformers import AutoTokenizer
+from smollm2_135M import create_model
+from checkpoint_utils import load_lightweight_model
+from generation import generate
+from vocab_shortlist import VocabShortlist, build_shortlist, count_tokens
+from benchmarks.common import synthetic_documents, write_synthetic_corpus
+
+def shrink_excluded_rows(model, token_ids, factor=0.1):
+    """Scale the tied embedding rows of tokens outside the shortlist"""
+    with torch.no_grad():
+        excluded = torch.ones(model.config.vocab_size, dtype=torch.bool)
+        excluded[token_ids] = False
+        model.lm_head.weight[excluded] *= factor
+    return model
+
+def decode_tokens_per_sec(model, prompt, max_new_tokens, vocab_shortlist=None, repeats=3):
+    best = 0.0
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        output = generate(model, [prompt], max_new_tokens=max_new_tokens, vocab_shortlist=vocab_shortlist)[0]
+        best = max(best, (len(output) - len(prompt)) / (time.perf_counter() - t0))
+    return best
+
+def projection_ms(head, hidden_states, iters=200):
+    with torch.no_grad():
+        head(hidden_states)
+        t0 = time.perf_counter()
+        for _ in range(iters):
+            head(hidden_states)
+    return (time.perf_counter() - t0) / iters * 1000
+
+def report(name, model, token_ids, prompts, max_new_tokens):
+    shortlist = VocabShortlist.from_model(model, token_ids)
+    with torch.no_grad():
+        expected = generate(model, prompts, max_new_tokens=max_new_tokens)
+        shortlist.reset_stats()
+        actual = generate(model, prompts, max_new_tokens=max_new_tokens, vocab_shortlist=shortlist)
+    matching = sum(a == b for e, o in zip(expected, actual) for a, b in zip(e, o))
+    total = sum(len(e) for e in expected)
+    assert actual == expected, f"{name}: shortlist output differs from full-vocabulary greedy"
+    print(f"{name}:")
+    print(f"  agreement with full-vocabulary greedy: {matching}/{total} tokens over {len(prompts)} prompts")
+    print(f"  guard: {shortlist.full_fallbacks} of {shortlist.calls} calls fell back to the full vocabulary, "
+          f"{shortlist.rescored_tokens / shortlist.calls:.1f} excluded tokens rescored per call")
+    
+    shortlist.reset_stats()
+    full_rate = decode_tokens_per_sec(model, prompts[0], max_new_tokens)
+    shortlist_rate = decode_tokens_per_sec(model, prompts[0], max_new_tokens, shortlist)
+    print(f"  decode: {full_rate:.2f} tok/s full vocabulary, {shortlist_rate:.2f} tok/s shortlist "
+          f"({shortlist_rate / full_rate:.2f}x), {shortlist.full_fallbacks} fallbacks in {shortlist.calls} calls")
+    
+    with torch.no_grad():
+        hidden = model.model.norm(model.model.embed_tokens(torch.tensor([[prompts[0][-1]]])))
+    print(f"  lm_head projection, one row: {projection_ms(model.lm_head, hidden):.3f}ms full, "
+          f"{projection_ms(shortlist, hidden):.3f}ms shortlist")
+
+def benchmark(checkpoint_path="checkpoints/model_lightweight_10000.pt", shortlist_size=4096, max_new_tokens=48):
+    tokenizer = AutoTokenizer.from_pretrained("tokenizer", local_files_only=True)
+    with tempfile.TemporaryDirectory() as tmp:
+        corpus = write_synthetic_corpus(os.path.join(tmp, "corpus.jsonl"), 200)
+        counts = count_tokens(data_files=corpus)
+    token_ids = build_shortlist(counts, shortlist_size, always_include=tokenizer.all_special_ids)
+    coverage = counts[token_ids].sum().item() / counts.sum().item()
+    print(f"Shortlist: {len(token_ids)} of {len(counts)} tokens, covering {coverage:.1%} of {counts.sum().item()} corpus tokens")
+    
+    prompts = [
+        tokenizer(text[:80], add_special_tokens=False)['input_ids']
+        for text in synthetic_documents(3, seed=1)
+    ]
+    try:
+        models = [("Lightweight checkpoint", load_lightweight_model(checkpoint_path, device='cpu'))]
+    except Exception as e:
+        print(f"Could not load {checkpoint_path} ({type(e).__name__}); using random weights")
+        models = [
+            ("Random weights", create_model(device='cpu').eval()),
+            ("Random weights, excluded rows shrunk", shrink_excluded_rows(create_model(device='cpu').eval(), token_ids)),
+        ]
+    for name, model in models:
+        report(name, model, token_ids, prompts, max_new_tokens)
+
+if __name__ == "__main__":
+    benchmark()
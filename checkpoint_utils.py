@@ -1,11 +1,49 @@
+import glob
 import os
+import re
+import threading
+import time
 from pathlib import Path
 import torch
+from smollm2_135M import create_model, FUSED_PROJECTIONS
+from adamw8bit import CODEBOOKS, dequantize_blockwise
+from dist_utils import gather_objects, get_rank, get_world_size, is_main_process
 
-def save_checkpoint(model, optimizer, scaler, step, loss, save_dir="checkpoints"):
+def _atomic_save(obj, path):
+    """torch.save to a temp file, then rename over path, so a crash never leaves a partial checkpoint"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def _gather_loader_states(train_loader):
+    """Every rank's data loader position, in rank order (a collective call in distributed runs)"""
+    return gather_objects(train_loader.state_dict()) if train_loader is not None else None
+
+def _training_state(model, optimizer, scaler, step, loss, loader_states=None):
+    checkpoint = {
+        'step': step,
+        'model_state_dict': model.state_dict(),
+        'optimizer_state_dict': optimizer.state_dict(),
+        'scaler_state_dict': scaler.state_dict(),
+        'loss': loss,
+    }
+    if loader_states is not None:
+        if len(loader_states) == 1:
+            checkpoint['loader_state_dict'] = loader_states[0]
+        else:
+            checkpoint['loader_state_dicts'] = loader_states
+    return checkpoint
+
+def save_checkpoint(model, optimizer, scaler, step, loss, save_dir="checkpoints", train_loader=None):
     """
     Save model checkpoint, overwriting previous checkpoint.
     
+    In a distributed run every rank must call this (the data loader positions
+    are gathered); only rank 0 writes.
+    
     Args:
         model: The PyTorch model
         optimizer: The optimizer
@@ -13,27 +51,190 @@ def save_checkpoint(model, optimizer, scaler, step, loss, save_dir="checkpoints"
         step: Current training step
         loss: Current loss value
         save_dir: Directory to save checkpoints
+        train_loader: Optional data loader whose position is saved for resuming
     """
+    loader_states = _gather_loader_states(train_loader)
+    if not is_main_process():
+        return
+    
     # Create checkpoint directory if it doesn't exist
     Path(save_dir).mkdir(parents=True, exist_ok=True)
     
     # Single checkpoint name
     checkpoint_path = os.path.join(save_dir, "model_latest.pt")
     
-    # Prepare checkpoint dictionary
-    checkpoint = {
-        'step': step,
-        'model_state_dict': model.state_dict(),
-        'optimizer_state_dict': optimizer.state_dict(),
-        'scaler_state_dict': scaler.state_dict(),
-        'loss': loss,
-    }
-    
     # Save checkpoint
-    torch.save(checkpoint, checkpoint_path)
+    _atomic_save(_training_state(model, optimizer, scaler, step, loss, loader_states), checkpoint_path)
     print(f"\nCheckpoint saved at step {step}")
 
-def load_checkpoint(model, optimizer, scaler, checkpoint_path="checkpoints/model_latest_10000.pt"):
+class CheckpointManager:
+    """
+    Writes training checkpoints from a background thread.
+    
+    save() copies the model, optimizer and scaler state to CPU memory (pinned
+    and reused between saves when training on CUDA) and returns; a background
+    thread then writes it to a temp file and renames it to
+    model_step_XXXXXXXX.pt. Only the last keep_last checkpoints are kept.
+    Call wait() (or close()) before exiting so the last write completes.
+    
+    In a distributed run every rank calls save(); the data loader positions
+    of all ranks are gathered and only rank 0 snapshots and writes.
+    """
+    def __init__(self, save_dir="checkpoints", keep_last=3):
+        self.save_dir = save_dir
+        self.keep_last = keep_last
+        Path(save_dir).mkdir(parents=True, exist_ok=True)
+        self._pinned = {}
+        self._thread = None
+        self._error = None
+    
+    def _to_cpu(self, obj, key=()):
+        """Copy every tensor in a nested state dict to CPU memory the training loop will not touch"""
+        if isinstance(obj, torch.Tensor):
+            if obj.device.type != "cuda":
+                return obj.detach().clone()
+            buf = self._pinned.get(key)
+            if buf is None or buf.shape != obj.shape or buf.dtype != obj.dtype:
+                buf = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=True)
+                self._pinned[key] = buf
+            return buf.copy_(obj.detach(), non_blocking=True)
+        if isinstance(obj, dict):
+            return {k: self._to_cpu(v, key + (k,)) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self._to_cpu(v, key + (i,)) for i, v in enumerate(obj))
+        return obj
+    
+    def save(self, model, optimizer, scaler, step, loss, train_loader=None):
+        """
+        Snapshot the training state and write it in the background.
+        
+        Returns:
+            pause: Seconds the caller was blocked (waiting for the previous
+                write, plus the device-to-host copy)
+        """
+        t0 = time.perf_counter()
+        loader_states = _gather_loader_states(train_loader)
+        if not is_main_process():
+            return time.perf_counter() - t0
+        
+        # One write in flight at a time; this also frees the pinned buffers for reuse
+        self.wait()
+        snapshot = self._to_cpu(_training_state(model, optimizer, scaler, step, loss, loader_states))
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        
+        path = os.path.join(self.save_dir, f"model_step_{step:08d}.pt")
+        self._thread = threading.Thread(target=self._write, args=(snapshot, path), daemon=True)
+        self._thread.start()
+        return time.perf_counter() - t0
+    
+    def _write(self, snapshot, path):
+        try:
+            _atomic_save(snapshot, path)
+            for old in list_checkpoints(self.save_dir)[self.keep_last:]:
+                os.remove(old)
+            print(f"\nCheckpoint saved at step {snapshot['step']}: {path}")
+        except Exception as e:
+            self._error = e
+    
+    def wait(self):
+        """Block until the pending write (if any) has finished; re-raises its error"""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("Background checkpoint write failed") from error
+    
+    def close(self):
+        self.wait()
+
+def list_checkpoints(save_dir="checkpoints"):
+    """CheckpointManager checkpoints in save_dir, newest step first"""
+    paths = glob.glob(os.path.join(save_dir, "model_step_*.pt"))
+    steps = {path: int(re.search(r"model_step_(\d+)\.pt$", path).group(1)) for path in paths}
+    return sorted(paths, key=steps.get, reverse=True)
+
+def _split_projection_name(name):
+    """'...self_attn.q_proj.weight' -> ('...self_attn', 'q_proj', 'weight')"""
+    module, _, leaf = name.rpartition('.')
+    parent, _, proj = module.rpartition('.')
+    return parent, proj, leaf
+
+def _fused_name(proj):
+    """Fused projection that contains proj, or None"""
+    return next((fused for fused, parts in FUSED_PROJECTIONS.items() if proj in parts), None)
+
+def _other_layout_names(names):
+    """Parameter names, in registration order, of the same model with the other projection layout"""
+    other = []
+    for name in names:
+        parent, proj, leaf = _split_projection_name(name)
+        if proj in FUSED_PROJECTIONS:
+            other += [f"{parent}.{part}.{leaf}" for part in FUSED_PROJECTIONS[proj]]
+        elif _fused_name(proj) is None:
+            other.append(name)
+        elif FUSED_PROJECTIONS[_fused_name(proj)][0] == proj:
+            other.append(f"{parent}.{_fused_name(proj)}.{leaf}")
+    return other
+
+def _dequantize_moments(param_state, shape):
+    """
+    A parameter's AdamW8bit state with float32 moments of the given shape.
+    
+    The blockwise codes are flattened and padded to whole blocks, so they
+    cannot be concatenated or split by rows like the weights; AdamW8bit
+    quantizes float32 moments again when the state is loaded.
+    """
+    param_state = dict(param_state)
+    for name, codebook in (('exp_avg', 'signed'), ('exp_avg_sq', 'unsigned')):
+        if f"{name}_codes" in param_state:
+            codes = param_state.pop(f"{name}_codes")
+            absmax = param_state.pop(f"{name}_absmax")
+            param_state[name] = dequantize_blockwise(codes, absmax, CODEBOOKS[codebook], shape, codes.numel() // absmax.numel())
+    return param_state
+
+def convert_optimizer_state(optimizer_state, model):
+    """
+    Re-key an optimizer state dict saved with the other projection layout
+    (separate q/k/v and gate/up weights vs fused qkv_proj/gate_up_proj) to the
+    parameters of model, concatenating or splitting the per-parameter tensors
+    (e.g. AdamW moments) the same way as the weights. AdamW8bit moments of
+    converted parameters are dequantized first and come back as float32.
+    State that already matches, or that cannot be mapped, is returned unchanged.
+    """
+    names = [name for name, _ in model.named_parameters()]
+    groups = optimizer_state['param_groups']
+    if len(groups) != 1 or len(groups[0]['params']) == len(names):
+        return optimizer_state
+    saved_names = _other_layout_names(names)
+    if len(saved_names) != len(groups[0]['params']):
+        return optimizer_state
+    
+    saved = {name: optimizer_state['state'][i] for name, i in zip(saved_names, groups[0]['params']) if i in optimizer_state['state']}
+    params = dict(model.named_parameters())
+    state = {}
+    for index, name in enumerate(names):
+        parent, proj, leaf = _split_projection_name(name)
+        if name in saved:
+            state[index] = saved[name]
+        elif proj in FUSED_PROJECTIONS:
+            parts = [saved.get(f"{parent}.{part}.{leaf}") for part in FUSED_PROJECTIONS[proj]]
+            if all(part is not None for part in parts):
+                sizes = model.get_submodule(parent).projection_sizes
+                parts = [_dequantize_moments(part, (size, *params[name].shape[1:])) for part, size in zip(parts, sizes)]
+                # Scalars such as the step count are shared; tensors stack along the output dimension
+                state[index] = {key: torch.cat([part[key] for part in parts]) if torch.is_tensor(value) and value.dim() > 0 else value
+                                for key, value in parts[0].items()}
+        elif _fused_name(proj) is not None and f"{parent}.{_fused_name(proj)}.{leaf}" in saved:
+            parts = FUSED_PROJECTIONS[_fused_name(proj)]
+            sizes = [params[f"{parent}.{part}.{leaf}"].size(0) for part in parts]
+            fused_state = _dequantize_moments(saved[f"{parent}.{_fused_name(proj)}.{leaf}"], (sum(sizes), *params[name].shape[1:]))
+            state[index] = {key: value.split(sizes)[parts.index(proj)].clone() if torch.is_tensor(value) and value.dim() > 0 else value
+                            for key, value in fused_state.items()}
+    return {'state': state, 'param_groups': [{**groups[0], 'params': list(range(len(names)))}]}
+
+def load_checkpoint(model, optimizer, scaler, checkpoint_path=None, train_loader=None, save_dir="checkpoints"):
     """
     Load model checkpoint.
     
@@ -41,17 +242,50 @@ def load_checkpoint(model, optimizer, scaler, checkpoint_path="checkpoints/model
         model: The PyTorch model
         optimizer: The optimizer
         scaler: The gradient scaler
-        checkpoint_path: Path to checkpoint file
+        checkpoint_path: Path to checkpoint file; if None, the newest checkpoint
+            in save_dir that loads cleanly (falling back to model_latest.pt)
+        train_loader: Optional data loader to move to the saved data position
+            (this rank's position in a distributed run)
+        save_dir: Directory searched when checkpoint_path is None
     
     Returns:
         step: The training step from checkpoint
         loss: The loss value from checkpoint
     """
-    checkpoint = torch.load(checkpoint_path)
+    # Training checkpoints hold the data loader state (NumPy arrays), which
+    # the weights_only unpickler rejects; these files are our own
+    if checkpoint_path is not None:
+        checkpoint = torch.load(checkpoint_path, map_location='cpu', weights_only=False)
+    else:
+        candidates = list_checkpoints(save_dir) + [os.path.join(save_dir, "model_latest.pt")]
+        checkpoint = None
+        for path in candidates:
+            if not os.path.exists(path):
+                continue
+            try:
+                checkpoint = torch.load(path, map_location='cpu', weights_only=False)
+                print(f"Loading checkpoint {path}")
+                break
+            except Exception as e:
+                print(f"Skipping unreadable checkpoint {path}: {e}")
+        if checkpoint is None:
+            raise FileNotFoundError(f"No valid checkpoint found in {save_dir}")
     
+    # Either projection layout loads; the model converts its weights while loading
     model.load_state_dict(checkpoint['model_state_dict'])
-    optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+    optimizer.load_state_dict(convert_optimizer_state(checkpoint['optimizer_state_dict'], model))
     scaler.load_state_dict(checkpoint['scaler_state_dict'])
+    if train_loader is not None:
+        loader_states = checkpoint.get('loader_state_dicts')
+        if loader_states is None and 'loader_state_dict' in checkpoint:
+            loader_states = [checkpoint['loader_state_dict']]
+        if loader_states is not None and len(loader_states) == get_world_size():
+            train_loader.load_state_dict(loader_states[get_rank()])
+        elif loader_states is not None:
+            print(f"Checkpoint has data loader state for {len(loader_states)} ranks, not {get_world_size()}; "
+                  "data restarts from the beginning of the stream")
+        else:
+            print("Checkpoint has no data loader state; data restarts from the beginning of the stream")
     
     return checkpoint['step'], checkpoint['loss']
 
@@ -73,6 +307,11 @@ def save_lightweight_checkpoint(model, save_dir="checkpoints"):
     torch.save(model.state_dict(), checkpoint_path)
     print(f"\nLightweight checkpoint saved at: {checkpoint_path}")
 
+def strip_compile_prefix(state_dict):
+    """Remove the "_orig_mod." prefix torch.compile adds to state dict keys"""
+    return {key.replace('_orig_mod.', '', 1) if key.startswith('_orig_mod.') else key: value
+            for key, value in state_dict.items()}
+
 def load_lightweight_checkpoint(model, checkpoint_path="checkpoints/model_lightweight_10000.pt"):
     """
     Load only model weights from lightweight checkpoint.
@@ -84,7 +323,45 @@ def load_lightweight_checkpoint(model, checkpoint_path="checkpoints/model_lightw
     # Determine device
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
     
-    # Load state dict with appropriate device
-    state_dict = torch.load(checkpoint_path, map_location=device)
-    model.load_state_dict(state_dict)
-    return model.to(device) 
\ No newline at end of file
+    # Memory-map the file; tensors are copied straight from the page cache into the parameters
+    state_dict = torch.load(checkpoint_path, map_location='cpu', mmap=True, weights_only=True)
+    model.load_state_dict(strip_compile_prefix(state_dict))
+    return model.to(device)
+
+def model_from_state_dict(state_dict, config=None):
+    """
+    A model whose parameters are the tensors of state_dict, built on the meta
+    device so nothing is allocated or randomly initialized first. Memory-mapped
+    tensors stay memory-mapped.
+    """
+    model = create_model(device="meta", config=config)
+    model.load_state_dict(strip_compile_prefix(state_dict), assign=True)
+    
+    # assign=True gives lm_head and embed_tokens separate parameters; tie them again
+    if model.config.tie_word_embeddings:
+        model.lm_head.weight = model.model.embed_tokens.weight
+    return model
+
+def load_lightweight_model(checkpoint_path="checkpoints/model_lightweight_10000.pt", device=None):
+    """
+    Build the model from a lightweight checkpoint without initializing it first.
+    
+    The model is constructed on the meta device (no allocation, no random
+    init) and the memory-mapped checkpoint tensors become its parameters, so
+    on CPU the weights are paged in from the file on first use instead of
+    being read and copied up front. Checkpoints saved with separate q/k/v and
+    gate/up projections are fused while loading, which copies those weights;
+    re-running convert_checkpoint.py writes them fused.
+    
+    Args:
+        checkpoint_path: Path to lightweight checkpoint file
+        device: Target device (default: cuda if available, else cpu)
+    
+    Returns:
+        model: The loaded model in eval mode
+    """
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    
+    state_dict = torch.load(checkpoint_path, map_location='cpu', mmap=True, weights_only=True)
+    return model_from_state_dict(state_dict).to(device).eval() 
\ No newline at end of file
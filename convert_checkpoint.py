@@ -1,6 +1,6 @@
 import torch
 from smollm2_135M import create_model
-from checkpoint_utils import save_lightweight_checkpoint
+from checkpoint_utils import save_lightweight_checkpoint, strip_compile_prefix
 import os
 
 def convert_to_lightweight():
@@ -11,14 +11,7 @@ def convert_to_lightweight():
     checkpoint = torch.load("checkpoints/model_latest_10000.pt")
     
     # Get the model state dict and remove the "_orig_mod." prefix from keys
-    state_dict = checkpoint['model_state_dict']
-    fixed_state_dict = {}
-    for key, value in state_dict.items():
-        if key.startswith('_orig_mod.'):
-            new_key = key.replace('_orig_mod.', '')
-            fixed_state_dict[new_key] = value
-        else:
-            fixed_state_dict[key] = value
+    fixed_state_dict = strip_compile_prefix(checkpoint['model_state_dict'])
     
     # Load the fixed state dict
     model.load_state_dict(fixed_state_dict)
@@ -1,8 +1,15 @@
+import numpy as np
 import torch
 from datasets import load_dataset
+from datasets.distributed import split_dataset_by_node
 from transformers import AutoTokenizer
 from typing import Tuple, Iterator
-import random
+import bisect
+import copy
+import itertools
+import queue
+import threading
+import time
 
 class CosmopediaDataLoader:
     def __init__(
@@ -13,119 +20,352 @@ class CosmopediaDataLoader:
         dataset_name: str = "HuggingFaceTB/smollm-corpus",
         subset: str = "cosmopedia-v2",
         streaming: bool = True,
-        hf_token: str = None
+        hf_token: str = None,
+        prefetch_batches: int = 0,
+        tokenize_batch_size: int = 64,
+        data_files: str = None,
+        prefetch_factor: int = 5,
+        seed: int = None,
+        rank: int = 0,
+        world_size: int = 1,
+        packing: bool = False
     ):
+        """
+        Args:
+            prefetch_batches: Number of ready batches a background thread keeps
+                queued. 0 tokenizes inline inside next_batch().
+            tokenize_batch_size: Documents passed to the tokenizer per call
+            data_files: Local files for file-based datasets (e.g. dataset_name="json")
+            prefetch_factor: Batches worth of tokens to keep buffered
+            seed: Seed for the buffer shuffles (None = nondeterministic)
+            rank, world_size: Position in a data-parallel run; each rank reads a
+                disjoint part of the stream (whole shards when they divide evenly
+                across ranks, otherwise every world_size-th document)
+            packing: Concatenate whole documents, each followed by EOS, into full
+                rows instead of padding one sentence-aligned chunk per row
+        """
         self.batch_size = batch_size
         self.sequence_length = sequence_length
+        self.packing = packing
+        # Packed rows hold one extra token so the last input still has its target
+        self.row_length = sequence_length + 1 if packing else sequence_length
         
         # Load tokenizer
         self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_path, token=hf_token)
         
         # Load dataset
-        self.dataset = load_dataset(dataset_name, subset, streaming=streaming, token=hf_token)["train"]
-        self.data_iter = iter(self.dataset)
+        self.dataset = load_dataset(dataset_name, subset, data_files=data_files, streaming=streaming, token=hf_token)["train"]
+        if world_size > 1:
+            self.dataset = split_dataset_by_node(self.dataset, rank=rank, world_size=world_size)
+        self.rank = rank
+        self.world_size = world_size
+        self.stream = self.dataset  # Dataset object being iterated (a resumed copy after load_state_dict)
+        self.data_iter = iter(self.stream)
+        self.epoch = 0  # Completed passes over the stream
+        self.docs_consumed = 0  # Documents read from the stream in this pass
         
         # Buffer settings
-        self.token_buffer = []
-        self.prefetch_factor = 5  # Keep 5 batches worth of data
+        self.tokenize_batch_size = tokenize_batch_size
+        self.token_buffer = np.empty((0, self.row_length), dtype=np.int32)  # One row per sequence
+        self.buffer_pos = 0  # Next unread row of token_buffer
+        self.pack_tail = np.empty(0, dtype=np.int32)  # Packed tokens not yet filling a row
+        self.prefetch_factor = prefetch_factor  # Batches worth of data to keep
         self.min_buffer_size = batch_size * sequence_length * self.prefetch_factor
+        self.rng = np.random.default_rng(seed)
+        
+        # Background prefetch state
+        self.prefetch_batches = prefetch_batches
+        self.stall_time = 0.0  # Seconds next_batch() spent waiting on the queue
+        self.stall_count = 0
+        self.batches_served = 0
+        self.last_useful_fraction = 0.0  # Share of target positions that count towards the loss
+        self.useful_tokens = 0
+        self.total_tokens = 0
+        self._batch_queue = None
+        self._stop_event = threading.Event()
+        self._worker = None
         
         # Initial buffer fill
         self._fill_buffer()
+        
+        # Data position of the last batch returned by next_batch()
+        self._position = self._snapshot()
+        
+        if self.prefetch_batches > 0:
+            self._start_worker()
         print("Initialized Cosmopedia dataloader")
     
-    def _tokenize_text(self, example: dict) -> list:
-        """Tokenize text and extract random coherent chunks"""
-        text = example['text']
+    def _tokenize_batch(self, texts: list) -> np.ndarray:
+        """Tokenize many documents in one call and pack every chunk into sequence_length rows"""
+        if self.packing:
+            return self._pack_documents(texts)
+        encodings = self.tokenizer(
+            texts,
+            add_special_tokens=False,
+            truncation=False,
+            padding=False,
+            return_offsets_mapping=True,
+            return_attention_mask=False
+        )
+        
+        chunks = []
+        for text, tokens, offsets in zip(texts, encodings['input_ids'], encodings['offset_mapping']):
+            chunks.extend(self._chunk_sentences(tokens, self._sentence_ends(text, offsets)))
+        
+        rows = np.full((len(chunks), self.sequence_length), self.tokenizer.pad_token_id, dtype=np.int32)
+        for i, chunk in enumerate(chunks):
+            rows[i, :len(chunk)] = chunk
+        return rows
+    
+    def _pack_documents(self, texts: list) -> np.ndarray:
+        """
+        Concatenate documents, each terminated by EOS, and cut the stream into rows.
         
-        # Split into sentences (rough approximation)
-        sentences = text.split('.')
-        tokens_list = []
+        Rows are row_length (sequence_length + 1) tokens long and start every
+        sequence_length tokens, so consecutive rows share one token and every
+        token in the stream is a target exactly once. The remainder is kept in
+        pack_tail and continues in the next call.
+        """
+        encodings = self.tokenizer(
+            texts,
+            add_special_tokens=False,
+            truncation=False,
+            padding=False,
+            return_attention_mask=False
+        )
+        eos = [self.tokenizer.eos_token_id]
+        stream = np.fromiter(
+            itertools.chain(self.pack_tail, *(tokens + eos for tokens in encodings['input_ids'])),
+            dtype=np.int32
+        )
         
-        # Tokenize each sentence separately
-        for sentence in sentences:
-            if not sentence.strip():
-                continue
-            tokens = self.tokenizer(
-                sentence.strip() + ".",  # Add period back
-                truncation=False,
-                padding=False,
-                return_tensors=None
-            )['input_ids']
-            tokens_list.append(tokens)
-        
-        # Combine sentences into chunks of approximately sequence_length
+        num_rows = max(0, (len(stream) - 1) // self.sequence_length)
+        starts = np.arange(num_rows) * self.sequence_length
+        rows = stream[starts[:, None] + np.arange(self.row_length)]
+        self.pack_tail = stream[num_rows * self.sequence_length:]
+        return rows
+    
+    @staticmethod
+    def _sentence_ends(text: str, offsets: list) -> list:
+        """Token indices just past each token that contains a period"""
+        token_ends = [end for _, end in offsets]
+        ends = []
+        pos = text.find('.')
+        while pos != -1:
+            # First token whose character span covers the period
+            i = bisect.bisect_right(token_ends, pos)
+            if i < len(token_ends) and (not ends or ends[-1] != i + 1):
+                ends.append(i + 1)
+            pos = text.find('.', pos + 1)
+        return ends
+    
+    def _chunk_sentences(self, tokens: list, sentence_ends: list) -> list:
+        """Greedily group whole sentences into chunks of at most sequence_length tokens"""
         chunks = []
-        current_chunk = []
-        current_length = 0
-        
-        for tokens in tokens_list:
-            if current_length + len(tokens) > self.sequence_length:
-                if current_chunk:  # Save current chunk if it exists
-                    chunks.append(current_chunk)
-                current_chunk = tokens
-                current_length = len(tokens)
-            else:
-                current_chunk.extend(tokens)
-                current_length += len(tokens)
-        
-        if current_chunk:  # Don't forget the last chunk
-            chunks.append(current_chunk)
-        
-        # Return random chunk if we have any
-        if chunks:
-            # Randomly select a chunk
-            chunk = random.choice(chunks)
-            # Pad or truncate to exact sequence length
-            if len(chunk) > self.sequence_length:
-                return chunk[:self.sequence_length]
-            else:
-                return chunk + [self.tokenizer.pad_token_id] * (self.sequence_length - len(chunk))
-        return []
+        start = 0  # Start of the current chunk
+        last_end = 0  # End of the last sentence added to the current chunk
+        
+        for end in sentence_ends + [len(tokens)]:
+            if end - start > self.sequence_length:
+                if last_end > start:
+                    chunks.append(tokens[start:last_end])
+                    start = last_end
+                # A single sentence longer than a row is split rather than dropped
+                while end - start > self.sequence_length:
+                    chunks.append(tokens[start:start + self.sequence_length])
+                    start += self.sequence_length
+            last_end = end
+        
+        if last_end > start:
+            chunks.append(tokens[start:last_end])
+        return chunks
     
     def _fill_buffer(self) -> None:
         """Fill buffer with tokens"""
         print("Refilling buffer...")
-        current_size = len(self.token_buffer)
+        current_size = self._buffered_tokens()
+        parts = [self.token_buffer[self.buffer_pos:]]
+        new_tokens = 0
+        restarted = False
+        
+        while current_size + new_tokens < self.min_buffer_size:
+            texts = [example['text'] for example in itertools.islice(self.data_iter, self.tokenize_batch_size)]
+            if not texts:
+                # End of stream: start over from the beginning
+                if restarted:
+                    raise RuntimeError("Dataset produced no documents")
+                self.stream = self.dataset
+                self.data_iter = iter(self.stream)
+                self.epoch += 1
+                self.docs_consumed = 0
+                restarted = True
+                continue
+            restarted = False
+            self.docs_consumed += len(texts)
+            
+            rows = self._tokenize_batch(texts)
+            parts.append(rows)
+            new_tokens += rows.size
+        
+        # Shuffle at sequence boundaries by permuting rows. The buffer is rebuilt
+        # rather than overwritten so batches already handed out stay valid.
+        if new_tokens > 0:
+            rows = np.concatenate(parts)
+            self.token_buffer = rows[self.rng.permutation(len(rows))]
+            self.buffer_pos = 0
+        self._refill_state = self._stream_state()
         
+        print(f"Buffer refilled: {current_size} → {self._buffered_tokens()} tokens")
+    
+    def _buffered_tokens(self) -> int:
+        """Tokens left in the buffer that have not been served yet"""
+        return (len(self.token_buffer) - self.buffer_pos) * self.sequence_length
+    
+    def _stream_state(self) -> dict:
+        """Stream offset, RNG state and unpacked tail right after a refill"""
+        return {
+            'epoch': self.epoch,
+            'docs_consumed': self.docs_consumed,
+            'dataset_state': copy.deepcopy(self.stream.state_dict()) if hasattr(self.stream, 'state_dict') else None,
+            'rng_state': copy.deepcopy(self.rng.bit_generator.state),
+            'pack_tail': torch.from_numpy(self.pack_tail.copy()),
+        }
+    
+    def _snapshot(self) -> tuple:
+        """Cheap reference to the current data position (the buffer is never modified in place)"""
+        return self.token_buffer, self.buffer_pos, self._refill_state
+    
+    def state_dict(self) -> dict:
+        """
+        Data position after the last batch returned by next_batch().
+        
+        Holds the stream offset, the shuffle RNG state and the unread buffer rows,
+        so a restored loader continues with exactly the batches this one would
+        have produced next. Batches prefetched but not yet returned are excluded.
+        """
+        token_buffer, buffer_pos, refill_state = self._position
+        return {
+            'token_buffer': torch.from_numpy(token_buffer[buffer_pos:].copy()),
+            **copy.deepcopy(refill_state),
+        }
+    
+    def load_state_dict(self, state: dict) -> None:
+        """Restore a position from state_dict(), seeking the stream without re-tokenizing it"""
+        restart_worker = self._worker is not None
+        self.close()
+        
+        self.token_buffer = state['token_buffer'].numpy().astype(np.int32).reshape(-1, self.row_length)
+        self.buffer_pos = 0
+        self.pack_tail = state['pack_tail'].numpy().astype(np.int32) if 'pack_tail' in state else np.empty(0, dtype=np.int32)
+        self.rng.bit_generator.state = state['rng_state']
+        self.epoch = state['epoch']
+        self.docs_consumed = state['docs_consumed']
+        
+        if state['dataset_state'] is not None and hasattr(self.dataset, 'load_state_dict'):
+            # Streaming datasets resume from their shard/offset state directly. A copy is
+            # resumed so that the next pass over self.dataset still starts from the top.
+            self.stream = copy.deepcopy(self.dataset)
+            self.stream.load_state_dict(state['dataset_state'])
+            self.data_iter = iter(self.stream)
+        else:
+            self.stream = self.dataset
+            self.data_iter = itertools.islice(iter(self.stream), self.docs_consumed, None)
+        
+        self._refill_state = self._stream_state()
+        self._position = self._snapshot()
+        if restart_worker:
+            self._start_worker()
+    
+    def _start_worker(self) -> None:
+        self._batch_queue = queue.Queue(maxsize=self.prefetch_batches)
+        self._stop_event = threading.Event()
+        self._worker = threading.Thread(target=self._produce_batches, name="cosmopedia-prefetch", daemon=True)
+        self._worker.start()
+    
+    def _produce_batches(self) -> None:
+        """Background producer: build batches and block while the queue is full"""
         try:
-            while len(self.token_buffer) < self.min_buffer_size:
-                example = next(self.data_iter)
-                tokens = self._tokenize_text(example)
-                if tokens:
-                    self.token_buffer.extend(tokens)
-                
-                if torch.cuda.is_available() and random.random() < 0.1:
-                    torch.cuda.empty_cache()
-                    
-        except StopIteration:
-            self.data_iter = iter(self.dataset)
-            if len(self.token_buffer) == 0:
-                self._fill_buffer()
-        
-        # Shuffle at sequence boundaries
-        if len(self.token_buffer) > current_size:
-            sequences = [self.token_buffer[i:i + self.sequence_length] 
-                        for i in range(0, len(self.token_buffer), self.sequence_length)]
-            random.shuffle(sequences)
-            self.token_buffer = [token for seq in sequences for token in seq]
-        
-        print(f"Buffer refilled: {current_size} → {len(self.token_buffer)} tokens")
+            while not self._stop_event.is_set():
+                item = (self._build_batch(), self._snapshot())
+                while not self._stop_event.is_set():
+                    try:
+                        self._batch_queue.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+        except Exception as e:
+            # Hand the error to the consumer instead of dying silently
+            self._batch_queue.put(e)
     
     def next_batch(self) -> Tuple[torch.Tensor, torch.Tensor]:
         """Get next batch while maintaining sequence coherence"""
-        if len(self.token_buffer) < self.min_buffer_size // 2:
+        if self._worker is None:
+            batch = self._build_batch()
+            self._position = self._snapshot()
+        else:
+            if self._batch_queue.empty():
+                self.stall_count += 1
+            t0 = time.time()
+            item = self._batch_queue.get()
+            self.stall_time += time.time() - t0
+            if isinstance(item, Exception):
+                raise item
+            batch, self._position = item
+        self.batches_served += 1
+        
+        useful = (batch[1] != -100).sum().item()
+        self.last_useful_fraction = useful / batch[1].numel()
+        self.useful_tokens += useful
+        self.total_tokens += batch[1].numel()
+        return batch
+    
+    def get_stats(self) -> dict:
+        """Prefetch counters (queue depth, time spent waiting for data) and useful-token fractions"""
+        return {
+            'queue_depth': self._batch_queue.qsize() if self._batch_queue is not None else 0,
+            'prefetch_batches': self.prefetch_batches,
+            'stall_time_ms': self.stall_time * 1000,
+            'stall_count': self.stall_count,
+            'batches_served': self.batches_served,
+            'useful_token_fraction': self.last_useful_fraction,
+            'total_useful_token_fraction': self.useful_tokens / max(self.total_tokens, 1),
+        }
+    
+    def close(self) -> None:
+        """Stop the background producer and release queued batches"""
+        if self._worker is None:
+            return
+        self._stop_event.set()
+        # Drain so a producer blocked on put() can observe the stop event
+        while self._worker.is_alive():
+            try:
+                self._batch_queue.get_nowait()
+            except queue.Empty:
+                pass
+            self._worker.join(timeout=0.1)
+        self._worker = None
+    
+    def _build_batch(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Slice one batch off the token buffer, refilling it when low"""
+        if self._buffered_tokens() < self.min_buffer_size // 2:
             self._fill_buffer()
         
-        # Get complete sequences for this batch
-        tokens_needed = self.batch_size * self.sequence_length
-        tokens = self.token_buffer[:tokens_needed]
-        self.token_buffer = self.token_buffer[tokens_needed:]
+        # Get complete sequences for this batch as a view of the buffer
+        rows = self.token_buffer[self.buffer_pos:self.buffer_pos + self.batch_size]
+        self.buffer_pos += self.batch_size
         
-        # Create input and target tensors
-        x = torch.tensor(tokens).view(self.batch_size, self.sequence_length)
-        y = torch.roll(x, shifts=-1, dims=-1)
-        y[:, -1] = x[:, 0]  # Wrap around for last token
+        # Create input and target tensors (targets as int64 for cross-entropy).
+        # Positions labelled -100 are ignored by the loss.
+        if self.packing:
+            x = torch.from_numpy(np.ascontiguousarray(rows[:, :-1]))
+            y = torch.from_numpy(rows[:, 1:]).long()
+            # The token after an EOS starts an unrelated document
+            y[x == self.tokenizer.eos_token_id] = -100
+        else:
+            x = torch.from_numpy(rows)
+            y = torch.roll(x, shifts=-1, dims=-1).long()
+            y[:, -1] = -100  # No next token within the chunk
+            y[y == self.tokenizer.pad_token_id] = -100
         
         return x, y
     
@@ -137,13 +377,25 @@ def create_cosmopedia_loader(
     batch_size: int,
     sequence_length: int,
     tokenizer_path: str = 'HuggingFaceTB/SmolLM2-135M-Instruct',
-    hf_token: str = None
+    hf_token: str = None,
+    prefetch_batches: int = 0,
+    tokenize_batch_size: int = 64,
+    seed: int = None,
+    rank: int = 0,
+    world_size: int = 1,
+    packing: bool = False
 ) -> CosmopediaDataLoader:
     return CosmopediaDataLoader(
         batch_size=batch_size,
         sequence_length=sequence_length,
         tokenizer_path=tokenizer_path,
-        hf_token=hf_token
+        hf_token=hf_token,
+        prefetch_batches=prefetch_batches,
+        tokenize_batch_size=tokenize_batch_size,
+        seed=seed,
+        rank=rank,
+        world_size=world_size,
+        packing=packing
     )
 
 if __name__ == "__main__":
@@ -0,0 +1,75 @@
+import os
+import torch
+import torch.distributed as dist
+
+def setup_distributed(backend: str = None) -> tuple:
+    """
+    Join the process group when launched with torchrun (WORLD_SIZE > 1).
+    
+    Args:
+        backend: Process group backend; defaults to nccl with CUDA and gloo otherwise
+    
+    Returns:
+        rank, world_size, device
+    """
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    if world_size == 1:
+        return 0, 1, 'cuda' if torch.cuda.is_available() else 'cpu'
+    
+    if backend is None:
+        backend = "nccl" if torch.cuda.is_available() else "gloo"
+    dist.init_process_group(backend=backend)
+    rank = dist.get_rank()
+    if torch.cuda.is_available():
+        local_rank = int(os.environ.get("LOCAL_RANK", 0))
+        torch.cuda.set_device(local_rank)
+        device = f"cuda:{local_rank}"
+    else:
+        device = 'cpu'
+    return rank, world_size, device
+
+def cleanup_distributed() -> None:
+    if is_distributed():
+        dist.destroy_process_group()
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+def get_rank() -> int:
+    return dist.get_rank() if is_distributed() else 0
+
+def get_world_size() -> int:
+    return dist.get_world_size() if is_distributed() else 1
+
+def is_main_process() -> bool:
+    """True on rank 0, and always in single-process runs"""
+    return get_rank() == 0
+
+def _all_reduce(value: float, op) -> float:
+    if not is_distributed():
+        return value
+    t = torch.tensor(float(value), dtype=torch.float64)
+    if dist.get_backend() == "nccl":
+        t = t.cuda()
+    dist.all_reduce(t, op=op)
+    return t.item()
+
+def all_reduce_sum(value: float) -> float:
+    """Sum a Python number over all ranks (identity without a process group)"""
+    return _all_reduce(value, dist.ReduceOp.SUM)
+
+def all_reduce_min(value: float) -> float:
+    """Smallest value of a Python number over all ranks (identity without a process group)"""
+    return _all_reduce(value, dist.ReduceOp.MIN)
+
+def all_reduce_mean(value: float) -> float:
+    """Average a Python number over all ranks (gloo has no AVG reduction)"""
+    return all_reduce_sum(value) / get_world_size()
+
+def gather_objects(obj) -> list:
+    """Every rank's obj, in rank order, on every rank"""
+    if not is_distributed():
+        return [obj]
+    objects = [None] * get_world_size()
+    dist.all_gather_object(objects, obj)
+    return objects
@@ -0,0 +1,306 @@
+import argparse
+import glob
+import json
+import math
+import os
+import time
+import torch
+from torch.amp import autocast
+from datasets import load_dataset
+from transformers import AutoTokenizer
+from smollm2_135M import LlamaConfig
+from checkpoint_utils import model_from_state_dict
+from dist_utils import all_reduce_sum
+from training_metrics import MetricsLogger
+
+# Held-out set layout: a dict with these keys
+#   'format': EVAL_FORMAT, 'version': EVAL_VERSION,
+#   'tokens': int32 token ids of all documents, each followed by EOS,
+#   'offsets': int64 start of each document in tokens, plus the total length,
+#   'eos_token_id': int
+EVAL_FORMAT = "smollm2-held-out"
+EVAL_VERSION = 1
+
+def build_held_out_set(
+    output_path: str,
+    tokenizer_path: str = "tokenizer",
+    dataset_name: str = "json",
+    subset: str = None,
+    data_files: str = None,
+    hf_token: str = None,
+    num_documents: int = 500,
+    skip_documents: int = 0
+) -> str:
+    """
+    Tokenize a fixed set of documents once for evaluation.
+    
+    The documents must be ones training never reads, e.g. a local file or a
+    separate split; skip_documents drops the start of the stream first.
+    
+    Returns:
+        output_path
+    """
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_path, token=hf_token)
+    dataset = load_dataset(dataset_name, subset, data_files=data_files, streaming=True, token=hf_token)["train"]
+    eos = tokenizer.eos_token_id
+    
+    documents = []
+    for i, example in enumerate(dataset):
+        if i < skip_documents:
+            continue
+        if len(documents) == num_documents:
+            break
+        documents.append(tokenizer(example['text'], add_special_tokens=False)['input_ids'] + [eos])
+    
+    lengths = torch.tensor([len(ids) for ids in documents], dtype=torch.long)
+    offsets = torch.cat([torch.zeros(1, dtype=torch.long), lengths.cumsum(0)])
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    torch.save({
+        'format': EVAL_FORMAT,
+        'version': EVAL_VERSION,
+        'tokens': torch.tensor([t for ids in documents for t in ids], dtype=torch.int32),
+        'offsets': offsets,
+        'eos_token_id': eos,
+    }, output_path)
+    print(f"Saved {len(documents)} documents, {offsets[-1].item()} tokens to {output_path}")
+    return output_path
+
+def document_windows(tokens: torch.Tensor, window: int, stride: int):
+    """
+    Sliding windows over one document that score every token after the first exactly once.
+    
+    Each window holds up to window inputs; targets already scored by an
+    earlier window are labelled -100, so later windows keep window - stride
+    tokens of context.
+    
+    Yields:
+        (inputs, labels) of equal length <= window
+    """
+    begin, scored = 0, 1  # tokens[0] has nothing to be predicted from
+    while True:
+        end = min(begin + window + 1, len(tokens))
+        chunk = tokens[begin:end]
+        labels = chunk[1:].clone()
+        labels[:scored - begin - 1] = -100
+        yield chunk[:-1], labels
+        scored = end
+        if end == len(tokens):
+            return
+        begin += stride
+
+class HeldOutSet:
+    """
+    A held-out set from build_held_out_set, cut into fixed-length scoring windows.
+    
+    Windows are right-padded to window tokens (padding is labelled -100 and,
+    being causal, never seen by real tokens), so every batch has the same
+    shape and a compiled model is not recompiled.
+    """
+    def __init__(self, path: str, window: int = 800, stride: int = None, max_windows: int = None):
+        """
+        Args:
+            path: File written by build_held_out_set
+            window: Tokens per forward pass
+            stride: Start-to-start distance of windows within a long document
+                (default window // 2, so each scored token has at least half a window of context)
+            max_windows: Keep only the first max_windows windows (a fixed, cheaper subset)
+        """
+        data = torch.load(path, map_location='cpu', weights_only=True)
+        if data.get('format') != EVAL_FORMAT:
+            raise ValueError(f"{path} is not a held-out set written by build_held_out_set")
+        self.window = window
+        stride = stride or max(window // 2, 1)
+        tokens = data['tokens'].long()
+        offsets = data['offsets'].tolist()
+        
+        inputs, labels = [], []
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            if end - start < 2:
+                continue
+            for x, y in document_windows(tokens[start:end], window, stride):
+                inputs.append(torch.cat([x, x.new_full((window - len(x),), data['eos_token_id'])]))
+                labels.append(torch.cat([y, y.new_full((window - len(y),), -100)]))
+                if len(inputs) == max_windows:
+                    break
+            if len(inputs) == max_windows:
+                break
+        self.inputs = torch.stack(inputs)
+        self.labels = torch.stack(labels)
+        self.num_tokens = int((self.labels != -100).sum())
+    
+    def __len__(self) -> int:
+        return len(self.inputs)
+
+@torch.no_grad()
+def evaluate_perplexity(model, held_out: HeldOutSet, batch_size: int = 8, device='cpu', use_amp: bool = False,
+                        rank: int = 0, world_size: int = 1) -> dict:
+    """
+    Mean next-token loss and perplexity of model on a held-out set.
+    
+    In a distributed run every rank must call this with the unwrapped model:
+    each scores every world_size-th window and the sums are all-reduced.
+    
+    Args:
+        model: LlamaForCausalLM (compiled or not); restored to its previous train/eval mode
+        batch_size: Windows per forward pass; the last batch is padded to keep shapes fixed
+        use_amp: Autocast to the device's half precision (CUDA)
+    
+    Returns:
+        dict with loss, perplexity, tokens, seconds
+    """
+    t0 = time.perf_counter()
+    was_training = model.training
+    model.eval()
+    device_type = torch.device(device).type
+    inputs = held_out.inputs[rank::world_size]
+    labels = held_out.labels[rank::world_size]
+    
+    # Summed on the device; read once at the end
+    total_loss = torch.zeros((), dtype=torch.float64, device=device)
+    total_tokens = 0
+    for i in range(0, len(inputs), batch_size):
+        x = inputs[i:i + batch_size]
+        y = labels[i:i + batch_size]
+        if len(x) < batch_size:
+            x = torch.cat([x, x[:1].expand(batch_size - len(x), -1)])
+            y = torch.cat([y, y.new_full((batch_size - len(y), y.size(1)), -100)])
+        num_tokens = int((y != -100).sum())
+        if num_tokens == 0:
+            continue
+        x = x.to(device, non_blocking=True)
+        y = y.to(device, non_blocking=True)
+        with autocast(device_type=device_type, enabled=use_amp):
+            _, loss = model(x, labels=y, return_logits=False)
+        total_loss += loss.double() * num_tokens
+        total_tokens += num_tokens
+    
+    if was_training:
+        model.train()
+    total_loss = all_reduce_sum(total_loss.item())
+    total_tokens = all_reduce_sum(total_tokens)
+    loss = total_loss / max(total_tokens, 1)
+    return {
+        'loss': loss,
+        'perplexity': math.exp(loss),
+        'tokens': int(total_tokens),
+        'seconds': time.perf_counter() - t0,
+    }
+
+def evaluate_checkpoint(path: str, held_out: HeldOutSet, config: LlamaConfig = None, batch_size: int = 8) -> dict:
+    """Perplexity of the weights in a training or lightweight checkpoint, on CPU"""
+    # Memory-mapped, so the optimizer state of training checkpoints is never read,
+    # and the weights become the model's parameters without a random init or copy
+    checkpoint = torch.load(path, map_location='cpu', mmap=True, weights_only=False)
+    model = model_from_state_dict(checkpoint.get('model_state_dict', checkpoint), config=config)
+    result = evaluate_perplexity(model, held_out, batch_size=batch_size)
+    result['step'] = checkpoint.get('step')
+    return result
+
+def watch_checkpoints(
+    held_out_path: str,
+    checkpoint_dir: str = "checkpoints",
+    metrics_path: str = "logs/eval_metrics.jsonl",
+    window: int = 800,
+    max_windows: int = None,
+    batch_size: int = 8,
+    poll_interval: float = 60.0,
+    once: bool = False,
+    config: LlamaConfig = None,
+    num_threads: int = None
+) -> None:
+    """
+    Evaluate every new checkpoint in checkpoint_dir, off the training process.
+    
+    Polls for model_step_*.pt and model_latest.pt files (written atomically by
+    checkpoint_utils, so a file that exists is complete) and appends one
+    record per checkpoint to metrics_path. Checkpoints already recorded there
+    are skipped, so the watcher can be restarted.
+    
+    Args:
+        once: Evaluate what is there now and return instead of polling
+        config: Model config of the checkpoints (default: SmolLM2-135M)
+        num_threads: CPU threads for evaluation, to leave cores to the training data loader
+    """
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    held_out = HeldOutSet(held_out_path, window=window, max_windows=max_windows)
+    print(f"Held-out set: {len(held_out)} windows, {held_out.num_tokens} scored tokens")
+    
+    done = set()
+    if os.path.exists(metrics_path):
+        with open(metrics_path) as f:
+            done = {(r['checkpoint'], r['mtime']) for r in map(json.loads, f) if 'checkpoint' in r}
+    metrics = MetricsLogger(metrics_path)
+    try:
+        while True:
+            paths = glob.glob(os.path.join(checkpoint_dir, "model_step_*.pt"))
+            paths += glob.glob(os.path.join(checkpoint_dir, "model_latest.pt"))
+            for path in sorted(paths, key=os.path.getmtime):
+                try:
+                    key = (os.path.basename(path), os.path.getmtime(path))
+                    if key in done:
+                        continue
+                    result = evaluate_checkpoint(path, held_out, config=config, batch_size=batch_size)
+                except (FileNotFoundError, RuntimeError, EOFError) as e:
+                    # Removed by the checkpoint rotation while being read
+                    print(f"Skipping {path}: {e}")
+                    continue
+                done.add(key)
+                metrics.log({'checkpoint': key[0], 'mtime': key[1], **result})
+                print(f"{key[0]} (step {result['step']}): loss {result['loss']:.4f} | "
+                      f"perplexity {result['perplexity']:.2f} | {result['seconds']:.1f}s")
+            if once:
+                return
+            time.sleep(poll_interval)
+    finally:
+        metrics.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Held-out perplexity: build the token set, or evaluate checkpoints as they appear")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    
+    build = subparsers.add_parser("build", help="Tokenize held-out documents once")
+    build.add_argument("--output", default="data/held_out.pt")
+    build.add_argument("--tokenizer-path", default="tokenizer")
+    build.add_argument("--dataset-name", default="json")
+    build.add_argument("--subset", default=None)
+    build.add_argument("--data-files", default=None)
+    build.add_argument("--hf-token", default=None)
+    build.add_argument("--num-documents", type=int, default=500)
+    build.add_argument("--skip-documents", type=int, default=0)
+    
+    watch = subparsers.add_parser("watch", help="Evaluate each new checkpoint on CPU")
+    watch.add_argument("--held-out", default="data/held_out.pt")
+    watch.add_argument("--checkpoint-dir", default="checkpoints")
+    watch.add_argument("--metrics", default="logs/eval_metrics.jsonl")
+    watch.add_argument("--window", type=int, default=800)
+    watch.add_argument("--max-windows", type=int, default=None)
+    watch.add_argument("--batch-size", type=int, default=8)
+    watch.add_argument("--poll-interval", type=float, default=60.0)
+    watch.add_argument("--once", action="store_true")
+    watch.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+    
+    if args.command == "build":
+        build_held_out_set(
+            output_path=args.output,
+            tokenizer_path=args.tokenizer_path,
+            dataset_name=args.dataset_name,
+            subset=args.subset,
+            data_files=args.data_files,
+            hf_token=args.hf_token,
+            num_documents=args.num_documents,
+            skip_documents=args.skip_documents
+        )
+    else:
+        watch_checkpoints(
+            held_out_path=args.held_out,
+            checkpoint_dir=args.checkpoint_dir,
+            metrics_path=args.metrics,
+            window=args.window,
+            max_windows=args.max_windows,
+            batch_size=args.batch_size,
+            poll_interval=args.poll_interval,
+            once=args.once,
+            num_threads=args.threads
+        )
@@ -0,0 +1,626 @@
+import collections
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Iterator, List, Optional
+import torch
+
+@dataclass
+class GenerationRequest:
+    """A single prompt served by the GenerationEngine"""
+    prompt_ids: List[int]
+    max_new_tokens: int = 50
+    temperature: float = 0.0  # 0 = greedy
+    top_k: int = 0  # 0 = no top-k filtering
+    top_p: float = 1.0  # 1.0 = no nucleus filtering
+    eos_token_id: Optional[int] = None
+    output_ids: List[int] = field(default_factory=list)
+    submitted_at: float = field(default_factory=time.perf_counter)
+    first_token_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    error: Optional[Exception] = None  # Set when the engine failed this request
+    done: threading.Event = field(default_factory=threading.Event, repr=False)
+    updated: threading.Condition = field(default_factory=threading.Condition, repr=False)
+    
+    def wait(self, timeout: float = None) -> List[int]:
+        """
+        Block until the request has finished and return the generated token ids.
+        
+        Raises the engine's exception if the request failed.
+        """
+        self.done.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.output_ids
+    
+    def stream(self, timeout: float = None) -> Iterator[int]:
+        """
+        Yield generated token ids as the engine produces them, until the request finishes.
+        
+        The engine must be serving from its background thread (start()).
+        
+        Args:
+            timeout: Seconds to wait for each new token before raising TimeoutError
+        
+        Raises the engine's exception, after the tokens generated before it, if the request failed.
+        """
+        sent = 0
+        while True:
+            with self.updated:
+                if not self.updated.wait_for(lambda: len(self.output_ids) > sent or self.done.is_set(), timeout):
+                    raise TimeoutError("no token generated within the timeout")
+                new = self.output_ids[sent:]
+                finished = self.done.is_set()
+            yield from new
+            sent += len(new)
+            if finished:
+                if self.error is not None:
+                    raise self.error
+                return
+    
+    def _append(self, token: int, now: float) -> None:
+        with self.updated:
+            self.output_ids.append(token)
+            if self.first_token_at is None:
+                self.first_token_at = now
+            self.updated.notify_all()
+    
+    def _finish(self, now: float, error: Exception = None) -> None:
+        with self.updated:
+            self.finished_at = now
+            self.error = error
+            self.done.set()
+            self.updated.notify_all()
+    
+    @property
+    def time_to_first_token(self) -> Optional[float]:
+        """Seconds from submission to the first generated token"""
+        return None if self.first_token_at is None else self.first_token_at - self.submitted_at
+    
+    @property
+    def tokens_per_sec(self) -> Optional[float]:
+        """Decode rate after the first token (the prefill is covered by time_to_first_token)"""
+        if self.finished_at is None or len(self.output_ids) < 2 or self.finished_at <= self.first_token_at:
+            return None
+        return (len(self.output_ids) - 1) / (self.finished_at - self.first_token_at)
+
+class IncrementalDetokenizer:
+    """
+    Turns a growing list of token ids into text deltas without re-decoding the whole sequence.
+    
+    Only a short window ending at the new tokens is decoded each time. Text is
+    held back while it ends in an incomplete UTF-8 sequence (a byte-level token
+    that needs the next one to form a character), and the window starts a few
+    tokens back so merges and spacing that depend on the previous token come out
+    as they would in a full decode.
+    """
+    def __init__(self, tokenizer, prompt_ids: List[int] = (), context_tokens: int = 5, skip_special_tokens: bool = True):
+        """
+        Args:
+            tokenizer: Tokenizer whose decode() is used
+            prompt_ids: Tokens preceding the generated ones; their text is not emitted
+            context_tokens: Prompt tokens decoded along with the first generated ones
+        """
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.token_ids = list(prompt_ids)
+        self.read_offset = len(self.token_ids)  # Tokens before this have been emitted
+        self.prefix_offset = max(self.read_offset - context_tokens, 0)  # Start of the decode window
+    
+    def _decode(self, token_ids) -> str:
+        return self.tokenizer.decode(token_ids, skip_special_tokens=self.skip_special_tokens)
+    
+    def add(self, token_ids: List[int]) -> str:
+        """Append tokens and return the text they complete (possibly empty)"""
+        self.token_ids.extend(token_ids)
+        prefix_text = self._decode(self.token_ids[self.prefix_offset:self.read_offset])
+        text = self._decode(self.token_ids[self.prefix_offset:])
+        if len(text) > len(prefix_text) and not text.endswith("\ufffd"):
+            self.prefix_offset = self.read_offset
+            self.read_offset = len(self.token_ids)
+            return text[len(prefix_text):]
+        return ""
+    
+    def flush(self) -> str:
+        """Text still held back at the end of generation (e.g. a trailing partial character)"""
+        prefix_text = self._decode(self.token_ids[self.prefix_offset:self.read_offset])
+        text = self._decode(self.token_ids[self.prefix_offset:])
+        self.prefix_offset = self.read_offset = len(self.token_ids)
+        return text[len(prefix_text):]
+
+def sample_next_tokens(logits, temperature, top_k, top_p, generator=None):
+    """
+    Pick one token per row with per-row sampling settings.
+    
+    Args:
+        logits: Next-token logits [B, vocab]
+        temperature: [B] float tensor; rows <= 0 are decoded greedily
+        top_k: [B] long tensor; 0 keeps the whole vocabulary
+        top_p: [B] float tensor; 1.0 keeps the whole distribution
+        generator: Optional torch.Generator for reproducible sampling
+    
+    Returns:
+        next_tokens: [B] long tensor
+    """
+    greedy_tokens = logits.argmax(dim=-1)
+    greedy = temperature <= 0
+    if greedy.all():
+        return greedy_tokens
+    
+    logits = logits.float() / temperature.clamp_min(1e-5).unsqueeze(-1)
+    
+    # Sorting the vocabulary is only needed when some row filters it
+    if (top_k > 0).any() or (top_p < 1.0).any():
+        vocab_size = logits.size(-1)
+        sorted_logits, sorted_idx = logits.sort(dim=-1, descending=True)
+        ranks = torch.arange(vocab_size, device=logits.device)
+        k = torch.where(top_k > 0, top_k, vocab_size)
+        sorted_logits = sorted_logits.masked_fill(ranks >= k.unsqueeze(-1), float('-inf'))
+        
+        # Keep the smallest prefix whose probability mass reaches top_p (always at least one token)
+        probs = sorted_logits.softmax(dim=-1)
+        mass_before = probs.cumsum(dim=-1) - probs
+        sorted_logits = sorted_logits.masked_fill(mass_before >= top_p.unsqueeze(-1), float('-inf'))
+        logits = torch.full_like(logits, float('-inf')).scatter(-1, sorted_idx, sorted_logits)
+    
+    sampled = torch.multinomial(logits.softmax(dim=-1), 1, generator=generator).squeeze(-1)
+    return torch.where(greedy, greedy_tokens, sampled)
+
+def _left_pad(t, length, dim, value=0):
+    """Pad t on the left along dim up to length"""
+    pad = length - t.size(dim)
+    if pad == 0:
+        return t
+    shape = list(t.shape)
+    shape[dim] = pad
+    return torch.cat([t.new_full(shape, value), t], dim=dim)
+
+class GenerationEngine:
+    """
+    Continuous-batching generation for LlamaForCausalLM.
+    
+    Requests are prefilled together, left-padded to a common length, and then
+    decoded one token per step in a single batch. Finished requests leave the
+    batch immediately and waiting requests are admitted into the free slots,
+    so a long generation never holds up the ones queued behind it.
+    
+    A step that raises fails only the requests it was running (the prefill
+    group, or the decoding batch) with that exception; the engine keeps
+    serving the others.
+    
+    With a vocab_shortlist (vocab_shortlist.VocabShortlist), steps in which
+    every request is greedy project onto the shortlist instead of the whole
+    vocabulary; the output is unchanged.
+    """
+    def __init__(self, model, max_batch_size: int = 8, pad_token_id: int = 0, seed: int = None, vocab_shortlist=None):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.pad_token_id = pad_token_id
+        self.vocab_shortlist = vocab_shortlist
+        self.device = next(model.parameters()).device
+        self.vocab_size = model.config.vocab_size
+        self.generator = None
+        if seed is not None:
+            self.generator = torch.Generator(device=self.device)
+            self.generator.manual_seed(seed)
+        
+        self.waiting = collections.deque()
+        self.running = []  # Requests in batch-row order
+        self.past_key_values = None
+        self.attention_mask = None  # [B, S]: 1 for cached tokens, 0 for left padding
+        self.next_input = None  # [B, 1]: last sampled token of each row, not yet in the cache
+        
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stop = False
+        # Held for every forward pass on the model: engine steps and exclusive_stream()
+        self.model_lock = threading.Lock()
+    
+    def submit(self, request: GenerationRequest) -> GenerationRequest:
+        """
+        Queue a request; it is admitted at the next step with a free batch slot.
+        
+        Raises ValueError for an empty prompt or token ids outside the vocabulary.
+        """
+        if not request.prompt_ids:
+            raise ValueError("empty prompt")
+        if min(request.prompt_ids) < 0 or max(request.prompt_ids) >= self.vocab_size:
+            raise ValueError(f"prompt token ids must be in [0, {self.vocab_size})")
+        with self._cond:
+            self.waiting.append(request)
+            self._cond.notify()
+        return request
+    
+    def has_work(self) -> bool:
+        return bool(self.waiting or self.running)
+    
+    def _sampling_params(self, requests):
+        temperature = torch.tensor([r.temperature for r in requests], device=self.device)
+        top_k = torch.tensor([r.top_k for r in requests], device=self.device)
+        top_p = torch.tensor([r.top_p for r in requests], device=self.device)
+        return temperature, top_k, top_p
+    
+    def _shortlist(self, requests):
+        """The vocabulary shortlist when all requests decode greedily (its logits are only exact at the argmax)"""
+        if self.vocab_shortlist is not None and all(r.temperature <= 0 for r in requests):
+            return self.vocab_shortlist
+        return None
+    
+    def _record(self, requests, tokens):
+        """Append one token per request; returns the mask of rows that are still running"""
+        now = time.perf_counter()
+        keep = []
+        for request, token in zip(requests, tokens.tolist()):
+            request._append(token, now)
+            finished = token == request.eos_token_id or len(request.output_ids) >= request.max_new_tokens
+            if finished:
+                request._finish(now)
+            keep.append(not finished)
+        return keep
+    
+    def _admit(self):
+        """Prefill waiting requests into free batch slots"""
+        with self._cond:
+            new = []
+            while self.waiting and len(self.running) + len(new) < self.max_batch_size:
+                request = self.waiting.popleft()
+                if request.max_new_tokens <= 0:
+                    request._finish(time.perf_counter())
+                    continue
+                new.append(request)
+        if not new:
+            return
+        try:
+            self._prefill(new)
+        except Exception as error:
+            if len(new) == 1:
+                self._fail(new, error)
+                return
+            # Prefill one at a time so only the request that fails is dropped
+            for request in new:
+                try:
+                    self._prefill([request])
+                except Exception as error:
+                    self._fail([request], error)
+    
+    def _prefill(self, new):
+        """Run the prompts of new requests and merge them into the running batch"""
+        # Left-pad the prompts so every row ends at the last column
+        prompt_len = max(len(r.prompt_ids) for r in new)
+        input_ids = torch.full((len(new), prompt_len), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(new), prompt_len), dtype=torch.long)
+        for row, request in enumerate(new):
+            input_ids[row, prompt_len - len(request.prompt_ids):] = torch.tensor(request.prompt_ids)
+            attention_mask[row, prompt_len - len(request.prompt_ids):] = 1
+        input_ids = input_ids.to(self.device)
+        attention_mask = attention_mask.to(self.device)
+        
+        logits, _, past_key_values = self.model(
+            input_ids, attention_mask=attention_mask, use_cache=True, last_logits_only=True,
+            vocab_shortlist=self._shortlist(new)
+        )
+        new_tokens = sample_next_tokens(logits[:, -1, :], *self._sampling_params(new), generator=self.generator)
+        
+        # Merge with the running batch, left-padding whichever cache is shorter
+        next_tokens = new_tokens
+        if self.running:
+            length = max(self.attention_mask.size(1), attention_mask.size(1))
+            past_key_values = [
+                tuple(torch.cat([_left_pad(old, length, 2), _left_pad(cur, length, 2)]) for old, cur in zip(old_kv, new_kv))
+                for old_kv, new_kv in zip(self.past_key_values, past_key_values)
+            ]
+            attention_mask = torch.cat([_left_pad(self.attention_mask, length, 1), _left_pad(attention_mask, length, 1)])
+            next_tokens = torch.cat([self.next_input.squeeze(1), new_tokens])
+        
+        # Nothing above changes the engine or the requests, so a failed prefill can be retried
+        keep = [True] * len(self.running) + self._record(new, new_tokens)
+        self.running = self.running + new
+        self.past_key_values = past_key_values
+        self.attention_mask = attention_mask
+        self.next_input = next_tokens.unsqueeze(1)
+        self._evict(keep)
+    
+    def _evict(self, keep):
+        """Drop finished rows from the batch and trim padding columns no row needs"""
+        if all(keep):
+            return
+        rows = [i for i, k in enumerate(keep) if k]
+        self.running = [self.running[i] for i in rows]
+        if not rows:
+            self.past_key_values = self.attention_mask = self.next_input = None
+            return
+        
+        index = torch.tensor(rows, device=self.device)
+        start = int(self.attention_mask.index_select(0, index).any(dim=0).nonzero()[0])
+        self.attention_mask = self.attention_mask.index_select(0, index)[:, start:]
+        self.past_key_values = [
+            tuple(t.index_select(0, index)[:, :, start:] for t in layer_kv) for layer_kv in self.past_key_values
+        ]
+        self.next_input = self.next_input.index_select(0, index)
+    
+    def _fail(self, requests, error):
+        """Finish requests with error (re-raised by their wait() and stream())"""
+        now = time.perf_counter()
+        for request in requests:
+            if not request.done.is_set():
+                request._finish(now, error)
+    
+    def _decode(self):
+        """Generate one token for every running request"""
+        self.attention_mask = torch.cat([self.attention_mask, torch.ones_like(self.attention_mask[:, :1])], dim=1)
+        logits, _, self.past_key_values = self.model(
+            self.next_input, past_key_values=self.past_key_values, attention_mask=self.attention_mask, use_cache=True,
+            vocab_shortlist=self._shortlist(self.running)
+        )
+        next_tokens = sample_next_tokens(
+            logits[:, -1, :], *self._sampling_params(self.running), generator=self.generator
+        )
+        keep = self._record(self.running, next_tokens)
+        self.next_input = next_tokens.unsqueeze(1)
+        self._evict(keep)
+    
+    @torch.no_grad()
+    def step(self) -> None:
+        """Admit waiting requests, then decode one token for the whole batch"""
+        with self.model_lock:
+            self._admit()
+            if self.running:
+                try:
+                    self._decode()
+                except Exception as error:
+                    self._fail_batch(error)
+    
+    def _fail_batch(self, error):
+        """Fail every running request and drop the batch; its cache may be half-updated"""
+        self._fail(self.running, error)
+        self.running = []
+        self.past_key_values = self.attention_mask = self.next_input = None
+    
+    def exclusive_stream(self, tokens: Iterator[int]) -> Iterator[int]:
+        """
+        Run another generator on the engine's model (e.g. speculative_stream)
+        from a different thread, one token at a time between engine steps, so
+        the two never run the model concurrently.
+        """
+        while True:
+            with self.model_lock:
+                token = next(tokens, None)
+            if token is None:
+                return
+            yield token
+    
+    def run_until_complete(self) -> None:
+        """Step until every submitted request has finished (no background thread)"""
+        while self.has_work():
+            self.step()
+    
+    def start(self) -> "GenerationEngine":
+        """Serve requests from a background thread"""
+        if self._thread is None:
+            self._stop = False
+            self._thread = threading.Thread(target=self._serve, daemon=True)
+            self._thread.start()
+        return self
+    
+    def _serve(self):
+        while True:
+            with self._cond:
+                while not self.has_work() and not self._stop:
+                    self._cond.wait()
+                if self._stop:
+                    return
+            try:
+                self.step()
+            except Exception as error:
+                # step() fails the requests it can attribute an error to; anything
+                # else fails the batch, and the thread keeps serving new requests
+                with self.model_lock:
+                    self._fail_batch(error)
+    
+    def close(self) -> None:
+        """Stop the background thread; requests still queued are left unfinished"""
+        if self._thread is not None:
+            with self._cond:
+                self._stop = True
+                self._cond.notify()
+            self._thread.join()
+            self._thread = None
+
+def detokenize_stream(tokens: Iterator[int], tokenizer, prompt_ids: List[int] = ()) -> Iterator[str]:
+    """Yield the text of generated tokens as they arrive (the prompt is not included)"""
+    detokenizer = IncrementalDetokenizer(tokenizer, prompt_ids)
+    for token in tokens:
+        text = detokenizer.add([token])
+        if text:
+            yield text
+    text = detokenizer.flush()
+    if text:
+        yield text
+
+def stream_text(request: GenerationRequest, tokenizer) -> Iterator[str]:
+    """Yield the text of a request's generated tokens as the engine produces them"""
+    return detokenize_stream(request.stream(), tokenizer, request.prompt_ids)
+
+@dataclass
+class SpeculativeStats:
+    """Counters and timings of one speculative_stream() call"""
+    drafted: int = 0  # Tokens proposed by the early-exit draft
+    accepted: int = 0  # Drafted tokens the full model agreed with
+    generated: int = 0
+    full_passes: int = 0  # Full-depth forward passes (prefill included)
+    started_at: float = field(default_factory=time.perf_counter)
+    first_token_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    
+    @property
+    def acceptance_rate(self) -> Optional[float]:
+        return self.accepted / self.drafted if self.drafted else None
+    
+    @property
+    def tokens_per_full_pass(self) -> Optional[float]:
+        return self.generated / self.full_passes if self.full_passes else None
+    
+    @property
+    def time_to_first_token(self) -> Optional[float]:
+        return None if self.first_token_at is None else self.first_token_at - self.started_at
+    
+    @property
+    def tokens_per_sec(self) -> Optional[float]:
+        """Decode rate after the first token"""
+        if self.finished_at is None or self.generated < 2 or self.finished_at <= self.first_token_at:
+            return None
+        return (self.generated - 1) / (self.finished_at - self.first_token_at)
+
+@torch.no_grad()
+def speculative_stream(
+    model,
+    prompt_ids: List[int],
+    max_new_tokens: int = 50,
+    exit_layer: int = 6,
+    draft_length: int = 4,
+    eos_token_id: int = None,
+    stats: SpeculativeStats = None
+) -> Iterator[int]:
+    """
+    Greedy decoding of one prompt with self-speculation, yielding tokens as they are accepted.
+    
+    The first exit_layer decoder layers, followed by the shared norm and lm_head,
+    draft up to draft_length tokens one at a time. They reuse the full model's
+    cache for those layers, since a layer's keys/values do not depend on the
+    layers above it. One full-depth pass over the last token and the drafts then
+    gives the full model's own greedy choice at every drafted position: drafts
+    are kept while they agree, and the full model's token replaces the first
+    disagreement (or follows the last draft), so the output is the full
+    model's greedy output. Each full pass yields between 1 and draft_length + 1
+    tokens.
+    
+    Args:
+        model: LlamaForCausalLM
+        prompt_ids: Prompt token ids
+        exit_layer: Decoder layers used by the draft
+        draft_length: Tokens drafted per full-depth verification pass
+        stats: Optional SpeculativeStats updated while generating
+    """
+    stats = stats if stats is not None else SpeculativeStats()
+    device = next(model.parameters()).device
+    if max_new_tokens <= 0:
+        stats.finished_at = time.perf_counter()
+        return
+    
+    def emit(token):
+        stats.generated += 1
+        if stats.first_token_at is None:
+            stats.first_token_at = time.perf_counter()
+        return token == eos_token_id or stats.generated >= max_new_tokens
+    
+    logits, _, past_key_values = model(
+        torch.tensor([prompt_ids], device=device), use_cache=True, last_logits_only=True
+    )
+    stats.full_passes += 1
+    token = int(logits[0, -1].argmax())
+    
+    try:
+        while True:
+            done = emit(token)
+            yield token
+            if done:
+                return
+            
+            # Draft with the first exit_layer layers on top of the verified cache
+            num_drafts = min(draft_length, max_new_tokens - stats.generated - 1)
+            drafts = []
+            draft_past = past_key_values[:exit_layer]
+            draft_input = token
+            for _ in range(num_drafts):
+                logits, _, draft_past = model(
+                    torch.tensor([[draft_input]], device=device), past_key_values=draft_past, use_cache=True,
+                    num_layers=exit_layer
+                )
+                draft_input = int(logits[0, -1].argmax())
+                drafts.append(draft_input)
+                if draft_input == eos_token_id:
+                    break
+            stats.drafted += len(drafts)
+            
+            # Verify: the full model's next token after the last token and after each draft
+            logits, _, past_key_values = model(
+                torch.tensor([[token] + drafts], device=device), past_key_values=past_key_values, use_cache=True
+            )
+            stats.full_passes += 1
+            predicted = logits[0].argmax(dim=-1).tolist()
+            accepted = 0
+            while accepted < len(drafts) and drafts[accepted] == predicted[accepted]:
+                accepted += 1
+            stats.accepted += accepted
+            
+            # Forget the cache entries of rejected drafts
+            keep = past_key_values[0][0].size(2) - (len(drafts) - accepted)
+            past_key_values = [(k[:, :, :keep], v[:, :, :keep]) for k, v in past_key_values]
+            
+            for draft in drafts[:accepted]:
+                done = emit(draft)
+                yield draft
+                if done:
+                    return
+            token = predicted[accepted]
+    finally:
+        stats.finished_at = time.perf_counter()
+
+def speculative_generate(model, prompt_ids: List[int], **kwargs) -> tuple:
+    """
+    Run speculative_stream to completion.
+    
+    Returns:
+        output_ids: Generated token ids (the prompt is not included)
+        stats: SpeculativeStats with the acceptance rate and timings
+    """
+    stats = SpeculativeStats()
+    output_ids = list(speculative_stream(model, prompt_ids, stats=stats, **kwargs))
+    return output_ids, stats
+
+def generate(
+    model,
+    prompts: List[List[int]],
+    max_new_tokens: int = 50,
+    temperature: float = 0.0,
+    top_k: int = 0,
+    top_p: float = 1.0,
+    eos_token_id: int = None,
+    max_batch_size: int = 8,
+    pad_token_id: int = 0,
+    seed: int = None,
+    vocab_shortlist=None
+) -> List[List[int]]:
+    """
+    Generate continuations for prompts of different lengths.
+    
+    Args:
+        model: LlamaForCausalLM
+        prompts: Token ids of each prompt
+        max_new_tokens: Generation limit per prompt
+        temperature: Sampling temperature (0 = greedy)
+        top_k: Keep only the k most likely tokens (0 = off)
+        top_p: Nucleus sampling threshold (1.0 = off)
+        eos_token_id: Stop a prompt once it produces this token
+        max_batch_size: Prompts decoded together
+        vocab_shortlist: Optional VocabShortlist used for greedy steps
+    
+    Returns:
+        outputs: Prompt followed by its generated tokens, for each prompt
+    """
+    engine = GenerationEngine(
+        model, max_batch_size=max_batch_size, pad_token_id=pad_token_id, seed=seed, vocab_shortlist=vocab_shortlist
+    )
+    requests = [
+        engine.submit(GenerationRequest(
+            prompt_ids=list(prompt),
+            max_new_tokens=max_new_tokens,
+            temperature=temperature,
+            top_k=top_k,
+            top_p=top_p,
+            eos_token_id=eos_token_id
+        ))
+        for prompt in prompts
+    ]
+    engine.run_until_complete()
+    return [r.prompt_ids + r.output_ids for r in requests]
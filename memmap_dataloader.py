@@ -0,0 +1,262 @@
+import argparse
+import glob
+import os
+import time
+import numpy as np
+import torch
+from datasets import load_dataset
+from transformers import AutoTokenizer
+from typing import Tuple, Iterator
+
+# Shard layout: a header of HEADER_INTS int32 values followed by uint16 tokens.
+# Documents are stored back to back, each terminated by the EOS token.
+SHARD_MAGIC = 20250120
+SHARD_VERSION = 1
+HEADER_INTS = 256
+HEADER_BYTES = HEADER_INTS * 4
+
+def write_shard(path: str, tokens: np.ndarray, num_docs: int) -> None:
+    """
+    Write a token shard to disk.
+    
+    Args:
+        path: Output file path
+        tokens: 1-D array of token ids (must fit in uint16)
+        num_docs: Number of documents contained in the shard
+    """
+    header = np.zeros(HEADER_INTS, dtype=np.int32)
+    header[0] = SHARD_MAGIC
+    header[1] = SHARD_VERSION
+    header[2] = len(tokens)
+    header[3] = num_docs
+    
+    # Write to a temp file first so an interrupted run never leaves a truncated shard
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(header.tobytes())
+        f.write(tokens.astype(np.uint16, copy=False).tobytes())
+    os.replace(tmp_path, path)
+
+def read_shard_header(path: str) -> dict:
+    """Read and validate the header of a token shard"""
+    header = np.fromfile(path, dtype=np.int32, count=HEADER_INTS)
+    if len(header) < HEADER_INTS or header[0] != SHARD_MAGIC:
+        raise ValueError(f"{path} is not a token shard")
+    if header[1] != SHARD_VERSION:
+        raise ValueError(f"{path} has unsupported shard version {header[1]}")
+    return {'num_tokens': int(header[2]), 'num_docs': int(header[3])}
+
+def load_shard(path: str) -> np.memmap:
+    """Memory-map the tokens of a shard without reading them"""
+    header = read_shard_header(path)
+    return np.memmap(path, dtype=np.uint16, mode="r", offset=HEADER_BYTES, shape=(header['num_tokens'],))
+
+def pretokenize(
+    output_dir: str,
+    tokenizer_path: str = 'HuggingFaceTB/SmolLM2-135M-Instruct',
+    dataset_name: str = "HuggingFaceTB/smollm-corpus",
+    subset: str = "cosmopedia-v2",
+    data_files: str = None,
+    hf_token: str = None,
+    shard_size: int = 100_000_000,
+    max_tokens: int = None,
+    tokenize_batch_size: int = 256
+) -> list:
+    """
+    Tokenize a dataset once and write it as uint16 token shards.
+    
+    Args:
+        output_dir: Directory for the shard files
+        shard_size: Tokens per shard
+        max_tokens: Stop after roughly this many tokens (None = whole dataset)
+        tokenize_batch_size: Documents passed to the tokenizer per call
+    
+    Returns:
+        paths: The shard files written
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_path, token=hf_token)
+    if len(tokenizer) > np.iinfo(np.uint16).max + 1:
+        raise ValueError(f"Vocabulary of {len(tokenizer)} tokens does not fit in uint16")
+    eos = tokenizer.eos_token_id
+    
+    dataset = load_dataset(dataset_name, subset, data_files=data_files, streaming=True, token=hf_token)["train"]
+    
+    paths = []
+    shard = np.empty(shard_size, dtype=np.uint16)
+    fill = 0
+    shard_docs = 0  # Documents whose EOS lands in the current shard
+    
+    def flush():
+        nonlocal fill, shard_docs
+        path = os.path.join(output_dir, f"shard_{len(paths):06d}.bin")
+        write_shard(path, shard[:fill], shard_docs)
+        paths.append(path)
+        print(f"Wrote {path}: {fill} tokens, {shard_docs} documents")
+        fill = 0
+        shard_docs = 0
+    
+    def add_documents(texts):
+        """Tokenize a batch of documents and append them, EOS-terminated, to the shards"""
+        nonlocal fill, shard_docs
+        num_tokens = 0
+        for ids in tokenizer(texts, add_special_tokens=False)['input_ids']:
+            ids.append(eos)
+            num_tokens += len(ids)
+            start = 0
+            while start < len(ids):
+                n = min(len(ids) - start, shard_size - fill)
+                shard[fill:fill + n] = ids[start:start + n]
+                fill += n
+                start += n
+                if start == len(ids):
+                    shard_docs += 1
+                if fill == shard_size:
+                    flush()
+        return num_tokens
+    
+    total_tokens = 0
+    texts = []
+    for example in dataset:
+        texts.append(example['text'])
+        if len(texts) == tokenize_batch_size:
+            total_tokens += add_documents(texts)
+            texts = []
+            if max_tokens is not None and total_tokens >= max_tokens:
+                break
+    else:
+        # Tail of the stream that did not fill a tokenizer batch
+        if texts:
+            add_documents(texts)
+    
+    if fill > 0:
+        flush()
+    return paths
+
+class MemmapDataLoader:
+    """
+    Samples random windows from pre-tokenized shards; no tokenization at train time.
+    
+    Windows span document boundaries (documents are EOS-separated, as with
+    packing) and every position has a target. Exposes the same stall_time,
+    get_stats() and close() as CosmopediaDataLoader, so train() can use either.
+    """
+    def __init__(
+        self,
+        batch_size: int,
+        sequence_length: int,
+        data_dir: str,
+        seed: int = None,
+        rank: int = 0,
+        world_size: int = 1
+    ):
+        """
+        Args:
+            rank, world_size: Position in a data-parallel run. Shards are split
+                round-robin across ranks when there are enough of them; otherwise
+                every rank samples all shards with its own RNG stream.
+        """
+        self.batch_size = batch_size
+        self.sequence_length = sequence_length
+        self.stall_time = 0.0  # Seconds spent in next_batch() reading windows (there is no prefetch)
+        self.batches_served = 0
+        
+        paths = sorted(glob.glob(os.path.join(data_dir, "shard_*.bin")))
+        if not paths:
+            raise FileNotFoundError(f"No token shards found in {data_dir}")
+        if len(paths) >= world_size:
+            paths = paths[rank::world_size]
+        
+        # Only shards with room for at least one full window can be sampled
+        self.shards = [shard for shard in (load_shard(path) for path in paths) if len(shard) > sequence_length]
+        if not self.shards:
+            raise ValueError(f"No shard in {data_dir} holds more than {sequence_length} tokens")
+        
+        # Sample shards in proportion to the number of windows they hold
+        windows = np.array([len(shard) - sequence_length for shard in self.shards], dtype=np.float64)
+        self.shard_probs = windows / windows.sum()
+        self.rng = np.random.default_rng(seed if seed is None or world_size == 1 else [seed, rank])
+        print(f"Initialized memmap dataloader: {len(self.shards)} shards, {sum(len(s) for s in self.shards)} tokens")
+    
+    def next_batch(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Get a batch of random windows; targets are the inputs shifted by one token"""
+        t0 = time.time()
+        shard_ids = self.rng.choice(len(self.shards), size=self.batch_size, p=self.shard_probs)
+        
+        buf = np.empty((self.batch_size, self.sequence_length + 1), dtype=np.int32)
+        for row, shard_id in enumerate(shard_ids):
+            shard = self.shards[shard_id]
+            start = self.rng.integers(0, len(shard) - self.sequence_length)
+            buf[row] = shard[start:start + self.sequence_length + 1]
+        
+        x = torch.from_numpy(buf[:, :-1])
+        y = torch.from_numpy(buf[:, 1:]).long()
+        self.stall_time += time.time() - t0
+        self.batches_served += 1
+        return x, y
+    
+    def get_stats(self) -> dict:
+        """Same keys as CosmopediaDataLoader.get_stats(); reads are synchronous and every target is labelled"""
+        return {
+            'queue_depth': 0,
+            'prefetch_batches': 0,
+            'stall_time_ms': self.stall_time * 1000,
+            'stall_count': self.batches_served,
+            'batches_served': self.batches_served,
+            'useful_token_fraction': 1.0,
+            'total_useful_token_fraction': 1.0,
+        }
+    
+    def close(self) -> None:
+        """Nothing to stop: there is no background producer"""
+    
+    def state_dict(self) -> dict:
+        """Sampler position; windows are drawn from the RNG alone"""
+        return {'rng_state': self.rng.bit_generator.state}
+    
+    def load_state_dict(self, state: dict) -> None:
+        self.rng.bit_generator.state = state['rng_state']
+    
+    def __iter__(self) -> Iterator[Tuple[torch.Tensor, torch.Tensor]]:
+        while True:
+            yield self.next_batch()
+
+def create_memmap_loader(
+    batch_size: int,
+    sequence_length: int,
+    data_dir: str = "data/cosmopedia",
+    seed: int = None,
+    rank: int = 0,
+    world_size: int = 1
+) -> MemmapDataLoader:
+    return MemmapDataLoader(
+        batch_size=batch_size,
+        sequence_length=sequence_length,
+        data_dir=data_dir,
+        seed=seed,
+        rank=rank,
+        world_size=world_size
+    )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-tokenize a dataset into uint16 token shards")
+    parser.add_argument("--output-dir", default="data/cosmopedia")
+    parser.add_argument("--tokenizer-path", default="HuggingFaceTB/SmolLM2-135M-Instruct")
+    parser.add_argument("--dataset-name", default="HuggingFaceTB/smollm-corpus")
+    parser.add_argument("--subset", default="cosmopedia-v2")
+    parser.add_argument("--data-files", default=None)
+    parser.add_argument("--hf-token", default=None)
+    parser.add_argument("--shard-size", type=int, default=100_000_000)
+    parser.add_argument("--max-tokens", type=int, default=None)
+    args = parser.parse_args()
+    
+    pretokenize(
+        output_dir=args.output_dir,
+        tokenizer_path=args.tokenizer_path,
+        dataset_name=args.dataset_name,
+        subset=args.subset,
+        data_files=args.data_files,
+        hf_token=args.hf_token,
+        shard_size=args.shard_size,
+        max_tokens=args.max_tokens
+    )
@@ -1,12 +1,13 @@
 from transformers import AutoTokenizer
 import torch
+from dist_utils import is_main_process
 
 def decode_tokens(tokenizer, tokens):
     return tokenizer.decode(tokens, skip_special_tokens=True)
 
 def sample_model_output(model, x, tokenizer, max_preview_length=200):
     """
-    Generate and display a sample output from the model.
+    Generate and display a sample output from the model (rank 0 only in distributed runs).
     
     Args:
         model: The language model
@@ -14,6 +15,9 @@ def sample_model_output(model, x, tokenizer, max_preview_length=200):
         tokenizer: HuggingFace tokenizer
         max_preview_length: Number of characters to show in preview
     """
+    if not is_main_process():
+        return
+    
     print("\n=== Sample Output ===")
     
     # Take the first sequence from the batch
@@ -31,6 +35,39 @@ def sample_model_output(model, x, tokenizer, max_preview_length=200):
     print(pred_text[:max_preview_length] + "...")
     print("\n==================\n")
 
+def greedy_generate(model, input_ids, max_new_tokens=50, use_cache=True):
+    """
+    Greedily extend a batch of prompts one token at a time.
+    
+    Args:
+        model: The language model
+        input_ids: Prompt token ids [B, T]
+        max_new_tokens: Number of tokens to append
+        use_cache: Decode incrementally with the key/value cache instead of
+            re-running the whole sequence for every token
+    
+    Returns:
+        input_ids: Prompt followed by the generated tokens [B, T + max_new_tokens]
+    """
+    past_key_values = None
+    next_input = input_ids
+    
+    with torch.no_grad():
+        for _ in range(max_new_tokens):
+            if use_cache:
+                logits, _, past_key_values = model(next_input, past_key_values=past_key_values, use_cache=True)
+            else:
+                logits, _ = model(input_ids)
+            
+            # Get the next token (most likely)
+            next_token = torch.argmax(logits[:, -1, :], dim=-1, keepdim=True)
+            
+            # Add the new token to our sequence
+            input_ids = torch.cat([input_ids, next_token], dim=1)
+            next_input = next_token
+    
+    return input_ids
+
 def initialize_tokenizer(model_path, hf_token=None):
     """Initialize and return the tokenizer."""
     return AutoTokenizer.from_pretrained(model_path, token=hf_token)
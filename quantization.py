@@ -0,0 +1,234 @@
+import argparse
+import os
+import warnings
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from smollm2_135M import LlamaConfig, LlamaForCausalLM, create_model
+
+# Quantized checkpoint layout: a dict with these keys
+#   'format': QUANT_FORMAT, 'version': QUANT_VERSION,
+#   'config': LlamaConfig fields, 'bits': 8 or 4, 'group_size': int4 group size,
+#   'state_dict': model state dict with every nn.Linear replaced by QuantizedLinear
+#                 buffers; the tied embedding is stored once, under lm_head
+QUANT_FORMAT = "smollm2-weight-only"
+QUANT_VERSION = 1
+
+def quantize_weight(weight, bits=8, group_size=64):
+    """
+    Symmetric weight-only quantization.
+    
+    Args:
+        weight: fp32 weight [out_features, in_features]
+        bits: 8 for per-output-channel int8, 4 for int4 with one scale per group_size inputs
+        group_size: Inputs sharing a scale (int4 only)
+    
+    Returns:
+        qweight: int8 [out, in] for 8 bits; uint8 [out, in // 2] (two nibbles per byte) for 4 bits
+        scale: fp32 [out] for 8 bits; [out, in // group_size] for 4 bits
+    """
+    weight = weight.detach().float()
+    if bits == 8:
+        scale = weight.abs().amax(dim=1).clamp_min(1e-8) / 127
+        qweight = torch.round(weight / scale[:, None]).clamp(-127, 127).to(torch.int8)
+        return qweight, scale
+    if bits == 4:
+        out_features, in_features = weight.shape
+        if in_features % group_size:
+            raise ValueError(f"in_features={in_features} is not divisible by group_size={group_size}")
+        groups = weight.view(out_features, in_features // group_size, group_size)
+        scale = groups.abs().amax(dim=-1).clamp_min(1e-8) / 7
+        q = torch.round(groups / scale[..., None]).clamp(-8, 7).to(torch.int16).view(out_features, in_features) + 8
+        qweight = (q[:, 0::2] | (q[:, 1::2] << 4)).to(torch.uint8)
+        return qweight, scale
+    raise ValueError(f"Unsupported bit width: {bits}")
+
+def dequantize_weight(qweight, scale, bits=8, group_size=64):
+    """Inverse of quantize_weight, returned in fp32"""
+    if bits == 8:
+        return qweight.float() * scale[:, None]
+    low = (qweight & 0x0F).to(torch.int16) - 8
+    high = (qweight >> 4).to(torch.int16) - 8
+    q = torch.stack([low, high], dim=-1).view(qweight.size(0), -1).float()
+    return (q.view(q.size(0), -1, group_size) * scale[..., None]).view(q.size(0), -1)
+
+def _int8_cpu_kernel_available():
+    return 'fbgemm' in torch.backends.quantized.supported_engines
+
+def _int4_cpu_kernel_available():
+    return hasattr(torch.ops.aten, '_weight_int4pack_mm_for_cpu')
+
+class QuantizedLinear(nn.Module):
+    """
+    Bias-free nn.Linear replacement holding int8 or grouped int4 weights.
+    
+    On CPU the matmul runs on PyTorch's int8 (fbgemm, activations quantized
+    per call) or int4 (bf16 activations) kernels, whose packed weights are
+    built once on first use. Elsewhere, or without those kernels, the weight
+    is dequantized on every call, which saves memory but not time.
+    use_kernels=False forces the dequantize path (exact weight-only numerics).
+    """
+    def __init__(self, in_features, out_features, bits=8, group_size=64, use_kernels=True):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.bits = bits
+        self.group_size = group_size
+        self.use_kernels = use_kernels
+        packed_in = in_features if bits == 8 else in_features // 2
+        scale_shape = (out_features,) if bits == 8 else (out_features, in_features // group_size)
+        self.register_buffer("qweight", torch.zeros(out_features, packed_in, dtype=torch.int8 if bits == 8 else torch.uint8))
+        self.register_buffer("scale", torch.ones(scale_shape))
+        self._packed = None
+    
+    @classmethod
+    def from_float(cls, linear, bits=8, group_size=64, use_kernels=True):
+        module = cls(linear.in_features, linear.out_features, bits, group_size, use_kernels)
+        module.qweight, module.scale = quantize_weight(linear.weight, bits, group_size)
+        return module
+    
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Kernel weights are derived from the buffers, so rebuild them after a load
+        self._packed = None
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+    
+    def _pack(self):
+        if self.bits == 8:
+            if not _int8_cpu_kernel_available():
+                return False
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                zero_points = torch.zeros(self.out_features, dtype=torch.long)
+                qweight = torch._make_per_channel_quantized_tensor(self.qweight, self.scale.double(), zero_points, 0)
+                return torch.ops.quantized.linear_prepack(qweight, None)
+        if not _int4_cpu_kernel_available():
+            return False
+        # The kernel takes unsigned nibbles as int32 [out, in] and (scale, zero) pairs as [groups, out, 2]
+        low = (self.qweight & 0x0F).to(torch.int32)
+        high = (self.qweight >> 4).to(torch.int32)
+        q = torch.stack([low, high], dim=-1).view(self.out_features, self.in_features)
+        packed = torch.ops.aten._convert_weight_to_int4pack_for_cpu(q, 1)
+        scales_and_zeros = torch.stack([self.scale.t(), torch.zeros_like(self.scale.t())], dim=-1)
+        return packed, scales_and_zeros.to(torch.bfloat16).contiguous()
+    
+    def forward(self, x):
+        if self.use_kernels and x.device.type == "cpu" and not torch.is_grad_enabled():
+            if self._packed is None:
+                self._packed = self._pack()
+            if self._packed is not False:
+                shape = x.shape
+                x2d = x.reshape(-1, self.in_features)
+                if self.bits == 8:
+                    out = torch.ops.quantized.linear_dynamic(x2d.float(), self._packed, True)
+                else:
+                    packed, scales_and_zeros = self._packed
+                    out = torch.ops.aten._weight_int4pack_mm_for_cpu(
+                        x2d.to(torch.bfloat16), packed, self.group_size, scales_and_zeros
+                    )
+                return out.to(x.dtype).view(*shape[:-1], self.out_features)
+        weight = dequantize_weight(self.qweight, self.scale, self.bits, self.group_size)
+        return F.linear(x, weight.to(x.dtype))
+    
+    def extra_repr(self):
+        group = f", group_size={self.group_size}" if self.bits == 4 else ""
+        return f"in_features={self.in_features}, out_features={self.out_features}, bits={self.bits}{group}"
+
+class QuantizedEmbedding(nn.Module):
+    """Embedding lookup that reads the rows of a tied QuantizedLinear (the lm_head)"""
+    def __init__(self, lm_head: QuantizedLinear):
+        super().__init__()
+        # Held in a list so the tied buffers are not saved twice
+        self._lm_head = [lm_head]
+    
+    def forward(self, input_ids):
+        head = self._lm_head[0]
+        qweight = head.qweight[input_ids]
+        scale = head.scale[input_ids]
+        if head.bits == 8:
+            return qweight.float() * scale[..., None]
+        flat = dequantize_weight(qweight.view(-1, qweight.size(-1)), scale.view(-1, scale.size(-1)), 4, head.group_size)
+        return flat.view(*input_ids.shape, head.in_features)
+
+def quantize_model(
+    model: LlamaForCausalLM,
+    bits: int = 8,
+    group_size: int = 64,
+    use_kernels: bool = True
+) -> LlamaForCausalLM:
+    """
+    Replace every nn.Linear (attention, MLP and the tied lm_head/embedding) with
+    weight-only quantized modules, in place. Norm weights stay in fp32.
+    """
+    for module in list(model.modules()):
+        for child_name, child in list(module.named_children()):
+            if isinstance(child, nn.Linear):
+                setattr(module, child_name, QuantizedLinear.from_float(child, bits, group_size, use_kernels))
+    model.model.embed_tokens = QuantizedEmbedding(model.lm_head)
+    model.quantization = {'bits': bits, 'group_size': group_size}
+    return model
+
+def save_quantized_checkpoint(model: LlamaForCausalLM, checkpoint_path: str) -> None:
+    """Save a model prepared by quantize_model in the compact quantized format"""
+    checkpoint = {
+        'format': QUANT_FORMAT,
+        'version': QUANT_VERSION,
+        'config': dict(vars(model.config)),
+        'bits': model.quantization['bits'],
+        'group_size': model.quantization['group_size'],
+        'state_dict': model.state_dict(),
+    }
+    torch.save(checkpoint, checkpoint_path)
+
+def load_quantized_checkpoint(checkpoint_path: str, device: str = 'cpu', use_kernels: bool = True) -> LlamaForCausalLM:
+    """Build a quantized model from a checkpoint written by save_quantized_checkpoint"""
+    checkpoint = torch.load(checkpoint_path, map_location='cpu', mmap=True, weights_only=True)
+    if checkpoint.get('format') != QUANT_FORMAT:
+        raise ValueError(f"{checkpoint_path} is not a quantized checkpoint")
+    if checkpoint['version'] != QUANT_VERSION:
+        raise ValueError(f"{checkpoint_path} has unsupported quantized checkpoint version {checkpoint['version']}")
+    
+    # Build the quantized structure on the meta device and adopt the memory-mapped buffers
+    # Files written before the fused projections have no fused_projections field; their
+    # quantized buffers are per q/k/v and gate/up projection
+    config = {'fused_projections': False, **checkpoint['config']}
+    # Older files also carry use_cache, which the model never read (callers pass use_cache to forward())
+    config.pop('use_cache', None)
+    model = create_model(device="meta", config=LlamaConfig(**config))
+    quantize_model(model, checkpoint['bits'], checkpoint['group_size'], use_kernels)
+    model.load_state_dict(checkpoint['state_dict'], assign=True)
+    return model.to(device).eval()
+
+def quantize_checkpoint(
+    input_path: str = "checkpoints/model_lightweight_10000.pt",
+    output_path: str = None,
+    bits: int = 8,
+    group_size: int = 64
+) -> str:
+    """
+    Quantize a lightweight (weights-only) checkpoint, as written by convert_checkpoint.py.
+    
+    Returns:
+        output_path: The quantized checkpoint file
+    """
+    if output_path is None:
+        output_path = os.path.splitext(input_path)[0] + f"_int{bits}.pt"
+    model = LlamaForCausalLM(LlamaConfig())
+    model.load_state_dict(torch.load(input_path, map_location='cpu'))
+    quantize_model(model, bits, group_size)
+    save_quantized_checkpoint(model, output_path)
+    
+    input_size = os.path.getsize(input_path) / (1024 * 1024)
+    output_size = os.path.getsize(output_path) / (1024 * 1024)
+    print(f"fp32 checkpoint size: {input_size:.2f} MB")
+    print(f"int{bits} checkpoint size: {output_size:.2f} MB ({input_size / output_size:.2f}x smaller)")
+    return output_path
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Quantize a lightweight checkpoint to int8 or grouped int4 weights")
+    parser.add_argument("--input", default="checkpoints/model_lightweight_10000.pt")
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--bits", type=int, choices=(8, 4), default=8)
+    parser.add_argument("--group-size", type=int, default=64)
+    args = parser.parse_args()
+    
+    quantize_checkpoint(args.input, args.output, args.bits, args.group_size)
@@ -1,3 +1,4 @@
+import contextlib
 import math
 from dataclasses import dataclass
 import torch
@@ -5,6 +6,9 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.utils.checkpoint
 
+# SDPA broadcasts key/value heads over query groups natively from PyTorch 2.5
+SDPA_SUPPORTS_GQA = tuple(int(v) for v in torch.__version__.split('+')[0].split('.')[:2]) >= (2, 5)
+
 @dataclass
 class LlamaConfig:
     vocab_size: int = 49152
@@ -17,7 +21,6 @@ class LlamaConfig:
     max_position_embeddings: int = 8192
     initializer_range: float = 0.041666666666666664
     rms_norm_eps: float = 1e-5
-    use_cache: bool = True
     pad_token_id: int = 2
     bos_token_id: int = 1
     eos_token_id: int = 2
@@ -25,34 +28,77 @@ class LlamaConfig:
     rope_theta: float = 100000
     rope_scaling: dict = None
     rope_interleaved: bool = False
+    fused_rms_norm: bool = False  # rsqrt formulation; eps moves inside the square root
+    fused_rotary: bool = True  # In-place half-width rotation without rotate_half
+    fused_projections: bool = True  # One qkv_proj and one gate_up_proj matmul instead of five
+    loss_chunk_size: int = 1024  # Tokens per lm_head/cross-entropy chunk when logits are not returned
 
 class RMSNorm(nn.Module):
-    def __init__(self, dim: int, eps: float = 1e-5):
+    def __init__(self, dim: int, eps: float = 1e-5, fused: bool = False):
         super().__init__()
         self.eps = eps
+        self.fused = fused
         self.weight = nn.Parameter(torch.ones(dim))
 
     def forward(self, x):
+        if self.fused:
+            # Single reduction and multiply, computed in fp32 under autocast
+            x_f = x.float()
+            return (x_f * torch.rsqrt(x_f.pow(2).mean(-1, keepdim=True) + self.eps)).type_as(x) * self.weight
         norm = torch.norm(x, dim=-1, keepdim=True) * x.shape[-1] ** (-0.5)
         return x / (norm + self.eps) * self.weight
 
 class RotaryEmbedding(nn.Module):
+    """
+    Rotary cos/sin table, built lazily and grown to the longest position seen.
+    
+    Buffers are non-persistent: they are never saved in a state_dict and are
+    rebuilt in the dtype/device of the activations that use them.
+    """
     def __init__(self, dim, max_position_embeddings=8192, base=100000):
         super().__init__()
-        inv_freq = 1.0 / (base ** (torch.arange(0, dim, 2).float() / dim))
-        self.register_buffer("inv_freq", inv_freq)
-        self.max_seq_len_cached = max_position_embeddings
-        t = torch.arange(self.max_seq_len_cached).type_as(self.inv_freq)
-        freqs = torch.einsum("i,j->ij", t, self.inv_freq)
+        # Always materialized on the CPU, even when the model is built on the meta
+        # device: it is not in the state_dict, so a checkpoint load would not fill it
+        inv_freq = 1.0 / (base ** (torch.arange(0, dim, 2, device="cpu").float() / dim))
+        self.register_buffer("inv_freq", inv_freq, persistent=False)
+        self.max_position_embeddings = max_position_embeddings
+        self.max_seq_len_cached = 0
+        self.register_buffer("cos_cached", None, persistent=False)
+        self.register_buffer("sin_cached", None, persistent=False)
+
+    def _set_cos_sin_cache(self, seq_len, device, dtype):
+        # Grow geometrically (up to max_position_embeddings) so decoding does not rebuild every step
+        length = max(seq_len, min(2 * self.max_seq_len_cached, self.max_position_embeddings))
+        t = torch.arange(length, device=device, dtype=torch.float32)
+        freqs = torch.outer(t, self.inv_freq.to(device=device, dtype=torch.float32))
         emb = torch.cat((freqs, freqs), dim=-1)
-        self.register_buffer("cos_cached", emb.cos()[None, None, :, :])
-        self.register_buffer("sin_cached", emb.sin()[None, None, :, :])
+        # Tables first, length last: a concurrent forward that sees the new length also sees the new tables
+        self.cos_cached = emb.cos()[None, None, :, :].to(dtype)
+        self.sin_cached = emb.sin()[None, None, :, :].to(dtype)
+        self.max_seq_len_cached = length
+        return self.cos_cached, self.sin_cached
 
-    def forward(self, x, seq_len=None):
-        return (
-            self.cos_cached[:, :, :seq_len, ...],
-            self.sin_cached[:, :, :seq_len, ...]
-        )
+    def forward(self, x, seq_len=None, offset=0, position_ids=None):
+        """
+        cos/sin for positions offset..offset+seq_len as [1, 1, seq_len, dim], or,
+        when per-row position_ids [B, T] are given, gathered as [B, T, dim].
+        
+        The table is sized from offset + seq_len (default seq_len: T), which
+        bounds position_ids too: packed or left-padded positions never exceed
+        the tokens seen so far. Reading position_ids.max() instead would sync
+        with the device and break a compiled graph on every call.
+        """
+        if seq_len is None:
+            seq_len = position_ids.size(-1)
+        end = offset + seq_len
+        # Read the tables once and check their own lengths, so a rebuild by another thread cannot be seen half-done
+        cos, sin = self.cos_cached, self.sin_cached
+        if (cos is None or sin is None or end > min(cos.size(2), sin.size(2))
+                or cos.device != x.device or cos.dtype != x.dtype):
+            cos, sin = self._set_cos_sin_cache(max(end, self.max_seq_len_cached), x.device, x.dtype)
+        if position_ids is not None:
+            return cos[0, 0][position_ids], sin[0, 0][position_ids]
+        return cos[:, :, offset:end, ...], sin[:, :, offset:end, ...]
 
 def rotate_half(x):
     x1, x2 = x[..., :x.shape[-1]//2], x[..., x.shape[-1]//2:]
@@ -63,6 +109,44 @@ def apply_rotary_pos_emb(q, k, cos, sin):
     k_embed = (k * cos) + (rotate_half(k) * sin)
     return q_embed, k_embed
 
+def apply_rotary_pos_emb_fused(q, k, cos, sin):
+    """
+    Same result as apply_rotary_pos_emb without materializing rotate_half.
+    
+    Both halves of cos/sin hold the same frequencies, so half-width tables are
+    enough: out = x * cos, then out1 -= x2 * sin and out2 += x1 * sin in place.
+    """
+    half = cos.shape[-1] // 2
+    sin = sin[..., :half]
+    
+    def rotate(x):
+        out = x * cos
+        out[..., :half].addcmul_(x[..., half:], sin, value=-1)
+        out[..., half:].addcmul_(x[..., :half], sin)
+        return out
+    
+    return rotate(q), rotate(k)
+
+# Fused projection -> the separate projections it replaces, in output order
+FUSED_PROJECTIONS = {
+    'qkv_proj': ('q_proj', 'k_proj', 'v_proj'),
+    'gate_up_proj': ('gate_proj', 'up_proj'),
+}
+
+def _convert_projections(state_dict, prefix, fused_name, part_sizes, fused):
+    """
+    Rewrite one module's projection weights in state_dict to the module's layout:
+    concatenate separate weights into the fused one, or split a fused weight.
+    This lets checkpoints saved with either layout load into both.
+    """
+    fused_key = f"{prefix}{fused_name}.weight"
+    part_keys = [f"{prefix}{name}.weight" for name in FUSED_PROJECTIONS[fused_name]]
+    if fused and all(key in state_dict for key in part_keys):
+        state_dict[fused_key] = torch.cat([state_dict.pop(key) for key in part_keys])
+    elif not fused and fused_key in state_dict:
+        for key, weight in zip(part_keys, state_dict.pop(fused_key).split(part_sizes)):
+            state_dict[key] = weight
+
 class LlamaAttention(nn.Module):
     def __init__(self, config):
         super().__init__()
@@ -71,79 +155,230 @@ class LlamaAttention(nn.Module):
         self.num_kv_groups = self.num_heads // self.num_kv_heads
         self.hidden_size = config.hidden_size
         self.head_dim = config.hidden_size // config.num_attention_heads
+        self.fused_rotary = config.fused_rotary
+        self.fused_projections = config.fused_projections
+        self.kv_dim = self.num_kv_heads * self.head_dim
+        # Output rows of q_proj, k_proj and v_proj within qkv_proj
+        self.projection_sizes = [self.hidden_size, self.kv_dim, self.kv_dim]
+        # The model was trained with the query pre-scaled by head_dim**-0.5 on top of
+        # SDPA's own head_dim**-0.5; both are folded into this single softmax scale
+        self.scaling = self.head_dim ** -1
         
-        self.q_proj = nn.Linear(config.hidden_size, config.num_attention_heads * self.head_dim, bias=False)
-        self.k_proj = nn.Linear(config.hidden_size, config.num_key_value_heads * self.head_dim, bias=False)
-        self.v_proj = nn.Linear(config.hidden_size, config.num_key_value_heads * self.head_dim, bias=False)
+        if self.fused_projections:
+            # One matmul for query, key and value; the output is split with views
+            self.qkv_proj = nn.Linear(config.hidden_size, self.hidden_size + 2 * self.kv_dim, bias=False)
+        else:
+            self.q_proj = nn.Linear(config.hidden_size, config.num_attention_heads * self.head_dim, bias=False)
+            self.k_proj = nn.Linear(config.hidden_size, config.num_key_value_heads * self.head_dim, bias=False)
+            self.v_proj = nn.Linear(config.hidden_size, config.num_key_value_heads * self.head_dim, bias=False)
         self.o_proj = nn.Linear(config.hidden_size, config.hidden_size, bias=False)
-        
-        self.rotary_emb = RotaryEmbedding(
-            self.head_dim,
-            max_position_embeddings=config.max_position_embeddings,
-            base=config.rope_theta
-        )
 
-    def forward(self, x):
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Older checkpoints carry a per-layer rotary table; it is now shared and rebuilt on demand
+        for name in ("inv_freq", "cos_cached", "sin_cached"):
+            state_dict.pop(f"{prefix}rotary_emb.{name}", None)
+        _convert_projections(state_dict, prefix, "qkv_proj", self.projection_sizes, self.fused_projections)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward(self, x, position_embeddings, past_key_value=None, use_cache=False, attention_mask=None):
+        """
+        position_embeddings: (cos, sin) for the new positions, shaped [1 or B, T, 1, head_dim]
+        attention_mask: Optional boolean [B, 1, T, past + T] mask (True = attend); causal if None
+        """
         B, T, C = x.size()
         
-        # Split heads and key/value heads
-        q = self.q_proj(x).view(B, T, self.num_heads, self.head_dim)
-        k = self.k_proj(x).view(B, T, self.num_kv_heads, self.head_dim)
-        v = self.v_proj(x).view(B, T, self.num_kv_heads, self.head_dim)
+        # Positions already held in the cache
+        past_len = past_key_value[0].size(2) if past_key_value is not None else 0
         
-        # Apply rotary embeddings
-        cos, sin = self.rotary_emb(x, seq_len=T)
-        cos = cos.view(1, T, 1, self.head_dim)
-        sin = sin.view(1, T, 1, self.head_dim)
-        q, k = apply_rotary_pos_emb(q, k, cos, sin)
+        # Split heads and key/value heads
+        if self.fused_projections:
+            q, k, v = self.qkv_proj(x).split([self.hidden_size, self.kv_dim, self.kv_dim], dim=-1)
+        else:
+            q, k, v = self.q_proj(x), self.k_proj(x), self.v_proj(x)
+        q = q.view(B, T, self.num_heads, self.head_dim)
+        k = k.view(B, T, self.num_kv_heads, self.head_dim)
+        v = v.view(B, T, self.num_kv_heads, self.head_dim)
         
-        # Repeat k,v for each query group
-        if self.num_kv_groups > 1:
-            k = k.repeat_interleave(self.num_kv_groups, dim=2)
-            v = v.repeat_interleave(self.num_kv_groups, dim=2)
+        # Apply rotary embeddings at the current position offset
+        cos, sin = position_embeddings
+        if self.fused_rotary:
+            q, k = apply_rotary_pos_emb_fused(q, k, cos, sin)
+        else:
+            q, k = apply_rotary_pos_emb(q, k, cos, sin)
         
         # Prepare inputs for attention
         q = q.transpose(1, 2)  # [B, num_heads, T, head_dim]
-        k = k.transpose(1, 2)  # [B, num_heads, T, head_dim]
-        v = v.transpose(1, 2)  # [B, num_heads, T, head_dim]
+        k = k.transpose(1, 2)  # [B, num_kv_heads, T, head_dim]
+        v = v.transpose(1, 2)  # [B, num_kv_heads, T, head_dim]
+        
+        # Append to the cache at key/value head width
+        if past_key_value is not None:
+            k = torch.cat([past_key_value[0], k], dim=2)
+            v = torch.cat([past_key_value[1], v], dim=2)
+        present = (k, v) if use_cache else None
         
-        # Scale query
-        q = q * (self.head_dim ** -0.5)
+        # Older PyTorch: repeat k,v for each query group
+        enable_gqa = self.num_kv_groups > 1 and SDPA_SUPPORTS_GQA
+        if self.num_kv_groups > 1 and not enable_gqa:
+            k = k.repeat_interleave(self.num_kv_groups, dim=1)
+            v = v.repeat_interleave(self.num_kv_groups, dim=1)
         
-        # Use PyTorch's built-in scaled dot product attention with Flash Attention
+        # Causal mask; with a cache the queries sit at the end of the key sequence
+        attn_mask = attention_mask
+        if attn_mask is None and past_len > 0 and T > 1:
+            q_pos = torch.arange(past_len, past_len + T, device=x.device)
+            k_pos = torch.arange(past_len + T, device=x.device)
+            attn_mask = k_pos[None, :] <= q_pos[:, None]
+        
+        # Use PyTorch's built-in scaled dot product attention with Flash Attention;
+        # with enable_gqa, k/v stay at num_kv_heads and are shared across query groups
+        sdpa_kwargs = {'enable_gqa': True} if enable_gqa else {}
         output = F.scaled_dot_product_attention(
             q, k, v,
-            is_causal=True
+            attn_mask=attn_mask,
+            is_causal=attention_mask is None and past_len == 0,
+            scale=self.scaling,
+            **sdpa_kwargs
         )
         
         # Reshape and project output
         output = output.transpose(1, 2).contiguous().view(B, T, C)
-        return self.o_proj(output)
+        output = self.o_proj(output)
+        if use_cache:
+            return output, present
+        return output
 
 class LlamaMLP(nn.Module):
     def __init__(self, config):
         super().__init__()
-        self.gate_proj = nn.Linear(config.hidden_size, config.intermediate_size, bias=False)
-        self.up_proj = nn.Linear(config.hidden_size, config.intermediate_size, bias=False)
+        self.fused_projections = config.fused_projections
+        self.intermediate_size = config.intermediate_size
+        # Output rows of gate_proj and up_proj within gate_up_proj
+        self.projection_sizes = [self.intermediate_size] * 2
+        if self.fused_projections:
+            self.gate_up_proj = nn.Linear(config.hidden_size, 2 * config.intermediate_size, bias=False)
+        else:
+            self.gate_proj = nn.Linear(config.hidden_size, config.intermediate_size, bias=False)
+            self.up_proj = nn.Linear(config.hidden_size, config.intermediate_size, bias=False)
         self.down_proj = nn.Linear(config.intermediate_size, config.hidden_size, bias=False)
         self.act_fn = nn.SiLU()
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        _convert_projections(state_dict, prefix, "gate_up_proj", self.projection_sizes, self.fused_projections)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def forward(self, x):
-        gate = self.act_fn(self.gate_proj(x))
-        up = self.up_proj(x)
-        return self.down_proj(gate * up)
+        if self.fused_projections:
+            gate, up = self.gate_up_proj(x).chunk(2, dim=-1)
+        else:
+            gate, up = self.gate_proj(x), self.up_proj(x)
+        return self.down_proj(self.act_fn(gate) * up)
+
+class ChunkedLMHeadCrossEntropy(torch.autograd.Function):
+    """
+    Mean cross-entropy of hidden_states @ weight.T against labels, computed in
+    chunks of rows so the full [N, vocab] logits never exist at once.
+    
+    Chunk logits are recomputed in backward, where the softmax gradient is
+    formed and immediately contracted into the hidden-state and weight grads.
+    """
+    @staticmethod
+    def forward(ctx, hidden_states, weight, labels, chunk_size, ignore_index=-100):
+        valid = labels != ignore_index
+        n_valid = valid.sum().clamp_min(1)
+        
+        loss = hidden_states.new_zeros((), dtype=torch.float32)
+        compute_dtype = None
+        for start in range(0, hidden_states.size(0), chunk_size):
+            logits = hidden_states[start:start + chunk_size] @ weight.t()
+            compute_dtype = logits.dtype
+            loss = loss + F.cross_entropy(
+                logits.float(), labels[start:start + chunk_size], ignore_index=ignore_index, reduction='sum'
+            )
+        
+        ctx.save_for_backward(hidden_states, weight, labels, valid, n_valid)
+        ctx.chunk_size = chunk_size
+        ctx.compute_dtype = compute_dtype
+        return loss / n_valid
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        hidden_states, weight, labels, valid, n_valid = ctx.saved_tensors
+        # Recompute in the dtype the forward matmul ran in (e.g. fp16 under autocast)
+        compute_weight = weight.to(ctx.compute_dtype)
+        scale = grad_output / n_valid
+        
+        grad_hidden = torch.empty_like(hidden_states)
+        grad_weight = torch.zeros_like(weight, dtype=torch.float32)
+        for start in range(0, hidden_states.size(0), ctx.chunk_size):
+            end = start + ctx.chunk_size
+            h = hidden_states[start:end].to(ctx.compute_dtype)
+            chunk_labels = labels[start:end]
+            chunk_valid = valid[start:end].unsqueeze(1)
+            
+            # d(loss)/d(logits) = (softmax - one_hot(label)) / n_valid for counted rows
+            grad_logits = torch.softmax((h @ compute_weight.t()).float(), dim=-1)
+            grad_logits.scatter_add_(1, chunk_labels.clamp_min(0).unsqueeze(1), -chunk_valid.float())
+            grad_logits = (grad_logits * chunk_valid * scale).to(ctx.compute_dtype)
+            
+            grad_hidden[start:end] = grad_logits @ compute_weight
+            grad_weight += (grad_logits.t() @ h).float()
+        
+        return grad_hidden, grad_weight.to(weight.dtype), None, None, None
+
+CHECKPOINT_POLICIES = ("all", "every_k", "attention", "mlp", "none")
 
 class LlamaDecoderLayer(nn.Module):
     def __init__(self, config):
         super().__init__()
-        self.input_layernorm = RMSNorm(config.hidden_size, eps=config.rms_norm_eps)
+        self.input_layernorm = RMSNorm(config.hidden_size, eps=config.rms_norm_eps, fused=config.fused_rms_norm)
         self.self_attn = LlamaAttention(config)
-        self.post_attention_layernorm = RMSNorm(config.hidden_size, eps=config.rms_norm_eps)
+        self.post_attention_layernorm = RMSNorm(config.hidden_size, eps=config.rms_norm_eps, fused=config.fused_rms_norm)
         self.mlp = LlamaMLP(config)
+        
+        # Activation checkpointing of the attention and MLP blocks (set by the model's policy)
+        self.checkpoint_attn = False
+        self.checkpoint_mlp = False
 
-    def forward(self, x):
-        x = x + self.self_attn(self.input_layernorm(x))
-        x = x + self.mlp(self.post_attention_layernorm(x))
+    def _attn_block(self, x, position_embeddings, past_key_value=None, attention_mask=None):
+        return self.self_attn(self.input_layernorm(x), position_embeddings, past_key_value, attention_mask=attention_mask)
+
+    def _mlp_block(self, x):
+        return self.mlp(self.post_attention_layernorm(x))
+
+    def _block(self, x, position_embeddings, past_key_value=None, attention_mask=None):
+        x = x + self._attn_block(x, position_embeddings, past_key_value, attention_mask)
+        return x + self._mlp_block(x)
+
+    def forward(self, x, position_embeddings, past_key_value=None, use_cache=False, attention_mask=None):
+        if use_cache:
+            attn_out, present = self.self_attn(
+                self.input_layernorm(x), position_embeddings, past_key_value, use_cache=True, attention_mask=attention_mask
+            )
+            x = x + attn_out
+            x = x + self.mlp(self.post_attention_layernorm(x))
+            return x, present
+        
+        checkpointing = self.training and torch.is_grad_enabled()
+        checkpoint_attn = checkpointing and self.checkpoint_attn
+        checkpoint_mlp = checkpointing and self.checkpoint_mlp
+        if checkpoint_attn and checkpoint_mlp:
+            # Whole layer as one recompute unit
+            return torch.utils.checkpoint.checkpoint(
+                self._block, x, position_embeddings, past_key_value, attention_mask, use_reentrant=False
+            )
+        
+        if checkpoint_attn:
+            x = x + torch.utils.checkpoint.checkpoint(
+                self._attn_block, x, position_embeddings, past_key_value, attention_mask, use_reentrant=False
+            )
+        else:
+            x = x + self._attn_block(x, position_embeddings, past_key_value, attention_mask)
+        
+        if checkpoint_mlp:
+            x = x + torch.utils.checkpoint.checkpoint(self._mlp_block, x, use_reentrant=False)
+        else:
+            x = x + self._mlp_block(x)
         return x
 
 class LlamaModel(nn.Module):
@@ -152,17 +387,102 @@ class LlamaModel(nn.Module):
         self.config = config
         self.embed_tokens = nn.Embedding(config.vocab_size, config.hidden_size)
         self.layers = nn.ModuleList([LlamaDecoderLayer(config) for _ in range(config.num_hidden_layers)])
-        self.norm = RMSNorm(config.hidden_size, eps=config.rms_norm_eps)
+        self.norm = RMSNorm(config.hidden_size, eps=config.rms_norm_eps, fused=config.fused_rms_norm)
+        
+        # One rotary table shared by every layer
+        self.head_dim = config.hidden_size // config.num_attention_heads
+        self.rotary_emb = RotaryEmbedding(
+            self.head_dim,
+            max_position_embeddings=config.max_position_embeddings,
+            base=config.rope_theta
+        )
+
+    @staticmethod
+    def _expand_attention_mask(attention_mask, past_len, T):
+        """[B, past_len + T] padding mask (1 = token) -> [B, 1, T, past_len + T] causal boolean mask"""
+        q_pos = torch.arange(past_len, past_len + T, device=attention_mask.device)
+        k_pos = torch.arange(attention_mask.size(1), device=attention_mask.device)
+        causal = k_pos[None, :] <= q_pos[:, None]
+        mask = causal[None, None] & attention_mask.bool()[:, None, None, :]
+        # Each query may always see itself, so rows for padding tokens are never fully masked (NaN)
+        return mask | (k_pos[None, :] == q_pos[:, None])[None, None]
 
-    def forward(self, input_ids):
+    def forward(self, input_ids, past_key_values=None, use_cache=False, attention_mask=None, position_ids=None, num_layers=None):
+        """
+        Args:
+            attention_mask: Optional [B, past + T] padding mask (1 = token, 0 = padding),
+                or a ready boolean [B, 1, T, past + T] mask
+            position_ids: Optional [B, T] rotary positions, each below past + T; derived
+                from a padding mask when one is given, otherwise past..past + T - 1
+            num_layers: Early exit: run only the first num_layers decoder layers
+                before the final norm (past_key_values then holds that many layers)
+        """
         x = self.embed_tokens(input_ids)
+        T = input_ids.size(1)
+        layers = self.layers if num_layers is None else self.layers[:num_layers]
+        
+        if past_key_values is None:
+            past_key_values = [None] * len(layers)
+        presents = [] if use_cache else None
+        past_len = past_key_values[0][0].size(2) if past_key_values[0] is not None else 0
         
-        for layer in self.layers:
-            x = layer(x)
+        if attention_mask is not None and attention_mask.dim() == 2:
+            if position_ids is None:
+                # Left padding: count positions from each row's first real token
+                position_ids = (attention_mask.long().cumsum(-1) - 1).clamp_min(0)[:, -T:]
+            attention_mask = self._expand_attention_mask(attention_mask, past_len, T)
+        
+        # Rotary cos/sin for the new positions, computed once for all layers
+        if position_ids is not None:
+            cos, sin = self.rotary_emb(x, seq_len=T, offset=past_len, position_ids=position_ids)
+            position_embeddings = (cos.unsqueeze(2), sin.unsqueeze(2))
+        else:
+            cos, sin = self.rotary_emb(x, seq_len=T, offset=past_len)
+            position_embeddings = (cos.view(1, T, 1, self.head_dim), sin.view(1, T, 1, self.head_dim))
+        
+        for layer, past_key_value in zip(layers, past_key_values):
+            if use_cache:
+                x, present = layer(x, position_embeddings, past_key_value, use_cache=True, attention_mask=attention_mask)
+                presents.append(present)
+            else:
+                x = layer(x, position_embeddings, past_key_value, attention_mask=attention_mask)
             
         x = self.norm(x)
+        if use_cache:
+            return x, presents
         return x
 
+def document_attention_inputs(input_ids, eos_token_id):
+    """
+    Attention mask and positions that keep packed documents apart.
+    
+    Each EOS ends the document it belongs to. Tokens attend causally within
+    their own document only, and rotary positions restart at 0 for every
+    document, so a packed row behaves like its documents run separately.
+    
+    Args:
+        input_ids: [B, T] packed token ids
+        eos_token_id: Document separator
+    
+    Returns:
+        attention_mask: [B, 1, T, T] boolean mask (True = attend)
+        position_ids: [B, T] positions within each document
+    """
+    is_eos = (input_ids == eos_token_id).long()
+    doc_ids = is_eos.cumsum(-1) - is_eos
+    T = input_ids.size(1)
+    positions = torch.arange(T, device=input_ids.device).expand_as(input_ids)
+    
+    causal = torch.ones(T, T, dtype=torch.bool, device=input_ids.device).tril()
+    attention_mask = causal[None, None] & (doc_ids[:, None, :, None] == doc_ids[:, None, None, :])
+    
+    # Offset of each token's document start: positions where the document id changes
+    starts = torch.zeros_like(doc_ids, dtype=torch.bool)
+    starts[:, 0] = True
+    starts[:, 1:] = doc_ids[:, 1:] != doc_ids[:, :-1]
+    doc_start = torch.where(starts, positions, torch.zeros_like(positions)).cummax(-1).values
+    return attention_mask, positions - doc_start
+
 class LlamaForCausalLM(nn.Module):
     def __init__(self, config):
         super().__init__()
@@ -170,13 +490,16 @@ class LlamaForCausalLM(nn.Module):
         self.model = LlamaModel(config)
         self.lm_head = nn.Linear(config.hidden_size, config.vocab_size, bias=False)
         
-        # Initialize weights and tie them if configured
-        self.apply(self._init_weights)
+        # Initialize weights and tie them if configured; a meta-device model has
+        # nothing to initialize, its weights are assigned from a checkpoint
+        if not self.lm_head.weight.is_meta:
+            self.apply(self._init_weights)
         if config.tie_word_embeddings:
             self.lm_head.weight = self.model.embed_tokens.weight
             
         # Add gradient checkpointing flag
         self.gradient_checkpointing = False
+        self.checkpoint_policy = "none"
 
     def _init_weights(self, module):
         if isinstance(module, nn.Linear):
@@ -186,40 +509,114 @@ class LlamaForCausalLM(nn.Module):
         elif isinstance(module, nn.Embedding):
             torch.nn.init.normal_(module.weight, mean=0.0, std=self.config.initializer_range)
 
-    def gradient_checkpointing_enable(self):
-        """Enable gradient checkpointing for memory efficiency"""
-        self.gradient_checkpointing = True
+    def gradient_checkpointing_enable(self, policy="all", every_k=2):
+        """
+        Enable gradient checkpointing for memory efficiency.
+        
+        Checkpointing is applied per LlamaDecoderLayer (non-reentrant, so it
+        composes with torch.compile) according to the policy:
+            "all": every layer
+            "every_k": every every_k-th layer
+            "attention": only the attention block of each layer
+            "mlp": only the MLP block of each layer
+            "none": no checkpointing
+        """
+        if policy not in CHECKPOINT_POLICIES:
+            raise ValueError(f"Unknown checkpointing policy {policy!r}; expected one of {CHECKPOINT_POLICIES}")
+        for i, layer in enumerate(self.model.layers):
+            selected = policy == "all" or (policy == "every_k" and i % every_k == 0)
+            layer.checkpoint_attn = selected or policy == "attention"
+            layer.checkpoint_mlp = selected or policy == "mlp"
+        self.gradient_checkpointing = policy != "none"
+        self.checkpoint_policy = policy
         
     def gradient_checkpointing_disable(self):
         """Disable gradient checkpointing"""
-        self.gradient_checkpointing = False
+        self.gradient_checkpointing_enable("none")
 
-    def forward(self, input_ids, labels=None):
-        # Modify forward to use gradient checkpointing if enabled
-        if self.gradient_checkpointing and self.training:
-            def create_custom_forward(module):
-                def custom_forward(*inputs):
-                    return module(*inputs)
-                return custom_forward
-            
-            hidden_states = torch.utils.checkpoint.checkpoint(
-                create_custom_forward(self.model),
-                input_ids
+    def forward(self, input_ids, labels=None, past_key_values=None, use_cache=False, return_logits=True,
+                attention_mask=None, position_ids=None, last_logits_only=False, num_layers=None, vocab_shortlist=None):
+        """
+        Run the model, optionally with a key/value cache for incremental decoding.
+        
+        Args:
+            input_ids: Token ids [B, T]; with a cache, only the new tokens
+            labels: Optional targets [B, T] for the cross-entropy loss
+            past_key_values: Per-layer (k, v) tensors from a previous call
+            use_cache: Also return the updated per-layer cache
+            return_logits: With labels, False computes the loss in chunks of
+                config.loss_chunk_size tokens and returns None for logits
+            attention_mask: Optional padding mask [B, past + T] (see LlamaModel.forward)
+            position_ids: Optional rotary positions [B, T]
+            last_logits_only: Without labels, project only the last position [B, 1, vocab]
+            num_layers: Early exit after the first num_layers decoder layers; the
+                shared norm and lm_head then predict from that depth
+            vocab_shortlist: Without labels, project with this VocabShortlist instead
+                of lm_head; only the argmax of its logits is exact (greedy decoding)
+        
+        Returns:
+            (logits, loss), or (logits, loss, past_key_values) when use_cache is set
+        """
+        presents = None
+        if use_cache:
+            hidden_states, presents = self.model(
+                input_ids, past_key_values, use_cache=True, attention_mask=attention_mask, position_ids=position_ids,
+                num_layers=num_layers
             )
         else:
-            hidden_states = self.model(input_ids)
+            # Gradient checkpointing, if enabled, is applied inside each decoder layer
+            hidden_states = self.model(input_ids, attention_mask=attention_mask, position_ids=position_ids, num_layers=num_layers)
             
-        logits = self.lm_head(hidden_states)
-        
         loss = None
-        if labels is not None:
-            loss = F.cross_entropy(logits.view(-1, logits.size(-1)), labels.view(-1))
-            
+        if labels is not None and not return_logits:
+            # Loss only: never materialize the full [B, T, vocab] logits
+            logits = None
+            loss = ChunkedLMHeadCrossEntropy.apply(
+                hidden_states.reshape(-1, hidden_states.size(-1)),
+                self.lm_head.weight,
+                labels.reshape(-1),
+                self.config.loss_chunk_size
+            )
+        else:
+            if last_logits_only and labels is None:
+                hidden_states = hidden_states[:, -1:, :]
+            if vocab_shortlist is not None and labels is None:
+                logits = vocab_shortlist(hidden_states)
+            else:
+                logits = self.lm_head(hidden_states)
+            if labels is not None:
+                loss = F.cross_entropy(logits.view(-1, logits.size(-1)), labels.view(-1))
+        
+        if use_cache:
+            return logits, loss, presents
         return logits, loss
 
-def create_model():
-    config = LlamaConfig()
-    model = LlamaForCausalLM(config)
+@contextlib.contextmanager
+def _skip_default_init():
+    """Skip the reset_parameters() init nn.Linear/nn.Embedding run in their constructors"""
+    saved = nn.Linear.reset_parameters, nn.Embedding.reset_parameters
+    nn.Linear.reset_parameters = nn.Embedding.reset_parameters = lambda self: None
+    try:
+        yield
+    finally:
+        nn.Linear.reset_parameters, nn.Embedding.reset_parameters = saved
+
+def create_model(device=None, config=None):
+    """
+    Args:
+        device: Device to construct the parameters on; "meta" allocates and
+            initializes nothing (weights must then be loaded with
+            load_state_dict(..., assign=True))
+        config: LlamaConfig (default: SmolLM2-135M)
+    """
+    config = config or LlamaConfig()
+    if device is None:
+        return LlamaForCausalLM(config)
+    if str(device) == "meta":
+        with _skip_default_init(), torch.device("meta"):
+            return LlamaForCausalLM(config)
+    with torch.device(device):
+        model = LlamaForCausalLM(config)
     return model
 
 if __name__ == "__main__":
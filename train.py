@@ -1,11 +1,104 @@
 import torch
 from torch.amp import autocast, GradScaler
-from smollm2_135M import create_model
+from smollm2_135M import create_model, document_attention_inputs
 from cosmopedia_dataloader import create_cosmopedia_loader
+from memmap_dataloader import create_memmap_loader
 from model_sampling import initialize_tokenizer, sample_model_output
-from checkpoint_utils import save_checkpoint, load_checkpoint
+from checkpoint_utils import CheckpointManager, load_checkpoint
+from dist_utils import setup_distributed, cleanup_distributed, all_reduce_mean, all_reduce_min, all_reduce_sum, get_world_size
+from adamw8bit import AdamW8bit
+from evaluation import HeldOutSet, evaluate_perplexity
+from training_metrics import PhaseTimer, StepProfiler, MetricsLogger, model_flops_per_token, peak_flops
+from torch.nn.parallel import DistributedDataParallel as DDP
+import contextlib
+import math
 import time
 
+def accumulate_gradients(model, scaler, micro_batches, device, use_amp=True, eos_token_id=None, timer=None):
+    """
+    Forward and backward over micro-batches, accumulating their gradients.
+    
+    Each micro-batch loss is the mean over its labelled tokens (labels != -100),
+    so it is weighted by its share of the step's labelled tokens; the summed
+    gradient then equals that of a single batch holding every micro-batch.
+    Under DDP, gradients are only all-reduced after the last micro-batch, and
+    the weights use the labelled-token count summed over ranks: DDP averages
+    the ranks' gradients, so with per-rank counts a rank with more padding or
+    masked tokens would weigh as much as one with more labels.
+    
+    Args:
+        model: The language model
+        scaler: GradScaler applied to every micro-batch loss
+        micro_batches: List of (x, y) tensors
+        device: Device to run on
+        use_amp: Run the forward pass under autocast
+        eos_token_id: If set, rows are packed documents separated by this token and
+            attention is restricted to each token's own document
+        timer: Optional PhaseTimer for the h2d, forward and backward phases
+    
+    Returns:
+        loss: Token-weighted mean loss over this rank's micro-batches (detached)
+    """
+    timer = timer or PhaseTimer(device, enabled=False)
+    num_tokens = [(y != -100).sum().item() for _, y in micro_batches]
+    total_tokens = max(sum(num_tokens), 1)
+    
+    no_sync = getattr(model, "no_sync", None)
+    # Gradient weight per labelled token; DDP divides the summed gradients by the world size
+    token_weight = 1 / total_tokens
+    world_size = get_world_size()
+    if no_sync is not None and world_size > 1:
+        token_weight = world_size / max(all_reduce_sum(sum(num_tokens)), 1)
+    step_loss = 0.0
+    for i, ((x, y), n) in enumerate(zip(micro_batches, num_tokens)):
+        with timer.phase("h2d"):
+            x, y = x.to(device, non_blocking=True), y.to(device, non_blocking=True)
+            attention_mask = position_ids = None
+            if eos_token_id is not None:
+                attention_mask, position_ids = document_attention_inputs(x, eos_token_id)
+        sync = no_sync is None or i == len(micro_batches) - 1
+        with contextlib.nullcontext() if sync else no_sync():
+            with timer.phase("forward"), autocast(device_type=torch.device(device).type, enabled=use_amp):
+                outputs = model(x, labels=y, return_logits=False, attention_mask=attention_mask, position_ids=position_ids)
+                loss = outputs[1] if isinstance(outputs, tuple) else outputs.loss
+            with timer.phase("backward"):
+                scaler.scale(loss * (n * token_weight)).backward()
+        step_loss = step_loss + loss.detach() * (n / total_tokens)
+    return step_loss
+
+def find_micro_batch_size(model, sequence_length, max_batch_size, device, reserve_bytes=0, headroom=0.1):
+    """
+    Largest micro-batch (halving from max_batch_size) whose forward and backward
+    fit in device memory. Only CUDA out-of-memory errors are detected, so on
+    other devices this returns max_batch_size.
+    
+    The probe runs on the eager model before the optimizer exists, so memory
+    allocated later (optimizer state, DDP gradient buckets, the compiled
+    graph's buffers) is held back while probing: reserve_bytes for the state
+    the caller knows about, plus headroom as a fraction of device memory.
+    """
+    if torch.device(device).type != 'cuda':
+        return max_batch_size
+    total_memory = torch.cuda.get_device_properties(device).total_memory
+    reserved = torch.empty(int(reserve_bytes + headroom * total_memory), dtype=torch.uint8, device=device)
+    batch_size = max_batch_size
+    while batch_size > 1:
+        try:
+            x = torch.randint(0, model.config.vocab_size, (batch_size, sequence_length), device=device)
+            with autocast(device_type='cuda'):
+                _, loss = model(x, labels=x, return_logits=False)
+            loss.backward()
+            break
+        except torch.cuda.OutOfMemoryError:
+            batch_size //= 2
+        finally:
+            model.zero_grad(set_to_none=True)
+            loss = None
+            torch.cuda.empty_cache()
+    del reserved
+    torch.cuda.empty_cache()
+    return batch_size
+
 def train(
     batch_size: int = 16,
     sequence_length: int = 800,
@@ -15,11 +108,78 @@ def train(
     hf_token: str = None,
     sample_frequency: int = 500,
     checkpoint_frequency: int = 500,
-    resume_from_checkpoint: bool = False
+    resume_from_checkpoint: bool = False,
+    prefetch_batches: int = 8,
+    checkpoint_policy: str = "all",
+    checkpoint_every_k: int = 2,
+    keep_checkpoints: int = 3,
+    gradient_accumulation_steps: int = 1,
+    target_tokens_per_step: int = None,
+    backend: str = None,
+    packing: bool = True,
+    document_masks: bool = False,
+    log_interval: int = 10,
+    metrics_path: str = "logs/train_metrics.jsonl",
+    time_phases: bool = True,
+    profile_start_step: int = None,
+    profile_steps: int = 5,
+    peak_tflops: float = None,
+    optimizer_8bit: bool = False,
+    eval_path: str = None,
+    eval_frequency: int = 500,
+    eval_max_windows: int = 64,
+    eval_batch_size: int = 8,
+    data_path: str = None
 ):
-    # Set device
-    device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    print(f"Using device: {device}")
+    """
+    Launch with torchrun (e.g. torchrun --nproc_per_node=2 train.py) for
+    data-parallel training: each rank reads its own part of the stream, and
+    only rank 0 logs, samples and writes checkpoints.
+    
+    Args:
+        batch_size: Micro-batch size (the upper bound when target_tokens_per_step is set)
+        gradient_accumulation_steps: Micro-batches accumulated per optimizer step
+        target_tokens_per_step: If set, use the largest micro-batch up to batch_size
+            that fits in memory and derive gradient_accumulation_steps to reach
+            this many tokens per optimizer step (the probe holds back memory for
+            the optimizer state and a 10% margin, which it allocates later)
+        backend: torch.distributed backend (default: nccl with CUDA, gloo on CPU)
+        packing: Pack whole documents, separated by EOS, into full rows instead of
+            padding one chunk per row
+        document_masks: With packing, stop tokens attending across document
+            boundaries (uses a dense mask, so SDPA cannot pick its flash kernel)
+        log_interval: Steps between metrics records. Reading the loss is the only
+            device sync in the loop, so it happens once per interval and step
+            times are averaged over the interval
+        metrics_path: JSONL file receiving one record per interval (None = off)
+        time_phases: Time data, h2d, forward, backward, optimizer and checkpoint
+            phases (CUDA events on GPU, so no extra syncs)
+        profile_start_step: If set, capture a torch.profiler trace of profile_steps
+            steps from this step into profiles/
+        peak_tflops: Device peak for MFU; looked up for known GPUs when None
+        optimizer_8bit: Keep the AdamW moments as blockwise 8-bit tensors (AdamW8bit),
+            about 2 bytes per parameter instead of 8; resuming from a float32 AdamW
+            checkpoint quantizes its moments
+        sample_frequency: Steps between argmax previews of one training row
+            (None = off); each is one forward pass over that row, a cheap
+            quality signal when no held-out set is configured
+        eval_path: Held-out set from evaluation.py build; if set, held-out
+            perplexity is logged every eval_frequency steps. Inline evaluation
+            blocks training on every rank for its duration (logged as eval_ms;
+            it is left out of tok/sec but not out of wall-clock time), so the
+            recommended setup is to leave this unset and run
+            python evaluation.py watch on the checkpoints instead
+        eval_max_windows: Fixed number of sequence_length windows scored inline,
+            split across ranks
+        eval_batch_size: Windows per evaluation forward pass
+        data_path: Directory of pre-tokenized shards (python memmap_dataloader.py);
+            if set, batches are random windows read from them instead of the
+            streamed, tokenized dataset (packing and prefetch_batches do not apply)
+    """
+    # Set device; joins the process group when launched with torchrun
+    rank, world_size, device = setup_distributed(backend)
+    device_type = torch.device(device).type
+    print(f"Using device: {device} (rank {rank}/{world_size})")
     
     # Set random seed
     torch.manual_seed(1337)
@@ -32,7 +192,23 @@ def train(
     print("Creating model...")
     model = create_model()
     model.to(device)
-    model.gradient_checkpointing_enable()
+    config = model.config
+    model.gradient_checkpointing_enable(checkpoint_policy, every_k=checkpoint_every_k)
+    
+    # Size micro-batches before compiling, so probing does not trigger recompiles
+    if target_tokens_per_step is not None:
+        # Allocated after the probe: AdamW moments (8 bytes per parameter, about 2 for AdamW8bit)
+        # and, under DDP, gradient buckets the size of the fp32 gradients
+        num_params = sum(p.numel() for p in model.parameters())
+        reserve_bytes = num_params * ((2 + 8 / 256) if optimizer_8bit else 8) + (num_params * 4 if world_size > 1 else 0)
+        # Every rank must run the same number of micro-batches (one gradient all-reduce per step),
+        # so all use the smallest micro-batch any rank can fit
+        batch_size = int(all_reduce_min(find_micro_batch_size(model, sequence_length, batch_size, device, reserve_bytes)))
+        gradient_accumulation_steps = max(1, math.ceil(target_tokens_per_step / (batch_size * sequence_length)))
+    tokens_per_step = batch_size * sequence_length * gradient_accumulation_steps
+    if rank == 0:
+        print(f"Micro-batch: {batch_size} x {sequence_length} | accumulation steps: {gradient_accumulation_steps} | "
+              f"tokens/step: {tokens_per_step * world_size} ({world_size} ranks)")
     
     # Compile model
     print("Compiling model...")
@@ -42,71 +218,184 @@ def train(
     tokenizer = initialize_tokenizer(model_path, hf_token)
     
     # Create data loader
-    train_loader = create_cosmopedia_loader(
-        batch_size=batch_size,
-        sequence_length=sequence_length,
-        tokenizer_path=model_path,
-        hf_token=hf_token
-    )
+    if data_path is not None:
+        train_loader = create_memmap_loader(
+            batch_size=batch_size,
+            sequence_length=sequence_length,
+            data_dir=data_path,
+            seed=1337,
+            rank=rank,
+            world_size=world_size
+        )
+    else:
+        train_loader = create_cosmopedia_loader(
+            batch_size=batch_size,
+            sequence_length=sequence_length,
+            tokenizer_path=model_path,
+            hf_token=hf_token,
+            prefetch_batches=prefetch_batches,
+            seed=1337,
+            rank=rank,
+            world_size=world_size,
+            packing=packing
+        )
+    # Shard windows are EOS-separated documents too, so they take document masks like packed rows
+    eos_token_id = tokenizer.eos_token_id if (packing or data_path is not None) and document_masks else None
     
     # Initialize optimizer and scaler
-    optimizer = torch.optim.AdamW(
-        model.parameters(),
-        lr=learning_rate,
-        betas=(0.9, 0.95),
-        eps=1e-8,
-        weight_decay=0.01,
-        foreach=True,
-    )
+    if optimizer_8bit:
+        optimizer = AdamW8bit(
+            model.parameters(),
+            lr=learning_rate,
+            betas=(0.9, 0.95),
+            eps=1e-8,
+            weight_decay=0.01,
+        )
+    else:
+        optimizer = torch.optim.AdamW(
+            model.parameters(),
+            lr=learning_rate,
+            betas=(0.9, 0.95),
+            eps=1e-8,
+            weight_decay=0.01,
+            foreach=True,
+        )
     scaler = GradScaler()
     
     # Load checkpoint if resuming
     start_step = 0
     if resume_from_checkpoint:
         print("Loading checkpoint...")
-        start_step, last_loss = load_checkpoint(model, optimizer, scaler)
-        print(f"Resuming from step {start_step} with loss {last_loss:.6f}")
+        last_step, last_loss = load_checkpoint(model, optimizer, scaler, train_loader=train_loader)
+        print(f"Resuming after step {last_step} with loss {last_loss:.6f}")
+        # The checkpoint is written after its step completes
+        start_step = last_step + 1
+    
+    # Gradients are all-reduced across ranks; sampling and checkpointing use the unwrapped model
+    train_model = model
+    if world_size > 1:
+        train_model = DDP(model, device_ids=[torch.device(device).index] if device_type == 'cuda' else None)
+    
+    # Checkpoints are written in the background; the loop only pauses for the copy to CPU
+    checkpoint_manager = CheckpointManager(save_dir="checkpoints", keep_last=keep_checkpoints)
+    
+    # Instrumentation: phase timers, optional profiler window, JSONL metrics from rank 0
+    timer = PhaseTimer(device, enabled=time_phases)
+    profiler = StepProfiler(profile_start_step, profile_steps, rank=rank, timer=timer) if profile_start_step is not None else None
+    metrics = MetricsLogger(metrics_path if rank == 0 else None)
+    flops_per_token = model_flops_per_token(config, sequence_length)
+    
+    # Held-out perplexity on a fixed subset of windows, if requested
+    held_out = None
+    if eval_path is not None:
+        held_out = HeldOutSet(eval_path, window=sequence_length, max_windows=eval_max_windows)
+        if rank == 0:
+            print(f"Held-out set: {len(held_out)} windows, {held_out.num_tokens} scored tokens")
+    device_peak_flops = peak_tflops * 1e12 if peak_tflops is not None else peak_flops(device)
     
     # Training loop
     model.train()
     print("Starting training...")
     
-    for step in range(start_step, num_steps):
-        t0 = time.time()
-        
-        x, y = train_loader.next_batch()
-        x, y = x.to(device), y.to(device)
+    try:
+        interval_start = time.time()
+        interval_steps = 0
+        interval_loss = 0.0
+        stall_before = train_loader.stall_time
+        for step in range(start_step, num_steps):
+            if profiler is not None:
+                profiler.step_begin(step)
         
-        # Forward pass with mixed precision
-        with autocast(device_type=device):
-            outputs = model(x, labels=y)
-            loss = outputs[1] if isinstance(outputs, tuple) else outputs.loss
+            with timer.phase("data", host=True):
+                micro_batches = [train_loader.next_batch() for _ in range(gradient_accumulation_steps)]
         
-        # Backward pass with gradient scaling
-        scaler.scale(loss).backward()
-        scaler.step(optimizer)
-        scaler.update()
-        optimizer.zero_grad()
+            # Forward and backward passes with mixed precision, accumulating gradients
+            loss = accumulate_gradients(train_model, scaler, micro_batches, device, eos_token_id=eos_token_id, timer=timer)
         
-        # Calculate timing and throughput
-        torch.cuda.synchronize()
-        t1 = time.time()
-        dt = (t1 - t0) * 1000
-        tokens_per_sec = (batch_size * sequence_length) / (t1 - t0)
+            # Optimizer step with gradient scaling
+            with timer.phase("optimizer"):
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad()
+            interval_steps += 1
+            interval_loss = interval_loss + loss
         
-        print(f'step{step} | loss: {loss.item():.6f} | dt: {dt:.2f}ms | tok/sec: {tokens_per_sec:.2f}')
+            if (step + 1) % log_interval == 0 or step == num_steps - 1:
+                # Reading the loss waits for the queued steps, so the wall clock covers them
+                step_loss = all_reduce_mean(interval_loss.item() / interval_steps)
+                dt = (time.time() - interval_start) / interval_steps
+                # Throughput summed over ranks
+                tokens_per_sec = all_reduce_sum(tokens_per_step / dt)
+                data_stats = train_loader.get_stats()
+                record = {
+                    'step': step,
+                    'loss': step_loss,
+                    'lr': optimizer.param_groups[0]['lr'],
+                    'step_time_ms': dt * 1000,
+                    'tokens_per_sec': tokens_per_sec,
+                    'mfu': tokens_per_sec * flops_per_token / (device_peak_flops * world_size) if device_peak_flops else None,
+                    'phase_ms': {name: ms / interval_steps for name, ms in timer.collect().items()},
+                    'data_wait_ms': (train_loader.stall_time - stall_before) * 1000 / interval_steps,
+                    'queue_depth': data_stats['queue_depth'],
+                    'useful_token_fraction': data_stats['useful_token_fraction'],
+                }
+                if device_type == 'cuda':
+                    record['max_memory_allocated_mb'] = torch.cuda.max_memory_allocated(device) / 2**20
+                if rank == 0:
+                    metrics.log(record)
+                    mfu = f" | MFU: {record['mfu']:.1%}" if record['mfu'] is not None else ""
+                    print(f"step{step} | loss: {step_loss:.6f} | dt: {dt * 1000:.2f}ms | tok/sec: {tokens_per_sec:.2f}{mfu}")
+                interval_start = time.time()
+                interval_steps = 0
+                interval_loss = 0.0
+                stall_before = train_loader.stall_time
         
-        # Show sample output
-        if step > 0 and step % sample_frequency == 0:
-            print(f"\n=== Sample at step {step} ===")
-            model.eval()
-            with torch.no_grad(), autocast(device_type=device):
-                sample_model_output(model, x, tokenizer)
-            model.train()
+            # Held-out evaluation stalls training on every rank; its time is kept out
+            # of the logged throughput only, so it still adds to the run's wall-clock time
+            if held_out is not None and (step + 1) % eval_frequency == 0:
+                with timer.phase("eval", host=True):
+                    result = evaluate_perplexity(
+                        model, held_out, eval_batch_size, device, use_amp=True, rank=rank, world_size=world_size
+                    )
+                interval_start += result['seconds']
+                if rank == 0:
+                    metrics.log({
+                        'step': step,
+                        'eval_loss': result['loss'],
+                        'eval_perplexity': result['perplexity'],
+                        'eval_tokens': result['tokens'],
+                        'eval_ms': result['seconds'] * 1000,
+                    })
+                    print(f"step{step} | eval loss: {result['loss']:.6f} | perplexity: {result['perplexity']:.2f} | "
+                          f"{result['seconds'] * 1000:.0f}ms")
+            
+            # Show sample output (one row, not the whole batch)
+            if sample_frequency is not None and step > 0 and step % sample_frequency == 0:
+                with timer.phase("sample", host=True):
+                    if rank == 0:
+                        print(f"\n=== Sample at step {step} ===")
+                    model.eval()
+                    with torch.no_grad(), autocast(device_type=device_type):
+                        sample_model_output(model, micro_batches[-1][0][:1].to(device), tokenizer)
+                    model.train()
+            
+            # Save checkpoint
+            if step > 0 and step % checkpoint_frequency == 0:
+                with timer.phase("checkpoint", host=True):
+                    pause = checkpoint_manager.save(model, optimizer, scaler, step, all_reduce_mean(loss.item()), train_loader=train_loader)
+                if rank == 0:
+                    print(f"Checkpoint snapshot at step {step}: training paused {pause * 1000:.2f}ms")
             
-        # Save checkpoint
-        if step > 0 and step % checkpoint_frequency == 0:
-            save_checkpoint(model, optimizer, scaler, step, loss.item())
+            if profiler is not None:
+                profiler.step_end(step)
+    finally:
+        if profiler is not None:
+            profiler.close()
+        metrics.close()
+        # Let the last checkpoint finish writing before exiting
+        checkpoint_manager.close()
+        train_loader.close()
+        cleanup_distributed()
 
 if __name__ == "__main__":
     HF_TOKEN = "hidden_for_security"
@@ -116,7 +405,6 @@ if __name__ == "__main__":
         sequence_length=800,
         hf_token=HF_TOKEN,
         num_steps=5051,
-        sample_frequency=500,
         checkpoint_frequency=5000,
         resume_from_checkpoint=True
     )
\ No newline at end of file
@@ -0,0 +1,157 @@
+import contextlib
+import json
+import os
+import time
+import torch
+from smollm2_135M import LlamaConfig
+
+# Dense bf16/fp16 tensor-core peak FLOP/s by device name, for MFU
+PEAK_FLOPS = {
+    'H100': 989e12,
+    'A100': 312e12,
+    'L4': 121e12,
+    'A10': 125e12,
+    'V100': 125e12,
+    'T4': 65e12,
+}
+
+def model_flops_per_token(config: LlamaConfig, sequence_length: int) -> float:
+    """
+    Training FLOPs per token (forward + backward) for a decoder-only model.
+    
+    6 FLOPs per matmul weight and token, plus the attention score and value
+    matmuls (12 * layers * hidden * sequence_length, the PaLM estimate). The
+    embedding lookup is free; with tied embeddings the lm_head still counts.
+    Recomputation from gradient checkpointing is not included, as is usual
+    for MFU.
+    """
+    head_dim = config.hidden_size // config.num_attention_heads
+    attention = config.hidden_size * head_dim * (2 * config.num_attention_heads + 2 * config.num_key_value_heads)
+    mlp = 3 * config.hidden_size * config.intermediate_size
+    matmul_params = config.num_hidden_layers * (attention + mlp) + config.hidden_size * config.vocab_size
+    return 6 * matmul_params + 12 * config.num_hidden_layers * config.hidden_size * sequence_length
+
+def peak_flops(device) -> float:
+    """Peak FLOP/s of a known CUDA device, or None"""
+    if torch.device(device).type != 'cuda':
+        return None
+    name = torch.cuda.get_device_name(torch.device(device))
+    for key, flops in PEAK_FLOPS.items():
+        if key in name:
+            return flops
+    return None
+
+class PhaseTimer:
+    """
+    Accumulates time per training phase without synchronizing the device.
+    
+    Device phases on CUDA are bracketed with CUDA events and only read in
+    collect(), after something else (e.g. loss.item() at a logging step) has
+    synchronized; host phases and CPU runs use the wall clock. While a
+    profiler is active every phase is also a named profiler range. When
+    disabled, phase() is a null context.
+    """
+    def __init__(self, device, enabled: bool = True):
+        self.use_events = torch.device(device).type == 'cuda'
+        self.enabled = enabled
+        self.profiling = False
+        self._host = {}  # name -> seconds
+        self._events = []  # (name, start event, end event)
+    
+    @contextlib.contextmanager
+    def phase(self, name: str, host: bool = False):
+        """
+        Args:
+            name: Phase name; repeated phases within a step add up
+            host: Time on the wall clock even on CUDA (work that waits on the CPU,
+                such as data loading or a checkpoint snapshot)
+        """
+        if not self.enabled:
+            yield
+            return
+        with torch.profiler.record_function(name) if self.profiling else contextlib.nullcontext():
+            if self.use_events and not host:
+                start = torch.cuda.Event(enable_timing=True)
+                end = torch.cuda.Event(enable_timing=True)
+                start.record()
+                yield
+                end.record()
+                self._events.append((name, start, end))
+            else:
+                t0 = time.perf_counter()
+                yield
+                self._host[name] = self._host.get(name, 0.0) + time.perf_counter() - t0
+    
+    def collect(self) -> dict:
+        """Milliseconds per phase since the last collect(), then reset"""
+        times = {name: seconds * 1000 for name, seconds in self._host.items()}
+        for name, start, end in self._events:
+            end.synchronize()  # Already complete when called after a sync point
+            times[name] = times.get(name, 0.0) + start.elapsed_time(end)
+        self._host = {}
+        self._events = []
+        return times
+
+class StepProfiler:
+    """
+    torch.profiler capture over a window of training steps.
+    
+    The trace is written as a Chrome trace (open in chrome://tracing or
+    Perfetto) when the window ends.
+    """
+    def __init__(self, start_step: int, num_steps: int, output_dir: str = "profiles", rank: int = 0, timer: PhaseTimer = None):
+        self.start_step = start_step
+        self.end_step = start_step + num_steps
+        self.output_dir = output_dir
+        self.rank = rank
+        self.timer = timer
+        self._profiler = None
+    
+    def step_begin(self, step: int) -> None:
+        if step != self.start_step:
+            return
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self._profiler = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True)
+        self._profiler.__enter__()
+        if self.timer is not None:
+            self.timer.profiling = True
+    
+    def step_end(self, step: int) -> None:
+        if self._profiler is None:
+            return
+        self._profiler.step()
+        if step + 1 >= self.end_step:
+            self.close()
+    
+    def close(self) -> None:
+        """Stop an active capture early (e.g. training ended inside the window) and write it"""
+        if self._profiler is None:
+            return
+        self._profiler.__exit__(None, None, None)
+        if self.timer is not None:
+            self.timer.profiling = False
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(self.output_dir, f"trace_rank{self.rank}_steps{self.start_step}-{self.end_step - 1}.json")
+        self._profiler.export_chrome_trace(path)
+        self._profiler = None
+        print(f"Profiler trace saved to {path}")
+
+class MetricsLogger:
+    """Appends one JSON object per line to a metrics file; does nothing when path is None"""
+    def __init__(self, path: str = None):
+        self.path = path
+        self._file = None
+        if path is not None:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self._file = open(path, "a", buffering=1)  # Line-buffered: every record reaches the file
+    
+    def log(self, record: dict) -> None:
+        if self._file is not None:
+            self._file.write(json.dumps(record) + "\n")
+    
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
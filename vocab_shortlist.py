@@ -0,0 +1,175 @@
+import argparse
+import torch
+import torch.nn as nn
+from datasets import load_dataset
+from transformers import AutoTokenizer
+
+def count_tokens(
+    tokenizer_path: str = "tokenizer",
+    dataset_name: str = "json",
+    subset: str = None,
+    data_files: str = None,
+    max_documents: int = 10_000,
+    tokenize_batch_size: int = 256
+) -> torch.Tensor:
+    """
+    Token frequencies over the first max_documents documents of a dataset.
+    
+    Returns:
+        counts: int64 count per vocabulary id [len(tokenizer)]
+    """
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_path, local_files_only=True)
+    dataset = load_dataset(dataset_name, subset, data_files=data_files, streaming=True)["train"]
+    counts = torch.zeros(len(tokenizer), dtype=torch.long)
+    
+    texts = []
+    for i, example in enumerate(dataset):
+        if i == max_documents:
+            break
+        texts.append(example['text'])
+        if len(texts) == tokenize_batch_size:
+            for ids in tokenizer(texts, add_special_tokens=False)['input_ids']:
+                counts += torch.bincount(torch.tensor(ids, dtype=torch.long), minlength=len(counts))
+            texts = []
+    # Tail that did not fill a tokenizer batch
+    if texts:
+        for ids in tokenizer(texts, add_special_tokens=False)['input_ids']:
+            counts += torch.bincount(torch.tensor(ids, dtype=torch.long), minlength=len(counts))
+    return counts
+
+def build_shortlist(counts: torch.Tensor, size: int, always_include=()) -> torch.Tensor:
+    """Sorted ids of the size most frequent tokens, plus always_include (special tokens)"""
+    token_ids = torch.topk(counts.float(), min(size, len(counts))).indices
+    token_ids = torch.cat([token_ids, torch.tensor(list(always_include), dtype=torch.long)])
+    return torch.unique(token_ids)
+
+class VocabShortlist(nn.Module):
+    """
+    lm_head for greedy decoding that projects onto a token shortlist, with an exactness guard.
+    
+    Each call scores the shortlisted rows of the (tied) output weight and
+    bounds every excluded token's logit from above: excluded rows are split
+    into their projection onto a rank-r basis plus a residual, so
+    h.w <= (B^T h).(B^T w) + |h - B B^T h| |w - B B^T w|, at r/hidden_size
+    of the cost of scoring them. Excluded tokens whose bound reaches the best
+    shortlisted logit are scored exactly; if too many do, the whole
+    vocabulary is projected. Returned logits are exact for every scored
+    token and -inf elsewhere, so their argmax is the full-vocabulary argmax
+    but they are not valid for sampling.
+    """
+    def __init__(self, weight: torch.Tensor, token_ids: torch.Tensor, rank: int = 64, max_rescore_fraction: float = 0.05):
+        """
+        Args:
+            weight: Full output weight [vocab, hidden] (lm_head.weight), kept by reference
+            token_ids: Shortlisted token ids
+            rank: Basis size of the bound on excluded tokens
+            max_rescore_fraction: Project the full vocabulary when more than this
+                fraction of the excluded tokens would need exact scores
+        """
+        super().__init__()
+        self.vocab_size = weight.size(0)
+        self.max_rescore = int(max_rescore_fraction * (self.vocab_size - len(token_ids)))
+        self._weight = [weight]  # Not a submodule parameter: the model owns it
+        
+        token_ids = torch.unique(token_ids.to(weight.device))
+        excluded = torch.ones(self.vocab_size, dtype=torch.bool, device=weight.device)
+        excluded[token_ids] = False
+        excluded_ids = excluded.nonzero().squeeze(1)
+        self.register_buffer("token_ids", token_ids, persistent=False)
+        self.register_buffer("excluded_ids", excluded_ids, persistent=False)
+        self.register_buffer("shortlist_weight", weight.detach()[token_ids].clone(), persistent=False)
+        
+        # Bound terms for the excluded rows, in float32
+        excluded_weight = weight.detach()[excluded_ids].float()
+        _, _, vh = torch.linalg.svd(excluded_weight, full_matrices=False)
+        basis = vh[:rank].t().contiguous()  # [hidden, rank], orthonormal columns
+        coefficients = excluded_weight @ basis
+        self.register_buffer("basis", basis, persistent=False)
+        self.register_buffer("excluded_coefficients", coefficients, persistent=False)
+        self.register_buffer("excluded_residual_norm", (excluded_weight - coefficients @ basis.t()).norm(dim=1), persistent=False)
+        # Slack for float rounding in the bound and the scores it is compared with
+        self.tolerance = 1e-4 * weight.detach().float().norm(dim=1).max().item()
+        self.reset_stats()
+    
+    @classmethod
+    def from_model(cls, model, token_ids: torch.Tensor, **kwargs) -> "VocabShortlist":
+        """Shortlist over a LlamaForCausalLM's dense lm_head"""
+        if not isinstance(model.lm_head, nn.Linear):
+            raise ValueError(f"VocabShortlist needs a dense lm_head, got {type(model.lm_head).__name__}")
+        return cls(model.lm_head.weight, token_ids, **kwargs)
+    
+    def reset_stats(self) -> None:
+        self.calls = 0
+        self.rows = 0  # Hidden states projected
+        self.rescored_tokens = 0  # Excluded tokens scored exactly after failing the bound, summed over calls
+        self.full_fallbacks = 0  # Calls that projected the whole vocabulary
+    
+    def forward(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        """
+        Args:
+            hidden_states: Final hidden states [..., hidden]
+        
+        Returns:
+            logits: [..., vocab], exact where scored and -inf elsewhere
+        """
+        weight = self._weight[0]
+        h = hidden_states.reshape(-1, hidden_states.size(-1))
+        self.calls += 1
+        self.rows += h.size(0)
+        
+        shortlist_logits = h @ self.shortlist_weight.t()
+        best = shortlist_logits.amax(dim=1, keepdim=True).float()
+        
+        h32 = h.float()
+        projected = h32 @ self.basis
+        residual = (h32 - projected @ self.basis.t()).norm(dim=1, keepdim=True)
+        bound = projected @ self.excluded_coefficients.t() + residual * self.excluded_residual_norm
+        candidates = (bound + self.tolerance * h32.norm(dim=1, keepdim=True) >= best).any(dim=0).nonzero().squeeze(1)
+        
+        if len(candidates) > self.max_rescore:
+            self.full_fallbacks += 1
+            return (h @ weight.t()).view(*hidden_states.shape[:-1], self.vocab_size)
+        
+        logits = h.new_full((h.size(0), self.vocab_size), float('-inf'))
+        logits[:, self.token_ids] = shortlist_logits
+        if len(candidates):
+            self.rescored_tokens += len(candidates)
+            rescored_ids = self.excluded_ids[candidates]
+            logits[:, rescored_ids] = h @ weight[rescored_ids].t()
+        return logits.view(*hidden_states.shape[:-1], self.vocab_size)
+
+# Shortlist file layout: a dict with these keys
+#   'token_ids': sorted int64 ids of the shortlisted tokens,
+#   'vocab_size': size of the full vocabulary,
+#   'coverage': fraction of the counted corpus tokens that are shortlisted
+def save_shortlist(path: str, token_ids: torch.Tensor, counts: torch.Tensor) -> None:
+    torch.save({
+        'token_ids': token_ids,
+        'vocab_size': len(counts),
+        'coverage': counts[token_ids].sum().item() / max(counts.sum().item(), 1)
+    }, path)
+
+def load_shortlist(path: str, model, **kwargs) -> VocabShortlist:
+    """VocabShortlist for model from a file written by save_shortlist"""
+    shortlist = torch.load(path, map_location="cpu", weights_only=True)
+    if shortlist['vocab_size'] != model.config.vocab_size:
+        raise ValueError(f"Shortlist is for a vocabulary of {shortlist['vocab_size']}, model has {model.config.vocab_size}")
+    return VocabShortlist.from_model(model, shortlist['token_ids'], **kwargs)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a decoding vocabulary shortlist from corpus token frequencies")
+    parser.add_argument("--output", default="checkpoints/vocab_shortlist.pt")
+    parser.add_argument("--tokenizer-path", default="tokenizer")
+    parser.add_argument("--dataset-name", default="json")
+    parser.add_argument("--subset", default=None)
+    parser.add_argument("--data-files", default=None)
+    parser.add_argument("--max-documents", type=int, default=10_000)
+    parser.add_argument("--size", type=int, default=8192)
+    args = parser.parse_args()
+    
+    counts = count_tokens(args.tokenizer_path, args.dataset_name, args.subset, args.data_files, args.max_documents)
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_path, local_files_only=True)
+    token_ids = build_shortlist(counts, args.size, always_include=tokenizer.all_special_ids)
+    save_shortlist(args.output, token_ids, counts)
+    print(f"Saved {len(token_ids)} of {len(counts)} tokens to {args.output}, "
+          f"covering {counts[token_ids].sum().item() / max(counts.sum().item(), 1):.1%} of corpus tokens")